@@ -30,10 +30,10 @@ from traceback import print_exc
 from .args import INIT_REPOSITORY, INDEX, INGEST, LIST_INDEX, \
     RETRIEVE, RETRIEVE_METADATA, HELP_CMD, SUBSCRIBE, DOWNLOAD, LIST_RETRIEVE, \
     START, STOP, LIST_SUBSCRIBE, UNSUBSCRIBE, DAEMON, \
-    DEV, SUMMARY, LIST_SUMMARY, STATUS, WEB, TRIGGER, ABORT_CODE, ERROR_CODE
+    DEV, SUMMARY, LIST_SUMMARY, STATUS, WEB, TRIGGER, WORKER, ABORT_CODE, ERROR_CODE
 from .config import Config, RepoInitializer
 from .daemon import Starter, Stopper, Daemon, StatusShower
-from .download import Downloader
+from .download import Downloader, DownloadWorker
 from .index import Indexer, IndexLister
 from .ingest import Ingester
 from .logs import LoggingContext
@@ -83,6 +83,8 @@ def execute(command, config):
         return
     commands = dict(COMMANDS)
     commands[HELP_CMD] = (Helper, '')
+    # not listed - started by retrieve for the pool download engine
+    commands[WORKER] = (DownloadWorker, '')
     if command in commands:
         commands[command][0](config).run(config.args)
     else:
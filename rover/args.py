@@ -36,6 +36,7 @@ SUBSCRIBE = 'subscribe'
 TRIGGER = 'trigger'
 UNSUBSCRIBE = 'unsubscribe'
 WEB = 'web'
+WORKER = 'worker'
 INIT = 'init'
 INIT_REPO = 'init-repo'
 INIT_REPOSITORY = 'init-repository'
@@ -50,10 +51,25 @@ ALL = 'all'
 ARGS = 'args'
 ASDF_FILENAME = 'asdf-filename'
 AVAILABILITYURL = 'availability-url'
+AVAILABILITYCACHETTL = 'availability-cache-ttl'
+AVAILABILITYCACHESIZE = 'availability-cache-size'
+AVAILABILITYSHARD = 'availability-shard'
+AVAILABILITYWORKERS = 'availability-workers'
 COMMAND = 'command'
 DATADIR = 'data-dir'
 DATASELECTURL = 'dataselect-url'
+DATASELECTWORKERS = 'dataselect-workers'
 DELETEFILES = 'delete-files'
+DOWNLOADENGINE = 'download-engine'
+CHUNKSAMPLES = 'chunk-samples'
+CHUNKORDER = 'chunk-order'
+COVERAGEENGINE = 'coverage-engine'
+RESUME = 'resume'
+BULKDIFF = 'bulk-diff'
+VERIFYFULLEVERY = 'verify-full-every'
+DOWNLOADADAPTIVE = 'download-adaptive'
+DOWNLOADHEDGE = 'download-hedge'
+DOWNLOADWORKERSMIN = 'download-workers-min'
 DOWNLOADRETRIES = 'download-retries'
 DOWNLOADWORKERS = 'download-workers'
 DEV = 'dev'
@@ -64,6 +80,9 @@ FORCECMD = 'force-cmd'
 FORCEFAILURES = 'force-failures'
 FORCE_METADATA_RELOAD = 'force-metadata-reload'
 FORCEREQUEST = 'force-request'
+FULLRECHECKPERIOD = 'full-recheck-period'
+SUBSCRIPTIONWEIGHT = 'subscription-weight'
+SUBSCRIPTIONWORKERS = 'subscription-workers'
 H, FULLHELP = 'H', 'full-help'
 _h, _help = 'h', 'help'
 FULLCONFIG = 'full-config'
@@ -112,9 +131,20 @@ DYNAMIC_ARGS = (VERSION, HELP_CMD, FULLHELP)
 
 # default values (for non-boolean parameters)
 DEFAULT_ASDF_FILENAME = 'asdf.h5'
+DEFAULT_AVAILABILITYCACHETTL = 0
+DEFAULT_AVAILABILITYCACHESIZE = 100
+DEFAULT_AVAILABILITYSHARD = 1000
+DEFAULT_AVAILABILITYWORKERS = 3
 DEFAULT_AVAILABILITYURL = 'http://service.iris.edu/fdsnws/availability/1/query'
 DEFAULT_DATADIR = 'data'
 DEFAULT_DATASELECTURL = 'http://service.iris.edu/fdsnws/dataselect/1/query'
+DEFAULT_DOWNLOADENGINE = 'subprocess'
+DEFAULT_DOWNLOADHEDGE = 0
+DEFAULT_CHUNKSAMPLES = 10000000
+DEFAULT_CHUNKORDER = 'oldest'
+DEFAULT_COVERAGEENGINE = 'python'
+DEFAULT_VERIFYFULLEVERY = 1
+DEFAULT_DOWNLOADWORKERSMIN = 1
 DEFAULT_DOWNLOADRETRIES = 3
 DEFAULT_DOWNLOADWORKERS = 5
 DEFAULT_EMAILFROM = 'noreply@rover'
@@ -136,6 +166,7 @@ DEFAULT_MSEEDINDEXCMD = 'mseedindex -sqlitebusyto 60000'
 DEFAULT_MSEEDINDEXWORKERS = 10
 DEFAULT_OUTPUT_FORMAT = 'mseed'
 DEFAULT_RECHECKPERIOD = 12
+DEFAULT_FULLRECHECKPERIOD = 168
 DEFAULT_ROVERCMD = 'rover'
 DEFAULT_SMTPADDRESS = 'localhost'
 DEFAULT_STATIONURL = 'http://service.iris.edu/fdsnws/station/1/query'
@@ -292,6 +323,16 @@ class Arguments(ArgumentParser):
         retrieve_group.add_argument(mm(TIMESPANTOL), default=DEFAULT_TIMESPANTOL, action='store', help='fractional tolerance for overlapping timespans', metavar=SAMPLESVAR, type=float)
         retrieve_group.add_argument(mm(DOWNLOADRETRIES), default=DEFAULT_DOWNLOADRETRIES, action='store', help='maximum number of attempts to download data', metavar=NVAR, type=int)
         retrieve_group.add_argument(mm(DOWNLOADWORKERS), default=DEFAULT_DOWNLOADWORKERS, action='store', help='number of download instances to run', metavar=NVAR, type=int)
+        retrieve_group.add_argument(mm(DOWNLOADADAPTIVE), default=False, action='store_bool', help='adjust the number of downloads (up to download-workers) from throughput, download time and errors?', metavar='')
+        retrieve_group.add_argument(mm(DOWNLOADWORKERSMIN), default=DEFAULT_DOWNLOADWORKERSMIN, action='store', help='minimum number of download instances (with download-adaptive)', metavar=NVAR, type=int)
+        retrieve_group.add_argument(mm(DOWNLOADENGINE), default=DEFAULT_DOWNLOADENGINE, action='store', help='how downloads are run. Choose from "subprocess", "thread" (in-process) or "pool" (long-lived worker processes)', metavar='')
+        retrieve_group.add_argument(mm(DOWNLOADHEDGE), default=DEFAULT_DOWNLOADHEDGE, action='store', help='when no other data remain, repeat downloads slower than this percentile of recent downloads (0 to disable)', metavar=PERCENTVAR, type=int)
+        retrieve_group.add_argument(mm(CHUNKSAMPLES), default=DEFAULT_CHUNKSAMPLES, action='store', help='estimated samples per download (stations are combined, or days split, to fit; 0 for one station-day per download)', metavar=NVAR, type=int)
+        retrieve_group.add_argument(mm(CHUNKORDER), default=DEFAULT_CHUNKORDER, action='store', help='order of downloads (by day within each station, and between the stations planned ahead of the downloads). Choose from "oldest", "newest", "largest" or "smallest"', metavar='')
+        retrieve_group.add_argument(mm(RESUME), default=False, action='store_bool', help='continue an interrupted retrieval (if the request is unchanged)?', metavar='')
+        retrieve_group.add_argument(mm(BULKDIFF), default=False, action='store_bool', help='compare availability with the index in a single scan (for large requests)?', metavar='')
+        retrieve_group.add_argument(mm(COVERAGEENGINE), default=DEFAULT_COVERAGEENGINE, action='store', help='how timespans are compared. Choose from "python" or "numpy" (faster for many timespans; needs numpy)', metavar='')
+        retrieve_group.add_argument(mm(VERIFYFULLEVERY), default=DEFAULT_VERIFYFULLEVERY, action='store', help='check the full request on every Nth verification (otherwise only data just downloaded; 0 for never)', metavar=NVAR, type=int)
         retrieve_group.add_argument(mm(ROVERCMD), default=DEFAULT_ROVERCMD, action='store', help='command to run rover', metavar=CMDVAR)
         retrieve_group.add_argument(mm(PREINDEX), default=True, action='store_bool', help='index before retrieval?', metavar='')
         retrieve_group.add_argument(mm(INGEST), default=True, action='store_bool', help='call ingest after retrieval?', metavar='')
@@ -308,7 +349,12 @@ class Arguments(ArgumentParser):
         # downloads
         download_group = self.add_argument_group('download arguments')
         download_group.add_argument(mm(AVAILABILITYURL), default=DEFAULT_AVAILABILITYURL, action='store', help='availability service url', metavar=URLVAR)
-        download_group.add_argument(mm(DATASELECTURL), default=DEFAULT_DATASELECTURL, action='store', help='dataselect service url', metavar=URLVAR)
+        download_group.add_argument(mm(AVAILABILITYSHARD), default=DEFAULT_AVAILABILITYSHARD, action='store', help='maximum request lines in each availability query (larger requests are split; 0 for a single query)', metavar=NVAR, type=int)
+        download_group.add_argument(mm(AVAILABILITYWORKERS), default=DEFAULT_AVAILABILITYWORKERS, action='store', help='number of availability queries to run at once (for split requests)', metavar=NVAR, type=int)
+        download_group.add_argument(mm(AVAILABILITYCACHETTL), default=DEFAULT_AVAILABILITYCACHETTL, action='store', help='age at which a cached availability response is revalidated', metavar=SECSVAR, type=int)
+        download_group.add_argument(mm(AVAILABILITYCACHESIZE), default=DEFAULT_AVAILABILITYCACHESIZE, action='store', help='maximum size (MB) of the availability cache (0 to disable)', metavar=NVAR, type=int)
+        download_group.add_argument(mm(DATASELECTURL), default=DEFAULT_DATASELECTURL, action='store', help='dataselect service url (or several equivalent urls, comma-separated)', metavar=URLVAR)
+        download_group.add_argument(mm(DATASELECTWORKERS), default=0, action='store', help='maximum number of downloads from each dataselect service (0 for no limit)', metavar=NVAR, type=int)
         download_group.add_argument(mm(TEMPDIR), default=DEFAULT_TEMPDIR, action='store', help='temporary storage for downloads', metavar=DIRVAR)
         download_group.add_argument(mm(TEMPEXPIRE), default=DEFAULT_TEMPEXPIRE, action='store', help='number of days before deleting temp files', metavar=DAYSVAR, type=int)
         download_group.add_argument(mm(HTTPTIMEOUT), default=DEFAULT_HTTPTIMEOUT, action='store', help='timeout for HTTP requests', metavar=SECSVAR, type=int)
@@ -325,7 +371,10 @@ class Arguments(ArgumentParser):
         subscription_group = self.add_argument_group('subscription arguments')
         subscription_group.add_argument(mm(SUBSCRIPTIONSDIR), default=DEFAULT_SUBSCRIPTIONSDIR, action='store', help='directory for subscriptions', metavar=DIRVAR)
         subscription_group.add_argument(mm(RECHECKPERIOD), default=DEFAULT_RECHECKPERIOD, action='store', help='time between availabilty checks', metavar=HOURSVAR, type=int)
+        subscription_group.add_argument(mm(FULLRECHECKPERIOD), default=DEFAULT_FULLRECHECKPERIOD, action='store', help='time between full availability checks (others check only data updated since the last success; 0 for always full)', metavar=HOURSVAR, type=int)
         subscription_group.add_argument(mm(FORCEREQUEST), default=False, action='store_bool', help='skip overlap checks (dangerous)?', metavar='')
+        subscription_group.add_argument(mm(SUBSCRIPTIONWEIGHT), default=1, action='store', help='share of downloads, relative to other subscriptions', metavar=NVAR, type=int)
+        subscription_group.add_argument(mm(SUBSCRIPTIONWORKERS), default=0, action='store', help='maximum number of downloads at once (0 for no limit)', metavar=NVAR, type=int)
 
         # logging
         logging_group = self.add_argument_group('logging arguments')
@@ -651,6 +700,11 @@ def fail_early(config):
     elif workers > 5:
         config.log.warn('Many workers - data center may refuse service (%s %d)' %
                         (mm(DOWNLOADWORKERS), workers))
+    if config.arg(DOWNLOADADAPTIVE) and not 0 < config.arg(DOWNLOADWORKERSMIN) <= workers:
+        raise Exception('%s must be between 1 and %s (%d)' %
+                        (mm(DOWNLOADWORKERSMIN), mm(DOWNLOADWORKERS), workers))
+    if not 0 <= config.arg(DOWNLOADHEDGE) < 100:
+        raise Exception('%s must be between 0 and 99 (%d)' % (mm(DOWNLOADHEDGE), config.arg(DOWNLOADHEDGE)))
     if config.arg(OUTPUT_FORMAT).upper() == "ASDF":
         try:
             import pyasdf
@@ -0,0 +1,186 @@
+
+from hashlib import sha1
+from os import listdir, utime, rename
+from os.path import join, exists, getsize, getmtime
+from shutil import copyfile
+from threading import Lock
+from time import time
+
+from .args import AVAILABILITYCACHETTL, AVAILABILITYCACHESIZE
+from .config import availability_cache_dir
+from .utils import http_session, stream_output, unique_filename, canonify, create_parents, \
+    read_json, write_json, safe_unlink, windows
+
+"""
+An on-disk cache of availability responses.
+
+Responses are keyed by the availability URL and the (normalized) request.  A response
+younger than availability-cache-ttl seconds is used directly; an older response is
+revalidated with a conditional request (If-None-Match / If-Modified-Since) when the
+service supplied an ETag or Last-Modified header, and replaced otherwise.  The least
+recently used responses are deleted when the cache exceeds availability-cache-size MB.
+
+A response is only stored if it can be used again (the ttl is non-zero, or the service
+supplied a validator) and it fits in the cache.
+"""
+
+
+DATA_SUFFIX = '.txt'
+META_SUFFIX = '.json'
+
+# the response for a query that returned no data
+EMPTY = 'empty'
+
+
+def cache_key(url, request):
+    """
+    The key for a request - lines are stripped, blank lines dropped and the rest sorted
+    (so that equivalent requests share an entry).
+    """
+    with open(request, 'r') as input:
+        lines = sorted(set(line.strip() for line in input if line.strip()))
+    hash = sha1()
+    for line in [url] + lines:
+        hash.update((line + '\n').encode('utf8'))
+    return hash.hexdigest()
+
+
+class AvailabilityCache:
+    """
+    Fetch availability responses via the cache.  Counts of hits, revalidations and
+    misses are kept so that the hit rate can be logged.
+    """
+
+    def __init__(self, config):
+        self._log = config.log
+        self._dir = availability_cache_dir(config)
+        self._ttl = config.arg(AVAILABILITYCACHETTL)
+        self._max_bytes = config.arg(AVAILABILITYCACHESIZE) * 1024 * 1024
+        self._lock = Lock()
+        self._entries = None  # key -> [last use epoch, size], read from the directory when first needed
+        self._size = 0  # total of the sizes in entries
+        self.hits, self.revalidated, self.misses = 0, 0, 0
+
+    def fetch(self, url, request, response, timeout, retries):
+        """
+        Like post_to_file - returns (path, check_status), where path is a copy of the response
+        (which the caller may delete) or None if there was no data.
+        """
+        key = cache_key(url, request)
+        data, meta_path = join(self._dir, key + DATA_SUFFIX), join(self._dir, key + META_SUFFIX)
+        meta = read_json(meta_path) if self._max_bytes else None
+        if meta and not (meta.get(EMPTY) or exists(data)):
+            meta = None
+        if meta and time() - meta['epoch'] < self._ttl:
+            copied = self._copy(key, meta, data, response)
+            if copied:
+                self._log.debug('Using cached availability for %s' % request)
+                self._count('hits')
+                return copied
+            meta = None
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        self._log.info('Downloading %s from %s with %s' % (response, url, request))
+        with open(canonify(request), 'rb') as input:
+            reply = http_session(retries).post(url, stream=True, data=input, timeout=timeout, headers=headers)
+        if headers and reply.status_code == 304:
+            reply.close()
+            copied = self._copy(key, meta, data, response)
+            if copied:
+                self._log.debug('Cached availability for %s is unchanged' % request)
+                self._count('revalidated')
+                meta['epoch'] = time()
+                write_json(meta_path, meta)
+                return copied
+            # deleted while revalidating (by another process), so request it again
+            with open(canonify(request), 'rb') as input:
+                reply = http_session(retries).post(url, stream=True, data=input, timeout=timeout)
+        self._count('misses')
+        path, check_status = stream_output(reply, response)
+        etag, last_modified = reply.headers.get('ETag'), reply.headers.get('Last-Modified')
+        if self._max_bytes and reply.status_code in (200, 204) and (self._ttl or etag or last_modified) \
+                and (path is None or getsize(path) <= self._max_bytes):
+            self._store(key, path, data, meta_path, {'url': url, 'epoch': time(), EMPTY: path is None,
+                                                     'etag': etag, 'last_modified': last_modified})
+        return path, check_status
+
+    def log_stats(self):
+        """
+        Log the hit rate (if the cache has been used).
+        """
+        total = self.hits + self.revalidated + self.misses
+        if self._max_bytes and total:
+            self._log.info('Availability cache: %d hits, %d revalidated, %d misses (%d%% hit rate)' %
+                           (self.hits, self.revalidated, self.misses,
+                            int(100 * (self.hits + self.revalidated) / total + 0.5)))
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _copy(self, key, meta, data, response):
+        # returns (path, check_status), or None if the entry has been deleted.  the lock
+        # stops other threads evicting the entry while it is copied
+        if meta.get(EMPTY):
+            return None, lambda: None
+        with self._lock:
+            try:
+                utime(data, None)  # the mtime records use, for eviction
+                response = unique_filename(canonify(response))
+                create_parents(response)
+                copyfile(data, response)
+            except (IOError, OSError) as e:
+                self._log.debug('Cached availability %s is no longer available: %s' % (key, e))
+                safe_unlink(response)
+                return None
+            self._read_entries()
+            if key in self._entries:
+                self._entries[key][0] = time()
+        return response, lambda: None
+
+    def _store(self, key, path, data, meta_path, meta):
+        with self._lock:
+            create_parents(data)
+            if path:
+                # copy then rename, so other processes never see a partial response
+                copyfile(path, data + '.tmp')
+                if windows():
+                    safe_unlink(data)
+                rename(data + '.tmp', data)
+            else:
+                safe_unlink(data)
+            write_json(meta_path, meta)
+            self._read_entries()
+            size = getsize(path) if path else 0
+            self._size += size - (self._entries[key][1] if key in self._entries else 0)
+            self._entries[key] = [time(), size]
+            self._evict()
+
+    def _read_entries(self):
+        # the sizes and last use of the entries are read once, and then kept up to date
+        # (so that storing a response does not scan the cache)
+        if self._entries is not None:
+            return
+        self._entries, self._size = {}, 0
+        for name in listdir(self._dir):
+            if name.endswith(META_SUFFIX):
+                key = name[:-len(META_SUFFIX)]
+                data = join(self._dir, key + DATA_SUFFIX)
+                size = getsize(data) if exists(data) else 0
+                self._entries[key] = [getmtime(data if exists(data) else join(self._dir, name)), size]
+                self._size += size
+
+    def _evict(self):
+        # delete the least recently used responses until the cache fits
+        if self._size <= self._max_bytes:
+            return
+        for (_, key) in sorted((used, key) for (key, (used, _)) in self._entries.items()):
+            if self._size <= self._max_bytes:
+                break
+            self._log.debug('Evicting cached availability %s' % key)
+            safe_unlink(join(self._dir, key + META_SUFFIX))
+            safe_unlink(join(self._dir, key + DATA_SUFFIX))
+            self._size -= self._entries.pop(key)[1]
@@ -125,6 +125,15 @@ class BaseConfig:
 def timeseries_db(config):
     return join(config.dir(DATADIR), 'timeseries.sqlite')
 
+def metrics_path(config):
+    return join(config.dir(TEMPDIR), 'rover_metrics.json')
+
+def stats_path(config):
+    return join(config.dir(TEMPDIR), 'rover_stats.json')
+
+def availability_cache_dir(config):
+    return join(config.dir(TEMPDIR), 'availability_cache')
+
 def asdf_container(config):
     return join(config.dir(DATADIR), config.arg(ASDF_FILENAME))
 
@@ -260,3 +269,12 @@ def write_config(config, filename, **kargs):
     safe_unlink(config_path)
     Arguments().write_config(config_path, args, **kargs)
     return config_path
+
+
+def clone_config(config):
+    """
+    A copy of the configuration with a separate database connection
+    (sqlite connections cannot be shared between threads).
+    """
+    return BaseConfig(config.log, config.log_path, config._args,
+                      init_db(timeseries_db(config), config.log), config._configdir)
@@ -1,5 +1,13 @@
+from itertools import chain
 
-from .utils import PushBackIterator, format_epoch, parse_epoch
+from .args import COVERAGEENGINE
+from .packed import unpack_timespans
+from .utils import PushBackIterator, format_epoch, parse_epochs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 Interface to the N_S_L_C / timespan data in tsindex - how much data do we have
@@ -7,6 +15,32 @@ for particular channels?
 """
 
 
+# nominal samplerates (Hz) for SEED band codes, used to estimate download sizes
+# when the samplerate is not known from the local index.
+BAND_SAMPLERATES = {'F': 1000, 'G': 1000, 'D': 250, 'C': 250, 'E': 100, 'S': 40, 'H': 100, 'B': 40,
+                    'M': 10, 'L': 1, 'V': 0.1, 'U': 0.01, 'R': 0.001, 'P': 0.0001, 'T': 0.00001,
+                    'Q': 0.000001}
+DEFAULT_SAMPLERATE = 100
+
+# implementations of Coverage (see coverage_class())
+PYTHON, NUMPY = 'python', 'numpy'
+ENGINES = (PYTHON, NUMPY)
+
+# added to the tolerance and increment when deciding whether timespans interact (s), so
+# that rounding errors never separate timespans that should be compared
+REACH_MARGIN = 0.001
+
+
+def nominal_samplerate(sncl):
+    """
+    The nominal samplerate for the channel in N_S_L_C (from the band code).
+    """
+    try:
+        return BAND_SAMPLERATES.get(sncl.split('_')[3][0].upper(), DEFAULT_SAMPLERATE)
+    except IndexError:
+        return DEFAULT_SAMPLERATE
+
+
 class Coverage:
     """
     The data coverage (timespans) with the index for a given N_S_L_C.
@@ -43,6 +77,18 @@ class Coverage:
         self.add_samplerate(samplerate)
         self.timespans.append((start, end))
 
+    def duration(self):
+        """
+        The total time (s) covered by the timespans.
+        """
+        return sum(end - start for (start, end) in self.timespans)
+
+    def estimated_samplerate(self):
+        """
+        The samplerate if known (from the index), otherwise a nominal value.
+        """
+        return self.samplerate if self.samplerate else nominal_samplerate(self.sncl)
+
     def join(self):
         self._log.debug('Joining overlapping timespans')
         if self:  # avoid looking at samplerate if no data
@@ -110,70 +156,305 @@ class Coverage:
         self.join()
         other.join()
 
-        us, them = PushBackIterator(iter(self.timespans)), PushBackIterator(iter(other.timespans))
         difference = Coverage(self._log, self._frac_tolerance, self._frac_increment, self.sncl)
         difference.add_samplerate(self.samplerate)
-        while True:
-            try:
-                us_start, us_end = next(us)
-            except StopIteration:
-                # we can return difference now, because there's only more subtracting to do
-                return difference
-            try:
-                them_start, them_end = next(them)
-            except StopIteration:
-                # there's no more subtraction, so everything left goes into difference
+        for start, end in subtract_timespans(self.timespans, other.timespans, tolerance, increment):
+            difference.add_epochs(start, end)
+        return difference
+
+
+def subtract_timespans(us, them, tolerance, increment):
+    """
+    The timespans (sorted, joined) in us that are not in them, in order (see Coverage.subtract).
+    """
+    us, them = PushBackIterator(iter(us)), PushBackIterator(iter(them))
+    while True:
+        try:
+            us_start, us_end = next(us)
+        except StopIteration:
+            # we can stop now, because there's only more subtracting to do
+            return
+        try:
+            them_start, them_end = next(them)
+        except StopIteration:
+            # there's no more subtraction, so everything left goes into difference
+            if us_end - us_start >= tolerance:
+                yield us_start, us_end
+            for (us_start, us_end) in us:
                 if us_end - us_start >= tolerance:
-                    difference.add_epochs(us_start, us_end)
-                for (us_start, us_end) in us:
-                    if us_end - us_start >= tolerance:
-                        difference.add_epochs(us_start, us_end)
-                return difference
-
-            # we start together
-            if abs(us_start - them_start) < tolerance:
-                # if we end together too, there's nothing to do
-                if abs(us_end - them_end) < tolerance:
-                    pass
-                # if we end first, so are completely wiped out, while they live to
-                # perhaps delete more
-                elif us_end < them_end:
-                    them.push((them_start, them_end))
-                # but they end first.  so some of our timespan still lives to face
-                # the next challenger.
-                else:
-                    # since this is a real difference we need to nudge forwards so
-                    # that we avoid including the end point of them again.
-                    us.push((them_end + increment, us_end))
-            # we start before them (difference must be larger than tolerance - see above)
-            elif us_start < them_start:
-                # we also end before them, so we're home free into the difference and
-                # they live to try kill our next timespan
-                if us_end < them_start:
-                    difference.add_epochs(us_start, us_end)
-                    them.push((them_start, them_end))
-                # we end after they start, so we overlap.  save the initial part in
-                # the difference and push the rest back for further consideration.
-                else:
-                    # is (us_start, them_start - increment) worth adding?
-                    if them_start - increment - us_start >= tolerance:
-                        difference.add_epochs(us_start, them_start - increment)
-                    if us_end - them_start > tolerance:
-                        us.push((them_start, us_end))
-                    them.push((them_start, them_end))
-            # we start after them
+                    yield us_start, us_end
+            return
+
+        # we start together
+        if abs(us_start - them_start) < tolerance:
+            # if we end together too, there's nothing to do
+            if abs(us_end - them_end) < tolerance:
+                pass
+            # if we end first, so are completely wiped out, while they live to
+            # perhaps delete more
+            elif us_end < them_end:
+                them.push((them_start, them_end))
+            # but they end first.  so some of our timespan still lives to face
+            # the next challenger.
             else:
-                # if we also end before them, then we're deleted completely
-                # while they continue to face our next timespan.
-                # (this is tricky - we can end slightly after, if it's within tolerance)
-                if us_end - them_end < tolerance:
-                    them.push((them_start, them_end))
-                # but we also end after them.  so some (perhaps all) of our timespan
-                # remains to face their next timespan.
-                else:
-                    # again, we need to nudge forwards beyond them to avoid
-                    # re-including the point
-                    us.push((max(them_end + increment, us_start), us_end))
+                # since this is a real difference we need to nudge forwards so
+                # that we avoid including the end point of them again.
+                us.push((them_end + increment, us_end))
+        # we start before them (difference must be larger than tolerance - see above)
+        elif us_start < them_start:
+            # we also end before them, so we're home free into the difference and
+            # they live to try kill our next timespan
+            if us_end < them_start:
+                yield us_start, us_end
+                them.push((them_start, them_end))
+            # we end after they start, so we overlap.  save the initial part in
+            # the difference and push the rest back for further consideration.
+            else:
+                # is (us_start, them_start - increment) worth adding?
+                if them_start - increment - us_start >= tolerance:
+                    yield us_start, them_start - increment
+                if us_end - them_start > tolerance:
+                    us.push((them_start, us_end))
+                them.push((them_start, them_end))
+        # we start after them
+        else:
+            # if we also end before them, then we're deleted completely
+            # while they continue to face our next timespan.
+            # (this is tricky - we can end slightly after, if it's within tolerance)
+            if us_end - them_end < tolerance:
+                them.push((them_start, them_end))
+            # but we also end after them.  so some (perhaps all) of our timespan
+            # remains to face their next timespan.
+            else:
+                # again, we need to nudge forwards beyond them to avoid
+                # re-including the point
+                us.push((max(them_end + increment, us_start), us_end))
+
+
+class ArrayCoverage(Coverage):
+    """
+    A Coverage with the timespans held in (sorted) numpy arrays of start and end
+    epochs (coverage-engine=numpy).
+
+    Joining and subtracting give the same results as Coverage, but the common cases
+    are handled with array operations.  For subtraction our timespans are grouped by
+    the timespans of theirs that they interact with (those within the tolerance and
+    increment); groups with none, or a single timespan each, are calculated directly
+    and only the rest are passed to the timespan-by-timespan code.
+    """
+
+    def __init__(self, log, frac_tolerance, frac_increment, sncl):
+        if np is None:
+            raise Exception("Missing required 'numpy' python package for '%s=%s'" % (COVERAGEENGINE, NUMPY))
+        self._starts, self._ends, self._pending, self._list = np.empty(0), np.empty(0), [], None
+        super().__init__(log, frac_tolerance, frac_increment, sncl)
+
+    @property
+    def timespans(self):
+        if self._list is None:
+            starts, ends = self.arrays()
+            self._list = list(zip(starts.tolist(), ends.tolist()))
+        return self._list
+
+    @timespans.setter
+    def timespans(self, timespans):
+        self._set_arrays(np.array([start for (start, _) in timespans], dtype=float),
+                         np.array([end for (_, end) in timespans], dtype=float))
+
+    def arrays(self):
+        """
+        The start and end epochs, as arrays.
+        """
+        if self._pending:
+            pending = np.fromiter(chain.from_iterable(self._pending), dtype=float,
+                                  count=2 * len(self._pending)).reshape(-1, 2)
+            self._starts = np.concatenate((self._starts, pending[:, 0]))
+            self._ends = np.concatenate((self._ends, pending[:, 1]))
+            self._pending = []
+        return self._starts, self._ends
+
+    def _set_arrays(self, starts, ends):
+        self._starts, self._ends, self._pending, self._list = starts, ends, [], None
+
+    def add_epochs(self, start, end, samplerate=None):
+        self.add_samplerate(samplerate)
+        self._pending.append((start, end))
+        self._list = None
+
+    def duration(self):
+        starts, ends = self.arrays()
+        return float((ends - starts).sum())
+
+    def __bool__(self):
+        return bool(len(self._starts) or self._pending)
+
+    def __str__(self):
+        starts, ends = self.arrays()
+        return '%s: %d timespans from %s to %s' % (
+            self.sncl, len(starts),
+            format_epoch(starts[0]) if len(starts) else '-',
+            format_epoch(ends[-1]) if len(ends) else '-'
+        )
+
+    def join(self):
+        self._log.debug('Joining overlapping timespans')
+        if self:
+            tolerance, increment = self.tolerances()
+            starts, ends = self.arrays()
+            if self.samplerate == 0:
+                if (starts < starts[0]).any():
+                    raise Exception('Unsorted start times')
+                self._log.debug('Joining channel with sample rate of zero.')
+                self._set_arrays(starts[:1], ends[-1:])
+                return
+            # the end of the joined timespan that each timespan is compared with
+            previous = np.maximum.accumulate(ends)[:-1]
+            gaps = starts[1:] - previous
+            separation = 1.0 / self.samplerate + tolerance
+            if (starts[1:] < starts[:-1]).any() or (gaps <= -separation).any():
+                # unsorted, or a timespan starting well inside the one before (which
+                # Coverage keeps separately) - these are rare, so use the original code
+                super().join()
+                return
+            breaks = gaps >= separation
+            first, last = np.concatenate(([True], breaks)), np.concatenate((breaks, [True]))
+            self._set_arrays(starts[first], np.maximum.accumulate(ends)[last])
+
+    def subtract(self, other):
+        if not self.sncl == other.sncl:
+            raise Exception('Cannot subtract mismatched availabilities')
+        if not other:  # subtracting zero (avoid checking samplerate)
+            return self
+
+        # minimal samplerate
+        self.add_samplerate(other.samplerate)
+        other.add_samplerate(self.samplerate)
+        tolerance, increment = self.tolerances()
+        self.join()
+        other.join()
+
+        difference = ArrayCoverage(self._log, self._frac_tolerance, self._frac_increment, self.sncl)
+        difference.add_samplerate(self.samplerate)
+        if self.samplerate == 0:
+            for start, end in subtract_timespans(self.timespans, other.timespans, tolerance, increment):
+                difference.add_epochs(start, end)
+            return difference
+        us_starts, us_ends = self.arrays()
+        if isinstance(other, ArrayCoverage):
+            them_starts, them_ends = other.arrays()
+        else:
+            them_starts = np.array([start for (start, _) in other.timespans], dtype=float)
+            them_ends = np.array([end for (_, end) in other.timespans], dtype=float)
+        n_us, n_them = len(us_starts), len(them_starts)
+        if not n_us:
+            return difference
+
+        # only timespans closer than this interact (further apart, the order of comparison
+        # guarantees that a timespan of ours is either unchanged or dropped as too short)
+        reach = tolerance + increment + REACH_MARGIN
+        if (us_starts[1:] < us_ends[:-1]).any() or (them_starts[1:] < them_ends[:-1]).any() or \
+                (us_ends < us_starts).any() or (them_ends < them_starts).any():
+            # overlapping (see join) or inverted timespans, so use the original code
+            for start, end in subtract_timespans(self.timespans, other.timespans, tolerance, increment):
+                difference.add_epochs(start, end)
+            return difference
+        # the range of their timespans that each of ours interacts with
+        lo = np.searchsorted(them_ends, us_starts - reach, side='left')
+        hi = np.searchsorted(them_starts, us_ends + reach, side='right')
+        counts = hi - lo
+        # groups of ours that share any of theirs are handled together
+        shared = (counts[1:] > 0) & (counts[:-1] > 0) & (lo[1:] < hi[:-1])
+        firsts = np.nonzero(np.concatenate(([True], ~shared)))[0]
+        lasts = np.concatenate((firsts[1:], [n_us])) - 1
+        group_lo, group_hi = lo[firsts], hi[lasts]
+        # timespans followed by one of theirs are never dropped as too short
+        more = group_hi < n_them
+
+        # pieces of the difference, with the index of the first timespan in the group and
+        # the position within the group (for ordering)
+        pieces = []
+
+        # groups of one of ours and none of theirs are unchanged
+        single = firsts == lasts
+        alone = single & (group_lo == group_hi)
+        keep = firsts[alone & (more | (us_ends[firsts] - us_starts[firsts] >= tolerance))]
+        pieces.append((keep, np.zeros(len(keep), dtype=int), us_starts[keep], us_ends[keep]))
+
+        # groups of one of ours and one of theirs (see subtract_timespans for the logic)
+        pairs = single & (group_hi - group_lo == 1)
+        us_index, them_index, more_pair = firsts[pairs], group_lo[pairs], more[pairs]
+        s, e = us_starts[us_index], us_ends[us_index]
+        ts, te = them_starts[them_index], them_ends[them_index]
+        together = np.abs(s - ts) < tolerance
+        before = ~together & (s < ts)
+        # we start before them and end before them
+        whole = before & (e < ts)
+        pieces.append((us_index[whole], np.zeros(whole.sum(), dtype=int), s[whole], e[whole]))
+        # we start before them and overlap (the remainder then starts with them)
+        overlap = before & ~whole
+        initial = overlap & (ts - increment - s >= tolerance)
+        pieces.append((us_index[initial], np.zeros(initial.sum(), dtype=int), s[initial], ts[initial] - increment))
+        s = np.where(overlap, ts, s)
+        active = ~before | (overlap & (e - ts > tolerance))
+        together = np.abs(s - ts) < tolerance
+        # what remains after they end
+        after = active & np.where(together, ~(np.abs(e - te) < tolerance) & ~(e < te), ~(e - te < tolerance))
+        tail_starts = np.where(together, te + increment, np.maximum(te + increment, s))
+        after &= more_pair | (e - tail_starts >= tolerance)
+        pieces.append((us_index[after], np.ones(after.sum(), dtype=int), tail_starts[after], e[after]))
+
+        # anything else is handled timespan by timespan (with a sentinel timespan of
+        # theirs if there are more later)
+        others = np.nonzero(~(alone | pairs))[0]
+        for first, last, them_lo, them_hi, later in zip(firsts[others].tolist(), lasts[others].tolist(),
+                                                       group_lo[others].tolist(), group_hi[others].tolist(),
+                                                       more[others].tolist()):
+            them = list(zip(them_starts[them_lo:them_hi].tolist(), them_ends[them_lo:them_hi].tolist()))
+            if later:
+                them.append((float('inf'), float('inf')))
+            mixed = list(subtract_timespans(zip(us_starts[first:last + 1].tolist(), us_ends[first:last + 1].tolist()),
+                                            them, tolerance, increment))
+            if mixed:
+                starts, ends = zip(*mixed)
+                pieces.append((np.full(len(mixed), first, dtype=int), np.arange(len(mixed)),
+                               np.array(starts), np.array(ends)))
+
+        groups, positions, starts, ends = (np.concatenate(column) for column in zip(*pieces))
+        order = np.lexsort((positions, groups))
+        difference._set_arrays(starts[order].astype(float), ends[order].astype(float))
+        return difference
+
+
+def coverage_class(engine):
+    """
+    The Coverage implementation for the coverage-engine option.
+    """
+    engine = engine.lower()
+    if engine == PYTHON:
+        return Coverage
+    elif engine == NUMPY:
+        if np is None:
+            raise Exception("Missing required 'numpy' python package for '%s=%s'" % (COVERAGEENGINE, NUMPY))
+        return ArrayCoverage
+    else:
+        raise Exception('Unknown coverage engine "%s" (choose from %s)' % (engine, ', '.join(ENGINES)))
+
+
+def parse_timespans(timespans):
+    """
+    Parse the timespans column from tsindex (or <start end> if that is missing).
+    """
+    if timespans is None:
+        raise Exception('Unexpected NULL reading timespans')
+    for pair in timespans.split(','):
+        inner = pair[1:-1]
+        if pair[0] == '[':
+            start, end = map(float, inner.split(':'))
+        elif pair[0] == '<':
+            start, end = parse_epochs(inner.split(' '))
+        else:
+            raise Exception('Unexpected timespans format: "%s"' % pair)
+        yield start, end
 
 
 # builders are needed to buffer the data read from the database and sort it,
@@ -188,23 +469,16 @@ class BaseBuilder:
     Shared functionality for all coverage builders.
     """
 
-    def __init__(self, log, frac_tolerance, frac_increment):
+    def __init__(self, log, frac_tolerance, frac_increment, coverage_class=Coverage):
         self._log = log
         self._frac_tolerance = frac_tolerance
         self._frac_increment = frac_increment
+        self._coverage_class = coverage_class
 
-    def _parse_timespans(self, timespans):
-        if timespans is None:
-            raise Exception('Unexpected NULL reading timespans')
-        for pair in timespans.split(','):
-            inner = pair[1:-1]
-            if pair[0] == '[':
-                start, end = map(float, inner.split(':'))
-            elif pair[0] == '<':
-                start, end = map(parse_epoch, inner.split(' '))
-            else:
-                raise Exception('Unexpected timespans format: "%s"' % pair)
-            yield start, end
+    def _parse_timespans(self, timespans, packed=None):
+        if packed is not None:
+            return unpack_timespans(packed)
+        return parse_timespans(timespans)
 
 
 class SingleSNCLBuilder(BaseBuilder):
@@ -214,17 +488,17 @@ class SingleSNCLBuilder(BaseBuilder):
     The mseedindex schema design makes it difficult to sort this information in SQL.
     """
 
-    def __init__(self, log, frac_tolerance, frac_increment, sncl):
-        super().__init__(log, frac_tolerance, frac_increment)
+    def __init__(self, log, frac_tolerance, frac_increment, sncl, coverage_class=Coverage):
+        super().__init__(log, frac_tolerance, frac_increment, coverage_class=coverage_class)
         self._sncl = sncl
         self._timespans = []
 
-    def add_timespans(self, timespans, samplerate=None):
-        for start, end in self._parse_timespans(timespans):
+    def add_timespans(self, timespans, samplerate=None, packed=None):
+        for start, end in self._parse_timespans(timespans, packed):
             self._timespans.append((start, end, samplerate))
 
     def coverage(self):
-        coverage = Coverage(self._log, self._frac_tolerance, self._frac_increment, self._sncl)
+        coverage = self._coverage_class(self._log, self._frac_tolerance, self._frac_increment, self._sncl)
         for start, end, samplerate in sorted(self._timespans):
             coverage.add_epochs(start, end, samplerate)
         return coverage
@@ -237,22 +511,22 @@ class MultipleSNCLBuilder(BaseBuilder):
     The mseedindex schema design makes it difficult to sort this information in SQL.
     """
 
-    def __init__(self, log, frac_tolerance, frac_increment, join=True):
-        super().__init__(log, frac_tolerance, frac_increment)
+    def __init__(self, log, frac_tolerance, frac_increment, join=True, coverage_class=Coverage):
+        super().__init__(log, frac_tolerance, frac_increment, coverage_class=coverage_class)
         self._join = join
         self._timespans = {}
 
-    def add_timespans(self, sncl, timespans, samplerate=None):
+    def add_timespans(self, sncl, timespans, samplerate=None, packed=None):
         if sncl not in self._timespans:
             self._timespans[sncl] = []
         ts = self._timespans[sncl]
-        for start, end in self._parse_timespans(timespans):
+        for start, end in self._parse_timespans(timespans, packed):
             ts.append((start, end, samplerate))
 
     def coverages(self):
         for sncl in sorted(self._timespans.keys()):
             ts = self._timespans[sncl]
-            coverage = Coverage(self._log, self._frac_tolerance, self._frac_increment, sncl)
+            coverage = self._coverage_class(self._log, self._frac_tolerance, self._frac_increment, sncl)
             for start, end, samplerate in sorted(ts):
                 coverage.add_epochs(start, end, samplerate)
             if self._join:
@@ -3,16 +3,17 @@ from sqlite3 import OperationalError
 from time import sleep, time
 
 from rover import __version__
-from .args import START, DAEMON, ROVERCMD, RECHECKPERIOD, PREINDEX, POSTSUMMARY, fail_early, STOP, UserFeedback, \
+from .args import START, DAEMON, ROVERCMD, RECHECKPERIOD, FULLRECHECKPERIOD, PREINDEX, POSTSUMMARY, fail_early, STOP, UserFeedback, \
     FORCECMD
 from .config import write_config
-from .manager import DownloadManager
+from .manager import DownloadManager, INCONSISTENT
 from .report import Reporter
 from .index import Indexer
 from .process import ProcessManager
 from .sqlite import SqliteSupport
+from .subscribe import create_subscriptions_table
 from .summary import Summarizer
-from .utils import check_cmd, run, windows
+from .utils import check_cmd, run, windows, format_epoch
 
 """
 Commands related to the daemon:
@@ -37,6 +38,10 @@ option, --recheck-period, sets the time interval in hours for the daemon to
 reprocess. ROVER start is the preferred method to initiate the retrieval of
 data via subscription(s).
 
+Rechecks ask the availability service only for data updated since the last
+successful check of the subscription (its updatedafter option).  A full
+check is made every full-recheck-period hours.
+
 See also `rover stop`, `rover status` and `rover daemon`.
 
 ##### Significant Options
@@ -48,6 +53,7 @@ See also `rover stop`, `rover status` and `rover daemon`.
 @temp-dir
 @subscriptions-dir
 @recheck-period
+@full-recheck-period
 @download-retries
 @http-timeout
 @http-retries
@@ -188,6 +194,7 @@ See also `rover stop`, `rover status`.
 @temp-dir
 @subscriptions-dir
 @recheck-period
+@full-recheck-period
 @download-retries
 @http-timeout
 @http-retries
@@ -223,7 +230,10 @@ REMINDER: ROVER start is the preferred method to launch the subscription service
         self._pre_index = config.arg(PREINDEX)
         self._post_summary = config.arg(POSTSUMMARY)
         self._download_manager = DownloadManager(config, DOWNLOADCONFIG)
+        create_subscriptions_table(self)
         self._recheck_period = config.arg(RECHECKPERIOD) * 60 * 60
+        self._full_recheck_period = config.arg(FULLRECHECKPERIOD) * 60 * 60
+        self._checks = {}  # id -> (epoch, full) for the checks in progress
         self._reporter = Reporter(config)
         self._config = config
 
@@ -241,7 +251,7 @@ REMINDER: ROVER start is the preferred method to launch the subscription service
                     if self._download_manager.is_idle():
                         sleep(60)
                 self._download_manager.step()
-                sleep(1)
+                self._download_manager.wait()
             except Exception as e:
                 self._reporter.send_email('ROVER Failure', self._reporter.describe_error(DAEMON, e))
                 raise
@@ -249,6 +259,12 @@ REMINDER: ROVER start is the preferred method to launch the subscription service
     def _source_callback(self, source):
         self.execute('''UPDATE rover_subscriptions SET last_error_count = ?, consistent = ? WHERE id = ?''',
                      (source.errors.final_errors, source.consistent, source.name))
+        epoch, full = self._checks.pop(source.name, (None, False))
+        if epoch is not None and not source.errors.final_errors and source.consistent != INCONSISTENT:
+            # later checks need only consider data updated since this one started
+            self.execute('''UPDATE rover_subscriptions SET last_success_epoch = ? WHERE id = ?''', (epoch, source.name))
+            if full:
+                self.execute('''UPDATE rover_subscriptions SET last_full_epoch = ? WHERE id = ?''', (epoch, source.name))
         if self._post_summary:
             Summarizer(self._config).run([])
         subject, msg = self._reporter.describe_daemon(source)
@@ -281,9 +297,24 @@ REMINDER: ROVER start is the preferred method to launch the subscription service
 
     def _add_subscription(self, id):
         try:
-            path, availability_url, dataselect_url = self.fetchone(
-                '''SELECT file, availability_url, dataselect_url FROM rover_subscriptions WHERE id = ?''', (id,))
-            self._log.default('Adding subscription %d (%s, %s)' % (id, availability_url, dataselect_url))
-            self._download_manager.add(id, path, True, availability_url, dataselect_url, self._source_callback)
+            path, availability_url, dataselect_url, weight, max_workers, last_success_epoch, last_full_epoch = \
+                self.fetchone('''SELECT file, availability_url, dataselect_url, weight, max_workers,
+                                        last_success_epoch, last_full_epoch
+                                   FROM rover_subscriptions WHERE id = ?''', (id,))
+            epoch = time()
+            full = self._is_full_check(epoch, last_success_epoch, last_full_epoch)
+            updated_after = None if full else last_success_epoch
+            self._log.default('Adding subscription %d (%s, %s, %s)' %
+                              (id, availability_url, dataselect_url,
+                               'full check' if full else 'data updated after %s' % format_epoch(updated_after)))
+            self._checks[id] = (epoch, full)
+            self._download_manager.add(id, path, True, availability_url, dataselect_url, self._source_callback,
+                                       weight=weight, max_workers=max_workers, updated_after=updated_after)
         finally:
             self.execute('''UPDATE rover_subscriptions SET last_check_epoch = ? WHERE id = ?''', (time(), id))
+
+    def _is_full_check(self, epoch, last_success_epoch, last_full_epoch):
+        # a full check is needed if there has been no successful full check within full-recheck-period
+        # (the start of the last successful check is the earliest time that an update could have been missed)
+        return not self._full_recheck_period or last_success_epoch is None or last_full_epoch is None or \
+            epoch - last_full_epoch >= self._full_recheck_period
@@ -1,18 +1,22 @@
 import os
 import json
 import sys
+from time import time
 
 from .args import DOWNLOAD, TEMPDIR, DELETEFILES, INGEST, \
     TEMPEXPIRE, HTTPTIMEOUT, \
-    HTTPRETRIES, DATASELECTURL
+    HTTPRETRIES, DATASELECTURL, DOWNLOADHEDGE, ERROR_CODE
+from .endpoints import split_urls
 from .ingest import Ingester
 from .sqlite import SqliteSupport
 from .utils import uniqueish, get_to_file, unique_filename, \
     clean_old_files, match_prefixes, create_parents, unique_path, \
-    safe_unlink, post_to_file, diagnose_error
+    safe_unlink, post_to_file, diagnose_error, http_session, create_exclusive
 
 """
 The 'rover download' command - download data from a URL (and then call ingest).
+
+The 'rover worker' command - run many downloads for the pool download engine.
 """
 
 
@@ -23,6 +27,19 @@ TMPDOWNLOAD = 'rover_download'
 # name of source when not a subscription
 DEFAULT_NAME = -1
 
+# a second (hedged) copy of a download uses the same request file name with this suffix
+HEDGE_SUFFIX = '_hedge'
+CLAIM_SUFFIX = '.claim'
+
+
+def claim_path(request_path):
+    """
+    The file that marks a download request (and any hedged copy) as claimed for ingest.
+    """
+    if request_path.endswith(HEDGE_SUFFIX):
+        request_path = request_path[:-len(HEDGE_SUFFIX)]
+    return request_path + CLAIM_SUFFIX
+
 
 class Downloader(SqliteSupport):
     """
@@ -85,13 +102,17 @@ will download, ingest and index data from `dataselect-url` after POSTing
     def __init__(self, config):
         SqliteSupport.__init__(self, config)
         self._temp_dir = config.dir(TEMPDIR)
-        self._dataselect_url = config.arg(DATASELECTURL)
+        # if there are several services, the caller chooses (the first is the default)
+        self._dataselect_url = split_urls(config.arg(DATASELECTURL))[0]
         self._delete_files = config.arg(DELETEFILES)
         self._blocksize = 1024 * 1024
         self._ingest = config.arg(INGEST)
         self._http_timeout = config.arg(HTTPTIMEOUT)
         self._http_retries = config.arg(HTTPRETRIES)
+        self._hedge = config.arg(DOWNLOADHEDGE)
         self._config = config
+        self.__ingester = None
+        self.__session = None
         clean_old_files(self._temp_dir, config.arg(TEMPEXPIRE), match_prefixes(TMPDOWNLOAD), self._log)
 
     def run(self, args):
@@ -100,7 +121,41 @@ will download, ingest and index data from `dataselect-url` after POSTing
         """
         if len(args) < 1 or len(args) > 2:
             raise Exception('Usage: rover %s url [path]' % DOWNLOAD)
-        in_path_or_url = args[0]
+        try:
+            feedback = self.download(*args)
+        except Exception as e:
+            # the caller still gets any feedback (eg the HTTP status) on error
+            self._write_feedback(getattr(e, 'feedback', None))
+            raise
+        self._write_feedback(feedback)
+        if self._delete_files:
+            # Remove empty log files to avoid clutter
+            log_path = self._config.log_path
+            if os.path.exists(log_path) and os.path.getsize(log_path) == 0:
+                safe_unlink(log_path)
+
+    def _write_feedback(self, feedback):
+        # write feedback, in JSON, to caller on stdout with download byte count
+        if feedback:
+            sys.stdout.write(json.dumps(feedback))
+
+    def download(self, in_path_or_url, out_path=None, dataselect_url=None):
+        """
+        Download, ingest and index, returning feedback for the caller.  This is called
+        directly by the in-process and pool download engines.  For a file, the data are
+        requested from dataselect_url, if given, otherwise from the dataselect-url option.
+
+        The feedback is a dictionary with:
+          start_epoch - when the download started
+          http_status - the HTTP status (if any)
+          download_byte_count - the size of the downloaded data
+          sections - the number of sections (contiguous data, as indexed by mseedindex) ingested
+          files - the day files in the repository that were changed
+          duplicate - true if the data were not ingested because a hedged copy claimed them first
+          timings - a dictionary of the seconds taken by each phase (download, ingest, index)
+
+        On download failure the exception has the feedback as an attribute.
+        """
         db_path = self._ingesters_db_path(in_path_or_url)
         if '://' in in_path_or_url:
             url, in_path, get = in_path_or_url, None, True
@@ -108,31 +163,70 @@ will download, ingest and index data from `dataselect-url` after POSTing
                 self._log.warn(('The URL provided is "%s" - this does not contain any ampersands.  ' +
                                 'You may have forgotten to quote the URL (and should expect failure).') % url)
         else:
-            url, in_path, get = self._dataselect_url, in_path_or_url, False
+            url, in_path, get = dataselect_url or self._dataselect_url, in_path_or_url, False
             if not os.path.exists(in_path):
                 raise Exception('Could not find file "%s"' % in_path)
-        if len(args) == 2:
-            out_path, delete_out = args[2], False
+        if out_path:
+            delete_out = False
         else:
             out_path, delete_out = unique_path(self._temp_dir, TMPDOWNLOAD, in_path_or_url), True
 
+        feedback, timings = {}, {}
         try:
-            if self._do_download(get, url, in_path, out_path):  # False when no data available
-                if self._ingest:
-                    Ingester(self._config).run([out_path], db_path=db_path)
-        except:
-            raise
-        else:
-            if self._delete_files:
-                # Remove empty log files to avoid clutter
-                log_path = self._config.log_path
-                if os.path.exists(log_path) and os.path.getsize(log_path) == 0:
-                    safe_unlink(log_path)
+            start = time()
+            feedback['start_epoch'] = start  # used to measure the time spent queued
+            try:
+                response = self._do_download(get, url, in_path, out_path)
+            except Exception as e:
+                # the status (if any) and time are used to adapt the number of downloads
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status:
+                    feedback['http_status'] = status
+                feedback['timings'] = {'download': time() - start}
+                e.feedback = feedback
+                raise
+            timings['download'] = time() - start
+            feedback['http_status'] = 200 if response else 204
+            if response:  # None when no data available
+                feedback['download_byte_count'] = os.path.getsize(response)
+                if self._ingest and not self._claim(in_path):
+                    self._log.info('Not ingesting %s (already claimed by another copy)' % in_path)
+                    feedback['duplicate'] = True
+                elif self._ingest:
+                    start = time()
+                    ingester = self._ingester()
+                    ingester.run([out_path], db_path=db_path)
+                    timings['index'] = ingester.index_time
+                    timings['ingest'] = time() - start - ingester.index_time
+                    feedback['sections'] = ingester.sections
+                    feedback['files'] = sorted(ingester.updated)
+            feedback['timings'] = timings
         finally:
             if self._delete_files:
                 if delete_out:
                     safe_unlink(out_path)
                 safe_unlink(db_path)
+        return feedback
+
+    def _claim(self, in_path):
+        # when downloads are hedged, two copies of a request may run at once, so the first
+        # to download claims the data (atomically, via a file) and the other is not ingested
+        if not (self._hedge and in_path):
+            return True
+        return create_exclusive(claim_path(in_path))
+
+    def _ingester(self):
+        # created on first use and then re-used, so that repeated downloads (in-process)
+        # don't repeat the command and leap second checks
+        if not self.__ingester:
+            self.__ingester = Ingester(self._config)
+        return self.__ingester
+
+    def _session(self):
+        # similarly, keep the connection alive between downloads
+        if not self.__session:
+            self.__session = http_session(self._http_retries)
+        return self.__session
 
     def _do_download(self, get, url, in_path, out_path):
         # previously we extracted the file name from the header, but the code
@@ -143,27 +237,60 @@ will download, ingest and index data from `dataselect-url` after POSTing
 
         if get:
             response, check_status = get_to_file(url, out_path,
-                                                 self._http_timeout, self._http_retries, self._log)
+                                                 self._http_timeout, self._http_retries, self._log,
+                                                 session=self._session())
             check_status()
         else:
             try:
                 response, check_status = post_to_file(url, in_path, out_path,
-                                                      self._http_timeout, self._http_retries, self._log)
+                                                      self._http_timeout, self._http_retries, self._log,
+                                                      session=self._session())
                 check_status()
             except Exception as e:
                 diagnose_error(self._log, str(e), in_path, out_path, copied=False)
                 raise
 
-        # write feedback, in JSON, to caller on stdout with download byte count
-        if response and os.path.isfile(response):
-            feedback = {}
-            feedback['download_byte_count'] = os.path.getsize(response)
-
-            if feedback['download_byte_count']:
-                sys.stdout.write(json.dumps(feedback))
-
         return response
 
     def _ingesters_db_path(self, url):
         name = uniqueish('rover_ingester', url)
         return unique_filename(os.path.join(self._temp_dir, name))
+
+
+class DownloadWorker:
+    """
+    The (undocumented) 'rover worker' command, started by retrieve when the
+    download-engine option is "pool".  Reads jobs from stdin and writes results
+    to stdout, one JSON object per line, until stdin is closed.
+
+    A job has the arguments for a download (or, for tests, a failure message).
+    The result has the return code and any feedback.  A single Downloader is
+    used for all jobs, so the database connection, HTTP session, etc, are
+    re-used.
+    """
+
+    def __init__(self, config):
+        self._log = config.log
+        self._downloader = Downloader(config)
+
+    def run(self, args):
+        # replies go to the original stdout; anything else written there (eg by
+        # mseedindex, which inherits the file descriptor) goes to stderr instead
+        sys.stdout.flush()
+        replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        for line in iter(sys.stdin.readline, ''):
+            if line.strip():
+                replies.write(json.dumps(self._run_job(json.loads(line))) + '\n')
+                replies.flush()
+        self._log.debug('No more jobs')
+
+    def _run_job(self, job):
+        try:
+            if 'fail' in job:
+                raise Exception(job['fail'])
+            return {'returncode': 0,
+                    'feedback': self._downloader.download(*job['args'], dataselect_url=job.get('dataselect_url'))}
+        except Exception as e:
+            self._log.error('Download failed: %s' % e)
+            return {'returncode': ERROR_CODE, 'feedback': getattr(e, 'feedback', None)}
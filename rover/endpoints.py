@@ -0,0 +1,187 @@
+
+from threading import Thread
+from time import time
+
+from .utils import http_session
+
+"""
+Support for several equivalent dataselect services (mirrors, caching proxies) - spreading
+downloads across them, limiting the downloads from each, and avoiding those that fail.
+"""
+
+
+# an endpoint is marked down after this many consecutive failures
+MAX_FAILURES = 3
+# and is then avoided for this many seconds (doubling each time a health check fails)
+BACKOFF = 10
+MAX_BACKOFF = 600
+# the timeout (s) for a health check
+HEALTH_TIMEOUT = 10
+# the weight of the latest download in the (exponentially weighted) mean latency
+LATENCY_WEIGHT = 0.2
+
+
+def split_urls(urls):
+    """
+    The dataselect-url option can list several (comma-separated) equivalent services.
+    """
+    return [url.strip() for url in urls.split(',') if url.strip()]
+
+
+def version_url(url):
+    """
+    The URL used to check an endpoint (FDSN services have a version method alongside query).
+    """
+    if url.endswith('/query'):
+        return url[:-len('query')] + 'version'
+    return url
+
+
+def is_endpoint_failure(returncode, feedback):
+    """
+    Did the download fail because of the service (rather than the request)?
+    """
+    status = (feedback or {}).get('http_status')
+    return bool(returncode) and (status is None or status == 429 or status >= 500)
+
+
+class Endpoint:
+    """
+    The state of a single dataselect service.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.running = 0
+        self.latency = None  # mean seconds per download (None until one succeeds)
+        self.failures = 0  # consecutive
+        self.down_until = None  # epoch when a down endpoint is next checked
+        self.backoff = BACKOFF
+        self.checking = None  # thread running a health check
+        self.check_result = None  # set by the thread
+
+    def expected(self):
+        # the expected time for a new download to complete, if queued behind those running
+        # (endpoints with no measured latency are preferred, so that all are tried)
+        return (self.running + 1) * (self.latency or 0), self.running
+
+    def __str__(self):
+        return self.url
+
+
+class Endpoints:
+    """
+    Choose the dataselect service for each download.
+
+    Downloads go to the endpoint with the least expected delay (the mean latency
+    times the number of downloads already running there), subject to a limit
+    on the downloads running at each endpoint.
+
+    When there is more than one endpoint, one that fails repeatedly (no response,
+    or a server error) is marked down and avoided until a health check (a request
+    for the service version) succeeds.  Health checks run in the background (so
+    never delay the choice of endpoint) and the result is used by the next
+    select().  If all endpoints are down they are used anyway (so downloads fail
+    and are retried as usual).
+    """
+
+    def __init__(self, log, urls, max_workers=0, check=None):
+        self._log = log
+        self._endpoints = [Endpoint(url) for url in split_urls(urls)]
+        if not self._endpoints:
+            raise Exception('No dataselect URL')
+        self._max_workers = max_workers
+        self._check = check or self._check_version
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def __iter__(self):
+        return iter(self._endpoints)
+
+    def _has_space(self, endpoint):
+        return not self._max_workers or endpoint.running < self._max_workers
+
+    def has_space(self):
+        """
+        Can any endpoint take another download?
+        """
+        return any(self._has_space(endpoint) for endpoint in self._endpoints)
+
+    def has_alternative(self, tried):
+        """
+        Is there an endpoint (that is up) with a URL that is not in tried?
+        """
+        return any(endpoint.url not in tried and endpoint.down_until is None for endpoint in self._endpoints)
+
+    def select(self, avoid=()):
+        """
+        The endpoint for the next download (avoiding the given URLs if possible), or None if all are busy.
+        """
+        candidates = [endpoint for endpoint in self._endpoints if self._has_space(endpoint)]
+        up = [endpoint for endpoint in candidates if self._is_up(endpoint)]
+        preferred = [endpoint for endpoint in up if endpoint.url not in avoid] or up or \
+            sorted(candidates, key=lambda endpoint: endpoint.down_until)[:1]
+        if not preferred:
+            return None
+        endpoint = min(preferred, key=lambda endpoint: endpoint.expected())
+        endpoint.running += 1
+        return endpoint
+
+    def finished(self, endpoint, returncode, feedback, seconds):
+        """
+        Record the result of a download from the endpoint.
+        """
+        endpoint.running -= 1
+        timings = (feedback or {}).get('timings') or {}
+        if not returncode:
+            seconds = timings.get('download', seconds)
+            endpoint.latency = seconds if endpoint.latency is None else \
+                LATENCY_WEIGHT * seconds + (1 - LATENCY_WEIGHT) * endpoint.latency
+            endpoint.failures = 0
+        elif is_endpoint_failure(returncode, feedback):
+            endpoint.failures += 1
+            if len(self._endpoints) > 1 and endpoint.failures >= MAX_FAILURES and endpoint.down_until is None:
+                self._log.warn('Dataselect service %s failed %d times - avoiding for %ds' %
+                               (endpoint, endpoint.failures, endpoint.backoff))
+                endpoint.down_until = time() + endpoint.backoff
+
+    def release(self, endpoint):
+        """
+        Release the endpoint without recording a result (eg for a cancelled download).
+        """
+        endpoint.running -= 1
+
+    def _is_up(self, endpoint):
+        if endpoint.down_until is None:
+            return True
+        if endpoint.checking:
+            if endpoint.checking.is_alive():
+                return False
+            endpoint.checking = None
+            if endpoint.check_result:
+                self._log.info('Dataselect service %s is available again' % endpoint)
+                endpoint.down_until, endpoint.failures, endpoint.backoff = None, 0, BACKOFF
+                return True
+            endpoint.backoff = min(MAX_BACKOFF, 2 * endpoint.backoff)
+            self._log.warn('Dataselect service %s is still unavailable - avoiding for %ds' %
+                           (endpoint, endpoint.backoff))
+            endpoint.down_until = time() + endpoint.backoff
+            return False
+        if time() < endpoint.down_until:
+            return False
+        endpoint.check_result = None
+        endpoint.checking = Thread(target=self._run_check, args=(endpoint,))
+        endpoint.checking.daemon = True
+        endpoint.checking.start()
+        return False
+
+    def _run_check(self, endpoint):
+        endpoint.check_result = self._check(endpoint)
+
+    def _check_version(self, endpoint):
+        try:
+            return http_session(0).get(version_url(endpoint.url), timeout=HEALTH_TIMEOUT).status_code == 200
+        except Exception as e:
+            self._log.debug('Health check for %s failed: %s' % (endpoint, e))
+            return False
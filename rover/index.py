@@ -7,11 +7,12 @@ from .config import timeseries_db
 from .args import MSEEDINDEXCMD, LEAP, LEAPEXPIRE, LEAPFILE, LEAPURL, DEV, VERBOSITY, MSEEDINDEXWORKERS, HTTPTIMEOUT, \
     HTTPRETRIES, FORCECMD, TIMESPANINC
 from .args import TIMESPANTOL
-from .coverage import MultipleSNCLBuilder
+from .coverage import MultipleSNCLBuilder, parse_timespans
 from .help import HelpFormatter
+from .packed import PACKED_TABLE, create_packed_table, pack_timespans, select_timespans
 from .scan import ModifiedScanner, DirectoryScanner
 from .sqlite import SqliteSupport
-from .utils import format_epoch, windows, tidy_timestamp
+from .utils import format_epoch, tidy_timestamp, mseedindex_command
 from .utils import check_leap, check_cmd, STATION, NETWORK, CHANNEL, LOCATION
 from .workers import Workers
 
@@ -33,7 +34,9 @@ class Indexer(ModifiedScanner, DirectoryScanner):
     rover index (file|dir)+
 
 Indexes files, adds or changes entries in the tsindex table stored in the
-miniSEED database.
+miniSEED database.  The timespans of new entries are also stored in a
+pre-parsed (binary) form, so that later comparisons with availability are
+faster.
 
 When no argument is given, all modified files in the repository are processed.
 The `--all` flag forces all files to be processed. If a path argument
@@ -74,6 +77,7 @@ will index the entire repository.
                                      config.arg(LEAPURL), config.arg(HTTPTIMEOUT), config.arg(HTTPRETRIES), config.log)
         self._verbose = config.arg(DEV) and config.arg(VERBOSITY) == 5
         self._workers = Workers(config, config.arg(MSEEDINDEXWORKERS))
+        self._indexed = []
 
     def run(self, args):
         """
@@ -90,17 +94,37 @@ will index the entire repository.
         Run mseedindex asynchronously in a worker.
         """
         self._log.info('Indexing %s' % path)
-        if windows():
-            self._workers.execute('set LIBMSEED_LEAPSECOND_FILE=%s && %s %s -sqlite %s %s'
-                                  % (self._leap_file, self._mseed_cmd, '-v -v' if self._verbose  else '',
-                                     self._timeseries_db, path))
-        else:
-            self._workers.execute('LIBMSEED_LEAPSECOND_FILE=%s %s %s -sqlite %s %s'
-                                  % (self._leap_file, self._mseed_cmd, '-v -v' if self._verbose  else '',
-                                     self._timeseries_db, path))
+        verbose = ['-v', '-v'] if self._verbose else []
+        command, env = mseedindex_command(self._mseed_cmd, self._leap_file,
+                                          *(verbose + ['-sqlite', self._timeseries_db, path]))
+        self._workers.execute(command, env=env)
+        self._indexed.append(path)
 
     def done(self):
         self._workers.wait_for_all()
+        indexed, self._indexed = self._indexed, []
+        self._pack_timespans(indexed)
+
+    def _pack_timespans(self, paths):
+        # store packed timespans for the entries of the files just indexed.  each file
+        # is packed by a single statement (so atomic), parsing via a sqlite function,
+        # and OR IGNORE because a concurrent process may have packed the same entries
+        if not paths:
+            return
+        if not self.fetchsingle('''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tsindex' '''):
+            self._log.debug('No index - check rover.config')
+            return
+        create_packed_table(self)
+        self._db.create_function('rover_pack_timespans', 1,
+                                 lambda timespans: pack_timespans(parse_timespans(timespans)))
+        with self.cursor() as c:
+            for path in paths:
+                c.execute('''INSERT OR IGNORE INTO %s (id, packed)
+                               SELECT t.rowid,
+                                      rover_pack_timespans(coalesce(t.timespans, '<' || t.starttime || ' ' || t.endtime || '>'))
+                                 FROM tsindex t LEFT JOIN %s p ON p.id = t.rowid
+                                 WHERE t.filename = ? AND p.id IS NULL''' % (PACKED_TABLE, PACKED_TABLE), (path,))
+        self._log.debug('Packed timespans for %d indexed files' % len(paths))
 
 
 START = 'start'
@@ -300,15 +324,15 @@ printed to stdout.
         self._multiple_constraints[found].append(value)
 
     def _build_query(self):
-        sql, params = 'select ', []
+        sql, params, table = 'select ', [], 'tsindex t'
         if self._flags[COUNT]:
             sql += 'count(*) '
         else:
-            sql += ('''network, station, location, channel,
-                       coalesce(timespans,'<' || starttime || ' ' || endtime || '>'), samplerate ''')
+            columns, table = select_timespans(self)
+            sql += 't.network, t.station, t.location, t.channel, %s, t.samplerate ' % columns
             if not self._flags[JOIN_QSR]:
-                sql += ', quality '
-        sql += 'from tsindex '
+                sql += ', t.quality '
+        sql += 'from %s ' % table
         constrained = False
 
         def conjunction(sql, constrained):
@@ -328,17 +352,17 @@ printed to stdout.
                     repeated = True
                 else:
                     sql += 'or '
-                sql += '%s like ? ' % name
+                sql += 't.%s like ? ' % name
                 params.append(self._wildchars(value))
             if repeated:
                 sql += ') '
         if self._single_constraints[START]:
             sql, constrained = conjunction(sql, constrained)
-            sql += 'endtime > ?'
+            sql += 't.endtime > ?'
             params.append(self._single_constraints[START])
         if self._single_constraints[END]:
             sql, constrained = conjunction(sql, constrained)
-            sql += 'starttime < ?'
+            sql += 't.starttime < ?'
             params.append(self._single_constraints[END])
         return sql, tuple(params)
 
@@ -357,11 +381,11 @@ printed to stdout.
 
         def callback(row):
             if self._flags[JOIN_QSR]:
-                n, s, l, c, ts, r = row
-                builder.add_timespans('%s_%s_%s_%s' % (n, s, l, c), ts, r)
+                n, s, l, c, ts, p, r = row
+                builder.add_timespans('%s_%s_%s_%s' % (n, s, l, c), ts, r, packed=p)
             else:
-                n, s, l, c, ts, r, q = row
-                builder.add_timespans('%s_%s_%s_%s_%s (%g Hz)' % (n, s, l, c, q, r), ts, r)
+                n, s, l, c, ts, p, r, q = row
+                builder.add_timespans('%s_%s_%s_%s_%s (%g Hz)' % (n, s, l, c, q, r), ts, r, packed=p)
 
         self.foreachrow(sql, params, callback)
         print()
@@ -3,6 +3,8 @@ from os import getpid
 from os.path import exists, join
 from re import match
 from shutil import copyfile
+from threading import Lock
+from time import time
 
 from .args import MSEEDINDEXCMD, LEAP, LEAPEXPIRE, LEAPFILE, LEAPURL, \
     DATADIR, INDEX, HTTPTIMEOUT, HTTPRETRIES, OUTPUT_FORMAT
@@ -11,7 +13,7 @@ from .lock import DatabaseBasedLockFactory, MSEED
 from .scan import DirectoryScanner
 from .sqlite import SqliteSupport, SqliteContext
 from .utils import run, check_cmd, check_leap, create_parents, safe_unlink, \
-    windows, atomic_move, hash
+    atomic_move, hash, mseedindex_command
 
 """
 The 'rover ingest' command - copy downloaded data into the repository (and then call index).
@@ -22,6 +24,10 @@ The 'rover ingest' command - copy downloaded data into the repository (and then
 # when run as a worker from (multiple) retriever(s) a table is supplied.
 TMPFILE = 'rover_tmp_ingest'
 
+# the database lock below is per-process (the PID is unique in the lock table), so
+# threads within a single process (the in-process download engine) also need this.
+THREAD_LOCK = Lock()
+
 
 class Ingester(SqliteSupport, DirectoryScanner):
     """
@@ -74,6 +80,10 @@ will add all the data in the given file to the repository.
         self._config = config
         self._log = config.log
         self._lock_factory = DatabaseBasedLockFactory(config, MSEED)
+        self.__indexer = None
+        self.index_time = 0  # seconds spent indexing during the last run
+        self.sections = 0  # number of (mseedindex) sections ingested during the last run
+        self.updated = set()  # day files changed during the last run
 
     def run(self, args, db_path=TMPFILE):
         """
@@ -83,6 +93,9 @@ will add all the data in the given file to the repository.
         To avoid database contention we can run mseedindex into a unique database path.
         """
         self._db_path = db_path
+        self.index_time = 0
+        self.sections = 0
+        self.updated = set()
         if not args:
             raise Exception('No paths provided')
         self.scan_dirs_and_files(args)
@@ -97,25 +110,31 @@ will add all the data in the given file to the repository.
             safe_unlink(self._db_path)
         updated = set()
         try:
-            if windows():
-                run('set LIBMSEED_LEAPSECOND_FILE=%s && %s -sqlite %s %s'
-                    % (self._leap_file, self._mseed_cmd, self._db_path, temp_file), self._log)
-            else:
-                run('LIBMSEED_LEAPSECOND_FILE=%s %s -sqlite %s %s'
-                    % (self._leap_file, self._mseed_cmd, self._db_path, temp_file), self._log)
+            command, env = mseedindex_command(self._mseed_cmd, self._leap_file, '-sqlite', self._db_path, temp_file)
+            run(command, self._log, env=env)
             with SqliteContext(self._db_path, self._log) as db:
                 rows = db.fetchall('''SELECT network, station, starttime, endtime, byteoffset, bytes
                                   FROM tsindex ORDER BY byteoffset''')
                 updated.update(self._copy_all_rows(temp_file, rows))
+                self.sections += len(rows)
+                self.updated.update(updated)
         finally:
             safe_unlink(self._db_path)
         if self._index:
-            Indexer(self._config).run(updated)
+            start = time()
+            self._indexer().run(updated)
+            self.index_time += time() - start
             if self._config.arg(OUTPUT_FORMAT).upper() == "ASDF":
                 from .asdf import ASDFHandler
                 # output as ASDF format
                 ASDFHandler(self._config).load_miniseed(updated)
 
+    def _indexer(self):
+        # re-used across calls when the ingester itself is re-used (in-process downloads)
+        if not self.__indexer:
+            self.__indexer = Indexer(self._config)
+        return self.__indexer
+
     def _copy_all_rows(self, temp_file, rows):
         self._log.info('Ingesting %s' % temp_file)
         updated = set()
@@ -152,8 +171,8 @@ will add all the data in the given file to the repository.
     def _append_data(self, data, mseed_file):
         # here we are locking for this process, so we can set the PID directly.
         # there is no possibility for deadlock because we are single threaded
-        # and release on exit.
-        with self._lock_factory.lock(mseed_file, pid=getpid()):
+        # (or serialized by THREAD_LOCK) and release on exit.
+        with THREAD_LOCK, self._lock_factory.lock(mseed_file, pid=getpid()):
             # to avoid leaving broken files on unexpected exit, use a temp
             # file and then move into position (move should be atomic)
             tmp = mseed_file + '.tmp'
@@ -1,25 +1,69 @@
 import datetime as dt
+import json
 from collections import deque
+from hashlib import sha1
+from heapq import heapify, heappop
+from math import ceil
+from queue import Queue, Empty
 from random import randint
 from sqlite3 import OperationalError
-from time import time, sleep
+from threading import Thread
+from time import time
 
 from .args import mm, FORCEFAILURES, DELETEFILES, TEMPDIR, HTTPTIMEOUT, HTTPRETRIES, TIMESPANTOL, DOWNLOADRETRIES, \
     DOWNLOADWORKERS, ROVERCMD, MSEEDINDEXCMD, LOGUNIQUE, LOGVERBOSITY, VERBOSITY, DOWNLOAD, DEV, WEB, SORTINPYTHON, \
-    TIMESPANINC, ABORT_CODE
-from .config import write_config
-from .coverage import Coverage, SingleSNCLBuilder
-from .download import DEFAULT_NAME, TMPREQUEST, TMPRESPONSE
-from .sqlite import SqliteSupport
-from .utils import utc, EPOCH_UTC, PushBackIterator, format_epoch, safe_unlink, unique_path, post_to_file, \
-    sort_file_inplace, parse_epoch, check_cmd, run, windows, diagnose_error, format_year_day_epoch
-from .workers import Workers
+    TIMESPANINC, ABORT_CODE, DOWNLOADENGINE, WORKER, CHUNKSAMPLES, DOWNLOADADAPTIVE, DOWNLOADWORKERSMIN, \
+    CHUNKORDER, RESUME, BULKDIFF, VERIFYFULLEVERY, DOWNLOADHEDGE, ERROR_CODE, DATASELECTURL, DATASELECTWORKERS, \
+    AVAILABILITYSHARD, AVAILABILITYWORKERS, COVERAGEENGINE
+from .cache import AvailabilityCache
+from .config import write_config, timeseries_db, metrics_path, stats_path
+from .coverage import SingleSNCLBuilder, nominal_samplerate, coverage_class
+from .endpoints import Endpoints, is_endpoint_failure, split_urls
+from .metrics import Metrics
+from .download import DEFAULT_NAME, TMPREQUEST, TMPRESPONSE, HEDGE_SUFFIX, Downloader, claim_path
+from .packed import select_timespans
+from .sqlite import SqliteSupport, SqliteDb, NoResult, init_db
+from .utils import utc, EPOCH_UTC, PushBackIterator, format_epoch, safe_unlink, unique_path, \
+    SortedFile, parse_epoch, parse_epochs, check_cmd, run, windows, diagnose_error, format_year_day_epoch, write_json
+from .workers import Workers, ThreadWorkers, PoolWorkers, AdaptiveLimit, SUBPROCESS, THREAD, POOL
 
 """
 The core logic for scheduling multiple downloads.  Called by both the daemon and `rover retrieve`.
 """
 
 
+# values for the chunk-order option
+OLDEST, NEWEST, LARGEST, SMALLEST = 'oldest', 'newest', 'largest', 'smallest'
+ORDERS = (OLDEST, NEWEST, LARGEST, SMALLEST)
+
+# chunk states in the journal
+RUNNING, DONE, FAILED, SPLIT, RETRIED = 'running', 'done', 'failed', 'split', 'retried'
+
+# a failed download is split in half and retried, up to this many times
+MAX_SPLIT_DEPTH = 4
+# but not to less than this many seconds of data
+MIN_SPLIT_SECONDS = 60
+
+# the (estimated samples) credited to each source, multiplied by its weight, on each round of the fair-share scheduler
+QUANTUM = 1000000
+
+# metrics are published (for rover web) at most this often (seconds)
+METRICS_PERIOD = 5
+# and progress at most this often
+STATS_PERIOD = 1
+
+# while downloads are running, compare availability with the index for this many coverages ahead
+PLAN_AHEAD = 100
+
+# request lines with a wildcard network or station are queried for availability in windows of this many days
+SHARD_DAYS = 365
+
+# downloads are hedged (see download-hedge) using the latencies of this many recent downloads
+HEDGE_SAMPLES = 100
+# but only once there are at least this many
+HEDGE_MIN_SAMPLES = 10
+
+
 class ManagerException(Exception):
     """
     Separate class so we can avoid sending additional emails when manager fails.
@@ -40,24 +84,37 @@ class ProgressStatistics:
 
     def __init__(self):
         self.__prev_net_sta = [None, None]
+        self.__prev_estimated_net_sta = [None, None]
         self.stations = [0, 0]
         self.seconds = [0, 0]
         self.chunks = [0, 0]
 
+    def estimate(self, n_stations, seconds):
+        # totals from the availability, before it is compared with the index.  these are
+        # replaced, coverage by coverage, with the data actually required (see remove_estimate)
+        self.stations[1] += n_stations
+        self.seconds[1] += seconds
+
+    def remove_estimate(self, availability):
+        net_sta = availability.sncl.split('_')[0:2]
+        if net_sta != self.__prev_estimated_net_sta:
+            self.stations[1] -= 1
+            self.__prev_estimated_net_sta = net_sta
+        self.seconds[1] -= availability.duration()
+
     def add_coverage(self, coverage):
         net_sta = coverage.sncl.split('_')[0:2]
         if net_sta != self.__prev_net_sta:
             self.stations[1] += 1
             self.__prev_net_sta = net_sta
         # but seconds are counted either way
-        for start, end in coverage.timespans:
-            self.seconds[1] += (end - start)
+        self.seconds[1] += coverage.duration()
 
     def pop_timespan(self, start, end):
         self.seconds[0] += (end - start)
 
-    def add_chunks(self, n):
-        self.stations[0] += 1  # a set of chunks is for a single station
+    def add_chunks(self, n, n_stations):
+        self.stations[0] += n_stations  # a set of chunks is for one or more (packed) stations
         # the day count isn't global - it's per sncl (coverage) - so resets
         self.chunks[0] = 0
         self.chunks[1] = n
@@ -65,6 +122,20 @@ class ProgressStatistics:
     def pop_chunk(self):
         self.chunks[0] += 1
 
+    def add_windows(self, n):
+        self.chunks[1] += n  # a day was split
+
+    def add_chunk(self, data):
+        # a chunk retried directly (stations are not counted)
+        self.chunks[1] += 1
+        for (sncl, start, end) in data:
+            self.seconds[1] += (end - start)
+
+    def pop_data(self, data):
+        self.pop_chunk()
+        for (sncl, start, end) in data:
+            self.pop_timespan(start, end)
+
     def __str__(self):
         return '(N_S %d/%d; day %d/%d)' % (self.stations[0], self.stations[1], self.chunks[0], self.chunks[1])
 
@@ -92,19 +163,43 @@ class Chunks:
     be efficient, so now we collect them here.
     This is a *collection* of chunks because a single chunk is only for one calendar day -
     we may assemble multiple days when moving from the coverages to chunks.
+
+    A chunk always contains all the data for a station (on that day).  If max_samples is
+    non-zero, further stations are packed into the same chunks, as long as the estimated
+    number of samples in each chunk remains within that limit.  This reduces the number of
+    requests for networks with many low-rate stations.  In the other direction, a day for
+    a single station that exceeds the limit is split into equal sub-day windows.
+
+    We cannot merge data across days because ingest requires that each block of data
+    is within a single day.
+
+    Chunks are downloaded in the given order (see ORDERS): oldest or newest day first, or
+    largest or smallest (estimated samples) first.  Within this collection the heap gives
+    that order; across stations, Retrieval uses window_key() to choose which of the planned
+    coverages (up to PLAN_AHEAD) start the next collection.
     """
 
-    def __init__(self, temp_dir):
-        self.__temp_dir = temp_dir
+    def __init__(self, log, max_samples=0, order=OLDEST):
+        if order not in ORDERS:
+            raise Exception('Unknown chunk order "%s" (choose from %s)' % (order, ', '.join(ORDERS)))
+        self._log = log
+        self.__max_samples = max_samples
+        self.__order = order
+        self.__heap = None  # (key, end of day epoch) built on first pop
+        self.__windows = deque()  # (description, data) ready to download
         self.__chunks = {}   # list of (sncl, start, end) indexed by end of day epoch
-        self.__network = None
-        self.__station = None
+        self.__samples = {}  # estimated number of samples indexed by end of day epoch
+        self.__stations = []  # N_S in the order added
 
     def __bool__(self):
-        return bool(self.__chunks)
+        return bool(self.__chunks or self.__windows)
 
     def __len__(self):
-        return len(self.__chunks)
+        return len(self.__chunks) + len(self.__windows)
+
+    @property
+    def n_stations(self):
+        return len(self.__stations)
 
     @staticmethod
     def _end_of_day(epoch):
@@ -114,24 +209,47 @@ class Chunks:
         left = right - 0.000001
         return left, right
 
-    def _append(self, right, sncl, start, end):
+    def _append(self, right, sncl, start, end, samples):
+        self.__heap = None
         if right not in self.__chunks:
             self.__chunks[right] = []
+            self.__samples[right] = 0
         self.__chunks[right].append((sncl, start, end))
+        self.__samples[right] += samples
 
-    def _set_ns(self, sncl):
-        nslc = sncl.split('_')
-        self.__network = nslc[0]
-        self.__station = nslc[1]
+    @staticmethod
+    def _net_sta(sncl):
+        return '_'.join(sncl.split('_')[0:2])
 
-    def sncl_ok(self, sncl):
-        nslc = sncl.split('_')
-        return not self.__chunks or (nslc[0] == self.__network and nslc[1] == self.__station)
+    def accepts(self, coverage):
+        """
+        Can the coverage be added to these chunks?
+        """
+        if not self.__chunks or self._net_sta(coverage.sncl) == self.__stations[-1]:
+            return True
+        if not self.__max_samples:
+            return False
+        samples = {}
+        for right, sncl, start, end, n in self._split(coverage):
+            samples[right] = samples.get(right, 0) + n
+        for right in samples:
+            if self.__samples.get(right, 0) + samples[right] > self.__max_samples:
+                return False
+        return True
 
     def add_coverage(self, coverage):
+        net_sta = self._net_sta(coverage.sncl)
+        if not self.__stations or net_sta != self.__stations[-1]:
+            self.__stations.append(net_sta)
+        for right, sncl, start, end, samples in self._split(coverage):
+            self._append(right, sncl, start, end, samples)
+
+    def _split(self, coverage):
+        """
+        Generate (end of day, sncl, start, end, estimated samples) for each day in the coverage.
+        """
         sncl, timespans = coverage.sncl, PushBackIterator(iter(coverage.timespans))
-        if not self.__chunks:
-            self._set_ns(sncl)
+        samplerate = coverage.estimated_samplerate()
 
         # Determine sampling period (interval)
         # On initial download we do not know the sampling rate/period, but if data exists locally we do
@@ -151,7 +269,7 @@ class Chunks:
                 if sampleperiod and sampleperiod > 0 and (left - start) < sampleperiod:
                     continue
                 else:
-                    self._append(right, sncl, start, end)
+                    yield right, sncl, start, end, (end - start) * samplerate
 
             # Otherwise, add the range beyond the current day to the timespans and
             # append the range that fits in the first day
@@ -163,25 +281,404 @@ class Chunks:
                 if sampleperiod and sampleperiod > 0 and (left - start) < sampleperiod:
                     continue
                 else:
-                    self._append(right, sncl, start, left)
-
+                    yield right, sncl, start, left, (left - start) * samplerate
 
     @staticmethod
     def format_sncl(sncl):
         return ' '.join(code if code else '--' for code in sncl.split('_'))
 
     def pop(self, progress):
-        right = next(iter(sorted(self.__chunks.keys())))
-        description = '%s_%s %s' % (self.__network, self.__station, format_year_day_epoch(right-24*3600))
-        data = self.__chunks[right]
-        path = unique_path(self.__temp_dir, 'rover_chunk', description)
-        with open(path, 'w') as out:
-            for (sncl, start, end) in data:
-                progress.pop_timespan(start, end)
-                print('%s %s %s' % (self.format_sncl(sncl), format_epoch(start), format_epoch(end)), file=out)
-        del self.__chunks[right]
+        """
+        Returns (description, data) for the next chunk, where data is a list of (sncl, start, end).
+        """
+        if not self.__windows:
+            self._next_day(progress)
+        description, data = self.__windows.popleft()
+        for (sncl, start, end) in data:
+            progress.pop_timespan(start, end)
         progress.pop_chunk()
-        return description, path
+        return description, data
+
+    def _key(self, right, samples):
+        if self.__order == NEWEST:
+            return -right,
+        elif self.__order == LARGEST:
+            return -samples, right
+        elif self.__order == SMALLEST:
+            return samples, right
+        else:
+            return right,
+
+    def window_key(self, coverages):
+        """
+        The key (smallest first) of the first chunk that the coverages (for one station) would
+        give, so that stations can be ordered in the same way as the chunks for each station.
+        """
+        samples = {}
+        for coverage in coverages:
+            for right, sncl, start, end, n in self._split(coverage):
+                samples[right] = samples.get(right, 0) + n
+        return min([self._key(right, samples[right]) for right in samples] or [()])
+
+    def _next_day(self, progress):
+        # chunks are not added once we start popping, so the heap is built once (in linear time)
+        # and then each pop is O(log n)
+        if self.__heap is None:
+            self.__heap = [(self._key(right, self.__samples[right]), right) for right in self.__chunks]
+            heapify(self.__heap)
+        key, right = heappop(self.__heap)
+        data, samples = self.__chunks[right], self.__samples[right]
+        del self.__chunks[right]
+        del self.__samples[right]
+        stations = set(self._net_sta(sncl) for (sncl, start, end) in data)
+        if len(stations) > 1:
+            description = '%s (+%d stations) %s' % (self._net_sta(data[0][0]), len(stations) - 1,
+                                                    format_year_day_epoch(right-24*3600))
+        else:
+            description = '%s %s' % (self._net_sta(data[0][0]), format_year_day_epoch(right-24*3600))
+        # a single station with too much data for one request is split into sub-day windows
+        n = int(ceil(samples / self.__max_samples)) if self.__max_samples else 1
+        if n > 1:
+            self._log.debug('Splitting %s into %d windows (estimated %d samples)' % (description, n, samples))
+            progress.add_windows(n - 1)
+            width = 24 * 3600.0 / n
+            for i in range(n):
+                left, right_i = right - 24 * 3600 + i * width, right - 24 * 3600 + (i + 1) * width
+                window = self.clip(data, left, right_i - 0.000001 if i + 1 < n else right)
+                if window:
+                    self.__windows.append(('%s (%d/%d)' % (description, i + 1, n), window))
+                else:
+                    progress.pop_chunk()  # nothing in this window
+        else:
+            self.__windows.append((description, data))
+
+    @staticmethod
+    def estimate_samples(data):
+        """
+        The estimated number of samples in the (sncl, start, end) entries (a proxy for size).
+        """
+        return sum((end - start) * nominal_samplerate(sncl) for (sncl, start, end) in data)
+
+    @staticmethod
+    def clip(data, left, right):
+        """
+        The (sncl, start, end) entries in data, restricted to the given interval.
+        """
+        clipped = []
+        for (sncl, start, end) in data:
+            start, end = max(start, left), min(end, right)
+            if start < end:
+                clipped.append((sncl, start, end))
+        return clipped
+
+    @staticmethod
+    def halve(data, min_seconds=MIN_SPLIT_SECONDS):
+        """
+        Split data into two parts (by entries, or by time for a single entry), for
+        retrying a failed download.  Returns None if the data cannot be split further.
+        """
+        if len(data) > 1:
+            middle = len(data) // 2
+            return data[:middle], data[middle:]
+        sncl, start, end = data[0]
+        if end - start < 2 * min_seconds:
+            return None
+        middle = start + (end - start) / 2.0
+        return [(sncl, start, middle - 0.000001)], [(sncl, middle, end)]
+
+
+class ChunkJournal(SqliteSupport):
+    """
+    A record, in the database, of each chunk downloaded for a source, and the outcome.
+
+    This lets a retry re-download only the chunks that failed, rather than repeat the
+    availability request and the comparison with the index.
+
+    The plan (the coverages still to download after comparing availability with the
+    index) is also stored, so that an interrupted retrieval can be resumed: the plan,
+    less the chunks that completed, is what remains.  Since planning continues during
+    the downloads, the last SNCL compared is also stored, so that an incomplete plan
+    can be resumed by comparing only the SNCLs that follow.
+    """
+
+    def __init__(self, config, submission):
+        super().__init__(config)
+        self._log = config.log
+        self._submission = submission
+        self._timespan_tol = config.arg(TIMESPANTOL)
+        self._timespan_inc = config.arg(TIMESPANINC)
+        self._coverage_class = coverage_class(config.arg(COVERAGEENGINE))  # as used by Source
+        self._create_chunks_table()
+        self._create_plan_tables()
+        self._create_verifications_table()
+
+    def _create_plan_tables(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_plans (
+                          submission text primary key,
+                          request_hash text not null,
+                          n_retries int not null,
+                          complete int not null default 0,
+                          creation_epoch int default (cast(strftime('%s', 'now') AS int)),
+                          planned_sncl text default NULL
+                        )''')
+        columns = [row[1] for row in self.fetchall('PRAGMA table_info(rover_plans)')]
+        if 'planned_sncl' not in columns:
+            self.execute('ALTER TABLE rover_plans ADD COLUMN planned_sncl text default NULL')
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_plan_coverages (
+                          id integer primary key autoincrement,
+                          submission text not null,
+                          sncl text not null,
+                          samplerate float,
+                          timespans text not null
+                        )''')
+
+    def start_plan(self, request_hash, n_retries):
+        """
+        Replace any plan with a new, empty plan (and discard the record of chunks).
+        """
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            self._db.execute('DELETE FROM rover_plans WHERE submission = ?', (self._submission,))
+            self._db.execute('DELETE FROM rover_plan_coverages WHERE submission = ?', (self._submission,))
+            self._db.execute('DELETE FROM rover_chunks WHERE submission = ?', (self._submission,))
+            self._db.execute('INSERT INTO rover_plans (submission, request_hash, n_retries) VALUES (?, ?, ?)',
+                             (self._submission, request_hash, n_retries))
+
+    def extend_plan(self, coverages, planned_sncl=None):
+        """
+        Add coverages to the plan, and (if given) the last SNCL compared with the index.
+        """
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            for coverage in coverages:
+                self._db.execute('''INSERT INTO rover_plan_coverages (submission, sncl, samplerate, timespans)
+                                    VALUES (?, ?, ?, ?)''',
+                                 (self._submission, coverage.sncl, coverage.samplerate,
+                                  json.dumps(coverage.timespans)))
+            if planned_sncl is not None:
+                self._db.execute('UPDATE rover_plans SET planned_sncl = ? WHERE submission = ?',
+                                 (planned_sncl, self._submission))
+
+    def complete_plan(self):
+        """
+        Mark the plan as complete (only complete plans can be resumed).
+        """
+        self.execute('UPDATE rover_plans SET complete = 1 WHERE submission = ?', (self._submission,))
+
+    def save_plan(self, request_hash, n_retries, coverages, planned_sncl=None):
+        """
+        Replace any plan with the given coverages.  If planned_sncl is given the plan is
+        incomplete (planned up to and including that SNCL), otherwise it is complete.
+        """
+        self.start_plan(request_hash, n_retries)
+        self.extend_plan(coverages, planned_sncl)
+        if planned_sncl is None:
+            self.complete_plan()
+
+    def load_plan(self, request_hash):
+        """
+        Return (n_retries, coverages, planned_sncl) for the saved plan, or None if there is no
+        plan for the request.  planned_sncl is None if the plan is complete, otherwise the
+        last SNCL compared with the index (empty if none).
+        """
+        try:
+            saved_hash, n_retries, complete, planned_sncl = \
+                self.fetchone('''SELECT request_hash, n_retries, complete, planned_sncl
+                                   FROM rover_plans WHERE submission = ?''',
+                              (self._submission,))
+        except NoResult:
+            return None
+        if str(saved_hash) != str(request_hash):
+            self._log.warn('The saved plan was for a different request')
+            return None
+        if complete:
+            planned_sncl = None
+        elif planned_sncl is None:
+            planned_sncl = ''
+        coverages = []
+
+        def callback(row):
+            sncl, samplerate, timespans = row
+            coverage = self._coverage_class(self._log, self._timespan_tol, self._timespan_inc, sncl)
+            coverage.samplerate = samplerate
+            coverage.timespans = [tuple(timespan) for timespan in json.loads(timespans)]
+            coverages.append(coverage)
+
+        self.foreachrow('SELECT sncl, samplerate, timespans FROM rover_plan_coverages WHERE submission = ? ORDER BY id',
+                        (self._submission,), callback)
+        return n_retries, coverages, planned_sncl
+
+    def discard_plan(self):
+        """
+        Discard the plan and the record of chunks (when complete).
+        """
+        self.execute('DELETE FROM rover_plans WHERE submission = ?', (self._submission,))
+        self.execute('DELETE FROM rover_plan_coverages WHERE submission = ?', (self._submission,))
+        self.clear()
+
+    def outcomes(self):
+        """
+        Returns (done, uncertain) where done is a map from SNCL to the timespans of completed
+        chunks, and uncertain is a set of SNCLs in chunks that were running (or failed) and so
+        may have been partially ingested.
+        """
+        done, uncertain = {}, set()
+
+        def callback(row):
+            state, data = row
+            for (sncl, start, end) in json.loads(data):
+                if state == DONE:
+                    done.setdefault(sncl, []).append((start, end))
+                elif state in (RUNNING, FAILED):
+                    uncertain.add(sncl)
+
+        self.foreachrow('SELECT state, data FROM rover_chunks WHERE submission = ?', (self._submission,), callback)
+        return done, uncertain
+
+    def touched(self):
+        """
+        Returns a map from SNCL to the timespans of all chunks in the record (whatever the outcome).
+        """
+        touched = {}
+
+        def callback(row):
+            for (sncl, start, end) in json.loads(row[0]):
+                touched.setdefault(sncl, []).append((start, end))
+
+        self.foreachrow('SELECT data FROM rover_chunks WHERE submission = ?', (self._submission,), callback)
+        return touched
+
+    def _create_verifications_table(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_verifications (
+                          submission text primary key,
+                          count int not null
+                        )''')
+
+    def count_verification(self):
+        """
+        Increment and return the number of verifications (for all retrievals of the submission).
+        """
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            self._db.execute('INSERT OR IGNORE INTO rover_verifications (submission, count) VALUES (?, 0)',
+                             (self._submission,))
+            self._db.execute('UPDATE rover_verifications SET count = count + 1 WHERE submission = ?',
+                             (self._submission,))
+        return self.fetchsingle('SELECT count FROM rover_verifications WHERE submission = ?', (self._submission,))
+
+    def _create_chunks_table(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_chunks (
+                          id integer primary key autoincrement,
+                          submission text not null,
+                          description text not null,
+                          data text not null,
+                          state text not null,
+                          updated_epoch int default (cast(strftime('%s', 'now') AS int))
+                        )''')
+        self.execute('''CREATE INDEX IF NOT EXISTS rover_chunks_submission_state
+                          ON rover_chunks (submission, state)''')
+
+    def clear(self):
+        """
+        Discard the record (when starting a new plan).
+        """
+        self.execute('DELETE FROM rover_chunks WHERE submission = ?', (self._submission,))
+
+    def start(self, description, data):
+        """
+        Record a chunk as it starts downloading, returning the id.
+        """
+        with self.cursor() as c:
+            c.execute('INSERT INTO rover_chunks (submission, description, data, state) VALUES (?, ?, ?, ?)',
+                      (self._submission, description, json.dumps(data), RUNNING))
+            return c.lastrowid
+
+    def finish(self, id, state):
+        """
+        Record the outcome of a chunk (DONE, FAILED or SPLIT).
+        """
+        self.execute('''UPDATE rover_chunks SET state = ?, updated_epoch = cast(strftime('%s', 'now') AS int)
+                          WHERE id = ?''', (state, id))
+
+    def failures(self):
+        """
+        Return (and mark as retried) the (description, data) of failed chunks.
+        """
+        failures = []
+
+        def callback(row):
+            description, data = row
+            failures.append((description, [tuple(entry) for entry in json.loads(data)]))
+
+        self.foreachrow('''SELECT description, data FROM rover_chunks
+                             WHERE submission = ? AND state = ? ORDER BY id''',
+                        (self._submission, FAILED), callback)
+        self.execute('UPDATE rover_chunks SET state = ? WHERE submission = ? AND state = ?',
+                     (RETRIED, self._submission, FAILED))
+        return failures
+
+
+def shard_lines(lines, max_lines, days=SHARD_DAYS):
+    """
+    Split request lines into shards of at most max_lines, grouped by network.  A line
+    with a wildcard network or station that covers more than the given number of
+    days is split into windows, one per shard.
+    """
+    shards, shard = [], []
+    for line in sorted(lines):
+        windows = _windows(line, days)
+        if len(windows) > 1:
+            shards.extend([window] for window in windows)
+        else:
+            if len(shard) == max_lines:
+                shards.append(shard)
+                shard = []
+            shard.append(line)
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def _windows(line, days):
+    parts = line.split()
+    if len(parts) == 6 and any('*' in part or '?' in part for part in parts[0:2]):
+        try:
+            start, end = parse_epochs(parts[4:])
+        except ValueError:
+            return [line]
+        window = days * 24 * 60 * 60
+        if end - start > window:
+            windows = []
+            while start < end:
+                windows.append(' '.join(parts[0:4] + [format_epoch(start), format_epoch(min(end, start + window))]))
+                start += window
+            return windows
+    return [line]
+
+
+class Hedging:
+    """
+    The latencies of recent (successful) downloads, used to decide when a download is
+    slow enough to start a second copy (a "hedged" request - whichever copy finishes
+    first is used).
+    """
+
+    def __init__(self, percentile, n_samples=HEDGE_SAMPLES, min_samples=HEDGE_MIN_SAMPLES):
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._latencies = deque(maxlen=n_samples)
+
+    def add(self, seconds):
+        self._latencies.append(seconds)
+
+    def threshold(self):
+        """
+        The latency (s) after which a download is hedged (or None if too few samples).
+        """
+        if len(self._latencies) < self._min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self._percentile / 100.0))]
 
 
 class Retrieval:
@@ -191,15 +688,29 @@ class Retrieval:
     on the fly).
     """
 
-    def __init__(self, log, name, temp_dir, delete_files, dataselect_url, force_failures):
+    def __init__(self, log, name, temp_dir, delete_files, dataselect_url, force_failures, chunk_samples,
+                 chunk_order, journal, record=None, hedging=None, endpoints=None):
         self._log = log
+        self._journal = journal
+        # called with (description, dispatch_epoch, return_code, feedback, url) for metrics
+        self._record = record
+        self._hedging = hedging
+        self._endpoints = endpoints  # choice of dataselect service (if None, dataselect_url is used)
         self._name = name
         self._temp_dir = temp_dir
+        self._chunk_samples = chunk_samples
+        self._chunk_order = chunk_order
         self._delete_files = delete_files
         self._dataselect_url = dataselect_url
         self._force_failures = force_failures
         self._coverages = deque()  # fifo: appendright / popleft; exposed for display
         self._chunks = None
+        self._planner = None  # generator of (available, required) coverages while planning
+        # (description, data, depth, tried) for halves of failed downloads, or whole downloads
+        # to retry at another dataselect service (tried is the URLs that failed)
+        self._retries = deque()
+        self._failures = deque()  # (description, data) for chunks that failed in an earlier retrieval
+        self._running = {}  # journal id -> details of downloads that are running (including hedged copies)
         self.worker_count = 0
         self.errors = ErrorStatistics()
         self.progress = ProgressStatistics()
@@ -212,6 +723,67 @@ class Retrieval:
             self._coverages.append(coverage)
             self.progress.add_coverage(coverage)
 
+    def plan(self, planner, n_stations, seconds):
+        """
+        Add coverages from the planner (a generator of (available, required) coverages) as
+        they are needed, so that downloads can start before planning is complete.  Until then,
+        progress totals are estimated from the availability.
+        """
+        self._planner = planner
+        self.progress.estimate(n_stations, seconds)
+
+    def _plan_next(self):
+        try:
+            available, required = next(self._planner)
+            self.progress.remove_estimate(available)
+            self.add_coverage(required)
+        except StopIteration:
+            self._planner = None
+        except Exception as e:
+            # counted as an error, so the retrieval is retried
+            self._log.error('Could not compare availability with the index: %s' % e)
+            self.errors.errors += 1
+            self._planner = None
+
+    def plan_ahead(self):
+        """
+        Plan a little further ahead of the downloads, returning whether anything was done.
+        """
+        if self._planner and len(self._coverages) < PLAN_AHEAD:
+            self._plan_next()
+            return True
+        return False
+
+    def finish_planning(self):
+        """
+        Complete the plan (for listing).
+        """
+        while self._planner:
+            self._plan_next()
+
+    def _fill(self):
+        while self._planner and not self._coverages:
+            self._plan_next()
+
+    def _order_window(self):
+        """
+        Move the station that comes first (in chunk order) among the planned coverages to the
+        front, so that the order applies across stations (within the planning window).
+        """
+        stations = []
+        for coverage in self._coverages:
+            if not stations or Chunks._net_sta(coverage.sncl) != Chunks._net_sta(stations[-1][0].sncl):
+                stations.append([])
+            stations[-1].append(coverage)
+        # while planning continues, the last station may be incomplete
+        candidates = stations[:-1] if self._planner and len(stations) > 1 else stations
+        if len(candidates) > 1:
+            keys = [(self._chunks.window_key(coverages), i) for i, coverages in enumerate(candidates)]
+            first = min(keys)[1]
+            if first:
+                self._coverages = deque(stations[first] + [coverage for i, coverages in enumerate(stations)
+                                                           if i != first for coverage in coverages])
+
     def get_coverages(self):
         """
         Provide access to coverages (for listing)
@@ -222,13 +794,16 @@ class Retrieval:
         """
         Ensure chunks has some data, if possible, and return whether it has any.
         """
-        if self._chunks:
+        if self._retries or self._failures or self._chunks:
             return True
-        self._chunks = Chunks(self._temp_dir)
-        while self._coverages and self._chunks.sncl_ok(self._coverages[0].sncl):
+        self._chunks = Chunks(self._log, self._chunk_samples, self._chunk_order)
+        self._fill()
+        self._order_window()
+        while self._coverages and self._chunks.accepts(self._coverages[0]):
             self._chunks.add_coverage(self._coverages.popleft())
+            self._fill()
         if self._chunks:
-            self.progress.add_chunks(len(self._chunks))
+            self.progress.add_chunks(len(self._chunks), self._chunks.n_stations)
             return True
         return False
 
@@ -237,48 +812,205 @@ class Retrieval:
                      tuple(code if code else '--' for code in tuple(sncl.split('_')))
         return '%s?%s&start=%s&end=%s' % (self._dataselect_url, url_params, format_epoch(start), format_epoch(end))
 
-    def _worker_callback(self, command, return_code, path, **kwargs):
+    def add_failure(self, description, data):
+        """
+        Add a chunk that failed in an earlier retrieval (to retry directly).
+        """
+        self._failures.append((description, data))
+        self.progress.add_chunk(data)
+
+    def _write_chunk(self, description, data, path=None):
+        path = path or unique_path(self._temp_dir, 'rover_chunk', description)
+        with open(path, 'w') as out:
+            for (sncl, start, end) in data:
+                print('%s %s %s' % (Chunks.format_sncl(sncl), format_epoch(start), format_epoch(end)), file=out)
+        return path
+
+    def _worker_callback(self, command, return_code, path, chunk, dispatch_epoch, endpoint, **kwargs):
         feedback = kwargs.get("feedback")
+        if self._record:
+            self._record(chunk[0], dispatch_epoch, return_code, feedback,
+                         endpoint.url if endpoint else self._dataselect_url)
         if feedback:
             bytecount = feedback.get("download_byte_count", 0)
             ProgressStatistics.download_bytes += bytecount
             ProgressStatistics.download_total_bytes += bytecount
+            if feedback.get('files'):
+                self._log.debug('%s ingested %d sections into %s' %
+                                (command, feedback.get('sections', 0), ', '.join(feedback['files'])))
+            if feedback.get('timings'):
+                self._log.debug('Timings for %s: %s' % (command, ', '.join('%s %.3fs' % item for item in
+                                                                            sorted(feedback['timings'].items()))))
         if self._delete_files:
             safe_unlink(path)
+        running = self._running[chunk[3]]
+        running['copies'] -= 1
+        if running['done']:
+            # a hedged copy that finished (or was cancelled) after the chunk was complete
+            if endpoint:
+                self._endpoints.release(endpoint)
+            self._end_running(running)
+            return
+        if endpoint:
+            self._endpoints.finished(endpoint, return_code, feedback, time() - dispatch_epoch)
         self.worker_count -= 1
+        duplicate = feedback and feedback.get('duplicate')
+        if not return_code and not duplicate:
+            if self._hedging:
+                self._hedging.add(time() - dispatch_epoch)
+            self._cancel_copies(running, command)
+        elif running['copies']:
+            return  # the other (hedged) copy will decide
+        running['done'] = True
+        self._end_running(running)
         self.errors.downloads += 1
-        if return_code:
+        if not return_code and not duplicate:
+            self._journal.finish(chunk[3], DONE)
+        else:
+            if duplicate:
+                # the other copy claimed the data, but failed
+                return_code = return_code or ERROR_CODE
+            if return_code != ABORT_CODE and self._fail_over(chunk, endpoint, return_code, feedback):
+                self._journal.finish(chunk[3], RETRIED)
+                return
+            if return_code != ABORT_CODE and self._retry_halves(chunk):
+                self._journal.finish(chunk[3], SPLIT)
+                return
+            self._journal.finish(chunk[3], FAILED)
             self.errors.errors += 1
             if return_code != ABORT_CODE:   # hide message on ctrl-C as we will exit as well
                 self._log.error('Download %s failed (return code %d)' % (self._name, return_code))
 
+    def _cancel_copies(self, running, command):
+        # the chunk is complete, so any other copy is no longer needed
+        for other in running['commands']:
+            if other != command:
+                self._log.debug('Cancelling %s' % other)
+                running['workers'].cancel(other)
+        self.worker_count -= running['copies']
+
+    def _end_running(self, running):
+        # once all copies have finished the claim on the data (if any) can be deleted
+        if not running['copies']:
+            del self._running[running['chunk'][3]]
+            if self._hedging and self._delete_files:
+                safe_unlink(claim_path(running['path']))
+
+    def _fail_over(self, chunk, endpoint, return_code, feedback):
+        # a download that failed because of the service is retried (whole) at another service
+        description, data, depth, id, tried = chunk
+        if endpoint and is_endpoint_failure(return_code, feedback):
+            tried = tried + (endpoint.url,)
+            if self._endpoints.has_alternative(tried):
+                self._log.warn('Download %s%s failed at %s - retrying at another service' %
+                               (self._name, description, endpoint))
+                self._retries.append((description, data, depth, tried))
+                return True
+        return False
+
+    def _retry_halves(self, chunk):
+        # a failed (perhaps timed-out) download is retried immediately as two smaller downloads
+        description, data, depth, id, tried = chunk
+        halves = Chunks.halve(data) if depth < MAX_SPLIT_DEPTH else None
+        if halves:
+            self._log.warn('Download %s%s failed - retrying in two parts' % (self._name, description))
+            for i, half in enumerate(halves):
+                self._retries.append(('%s [%s]' % (description, 'ab'[i]), half, depth + 1, ()))
+            return True
+        return False
+
     def new_worker(self, workers, config_path, rover_cmd):
         """
-        Launch a new worker (called by manager main loop).
+        Launch a new worker (called by manager main loop), returning the estimated samples requested.
         """
-        description, path = self._chunks.pop(self.progress)
+        if self._retries:
+            description, data, depth, tried = self._retries.popleft()
+        elif self._failures:
+            (description, data), depth, tried = self._failures.popleft(), 0, ()
+            self.progress.pop_data(data)
+        else:
+            (description, data), depth, tried = self._chunks.pop(self.progress), 0, ()
+        path = self._write_chunk(description, data)
         self._log.default('Downloading %s %s' % (description, self.progress))
         # for testing error handling we can inject random errors here
-        if randint(1, 100) <= self._force_failures:
+        failure = randint(1, 100) <= self._force_failures
+        if failure:
             self._log.warn('Random failure expected (%s %d)' % (mm(FORCEFAILURES), self._force_failures))
-            command = 'exit 1  # failure for tests'
-        else:
-            # we only pass arguments on the command line that are different from the
-            # default (which is in the file)
-            if windows():
-                command = 'pythonw -m rover -f %s %s "%s"' % (config_path, DOWNLOAD, path)
-            else:
-                command = '%s -f %s %s "%s"' % (rover_cmd, config_path, DOWNLOAD, path)
-        self._log.debug(command)
 
-        callback_function = lambda cmd, rtn, **kwargs: self._worker_callback(cmd, rtn, path, **kwargs)
+        chunk = (description, data, depth, self._journal.start(description, data), tried)
+        running = {'chunk': chunk, 'path': path, 'workers': workers, 'epoch': time(),
+                   'commands': [], 'urls': [], 'copies': 0, 'hedged': False, 'done': False}
+        self._running[chunk[3]] = running
+        endpoint = self._endpoints.select(avoid=tried) if self._endpoints else None
+        self._launch(workers, config_path, rover_cmd, running, path, failure, endpoint)
+        if not running['copies']:
+            del self._running[chunk[3]]
+        return Chunks.estimate_samples(data)
+
+    def hedge(self, workers, config_path, rover_cmd):
+        """
+        Start a second copy of the oldest running download, if it is slower than the
+        hedging threshold, returning whether one was started.
+        """
+        threshold = self._hedging.threshold() if self._hedging else None
+        if threshold is None or (self._endpoints and not self._endpoints.has_space()):
+            return False
+        now = time()
+        slow = [running for running in self._running.values()
+                if not (running['hedged'] or running['done']) and now - running['epoch'] > threshold]
+        if not slow:
+            return False
+        running = min(slow, key=lambda running: running['epoch'])
+        running['hedged'] = True
+        description, data = running['chunk'][:2]
+        self._log.info('Download %s%s is slow (over %.1fs) - starting a second copy' %
+                       (self._name, description, threshold))
+        path = self._write_chunk(description, data, path=running['path'] + HEDGE_SUFFIX)
+        # preferably at a different dataselect service
+        endpoint = self._endpoints.select(avoid=running['urls']) if self._endpoints else None
+        self._launch(workers, config_path, rover_cmd, running, path, False, endpoint)
+        return True
+
+    def _launch(self, workers, config_path, rover_cmd, running, path, failure, endpoint):
+        chunk = running['chunk']
+        dispatch_epoch = time()
+        callback_function = lambda cmd, rtn, **kwargs: \
+            self._worker_callback(cmd, rtn, path, chunk, dispatch_epoch, endpoint, **kwargs)
+        # the url is only needed if there is a choice (otherwise it is in the config)
+        url = endpoint.url if endpoint and len(self._endpoints) > 1 else None
 
         try:
-            workers.execute(command, callback=callback_function, feedback=True)
+            if isinstance(workers, ThreadWorkers):
+                command = '%s "%s"' % (DOWNLOAD, path)
+                job = forced_failure if failure else \
+                    lambda downloader: downloader.download(path, dataselect_url=url)
+                workers.execute(job, callback=callback_function, name=command)
+            elif isinstance(workers, PoolWorkers):
+                command = '%s "%s"' % (DOWNLOAD, path)
+                job = {'fail': 'Failure for tests'} if failure else {'args': [path], 'dataselect_url': url}
+                workers.execute(job, callback=callback_function, name=command)
+            else:
+                # we only pass arguments on the command line that are different from the
+                # default (which is in the file)
+                options = ' %s "%s"' % (mm(DATASELECTURL), url) if url else ''
+                if failure:
+                    command = 'exit 1  # failure for tests'
+                elif windows():
+                    command = 'pythonw -m rover -f %s%s %s "%s"' % (config_path, options, DOWNLOAD, path)
+                else:
+                    command = '%s -f %s%s %s "%s"' % (rover_cmd, config_path, options, DOWNLOAD, path)
+                self._log.debug(command)
+                workers.execute(command, callback=callback_function, feedback=True)
         except Exception as ex:
             self._log.error('Worker failed (%s): %s' % (command, ex))
+            if endpoint:
+                self._endpoints.release(endpoint)
         else:
             self.worker_count += 1
+            running['commands'].append(command)
+            running['copies'] += 1
+            if endpoint:
+                running['urls'].append(endpoint.url)
 
     def is_complete(self):
         """
@@ -287,6 +1019,65 @@ class Retrieval:
         return self.worker_count == 0 and not self.has_chunks()
 
 
+def forced_failure(downloader):
+    """
+    In-process equivalent of 'exit 1' (see force-failures).
+    """
+    raise Exception('Failure for tests')
+
+
+class MergedIndex:
+    """
+    The index, read in a single scan ordered by SNCL, for comparison with the (sorted)
+    availability.  This avoids a separate query for each SNCL in large requests.
+
+    SNCLs must be requested in order.  If not (the availability was sorted differently)
+    then None is returned and the caller should query the index directly.
+    """
+
+    def __init__(self, config, first_network, last_network):
+        self._log = config.log
+        self._timespan_tol = config.arg(TIMESPANTOL)
+        self._timespan_inc = config.arg(TIMESPANINC)
+        self._coverage_class = coverage_class(config.arg(COVERAGEENGINE))
+        # a separate connection, so that the scan can continue while the main connection is used
+        self._db = init_db(timeseries_db(config), self._log)
+        self._prev_key = None
+        try:
+            # timespans as text or packed (see Source._scan_index)
+            columns, table = select_timespans(SqliteDb(self._db, self._log))
+            self._rows = self._db.execute(
+                '''SELECT t.network, t.station, t.location, t.channel, %s, t.samplerate
+                     FROM %s
+                     WHERE t.network >= ? AND t.network <= ?
+                     ORDER BY t.network, t.station, t.location, t.channel, t.starttime, t.endtime''' %
+                (columns, table), (first_network, last_network))
+            self._row = next(self._rows, None)
+        except OperationalError:
+            self._log.debug('No index - check rover.config')
+            self._row = None
+
+    def coverage(self, sncl):
+        """
+        The index coverage for the SNCL (or None if requested out of order).
+        """
+        key = tuple(sncl.split('_'))
+        if self._prev_key is not None and key <= self._prev_key:
+            return None
+        self._prev_key = key
+        while self._row and tuple(self._row[0:4]) < key:
+            self._row = next(self._rows, None)
+        builder = SingleSNCLBuilder(self._log, self._timespan_tol, self._timespan_inc, sncl,
+                                    coverage_class=self._coverage_class)
+        while self._row and tuple(self._row[0:4]) == key:
+            builder.add_timespans(self._row[4], self._row[6], packed=self._row[5])
+            self._row = next(self._rows, None)
+        return builder.coverage()
+
+    def close(self):
+        self._db.close()
+
+
 # avoid enum because python2 doesn't have it and we want code that runs on both
 # (if we use backports then it's a conditional install)
 UNCERTAIN, CONFIRMED, INCONSISTENT = 0, 1, 2
@@ -303,9 +1094,13 @@ class Source(SqliteSupport):
     # second. it collects and reports statistics that are used by the download manager and displayed to the user.
     # these are the public attributes and properties (delegated to the current retriever).
 
-    def __init__(self, config, name, fetch, request_path, availability_url, dataselect_url, completion_callback):
+    def __init__(self, config, name, fetch, request_path, availability_url, dataselect_url, completion_callback,
+                 metrics=None, weight=1, max_workers=0, updated_after=None, endpoints=None):
         super().__init__(config)
         self._log = config.log
+        self._metrics = metrics
+        self.weight = max(1, weight)  # relative share of the workers
+        self.max_workers = max_workers  # limit on workers (0 for no limit)
         self._force_failures = config.arg(FORCEFAILURES)
         self._delete_files = config.arg(DELETEFILES)
         self._temp_dir = config.dir(TEMPDIR)
@@ -313,22 +1108,40 @@ class Source(SqliteSupport):
         self._http_retries = config.arg(HTTPRETRIES)
         self._timespan_inc = config.arg(TIMESPANINC)
         self._timespan_tol = config.arg(TIMESPANTOL)
+        self._coverage_class = coverage_class(config.arg(COVERAGEENGINE))
         self._config = config
         self.download_retries = config.arg(DOWNLOADRETRIES)
         self._sort_in_python = config.arg(SORTINPYTHON)
+        self._availability_shard = config.arg(AVAILABILITYSHARD)
+        self._availability_workers = max(1, config.arg(AVAILABILITYWORKERS))
+        self._availability_cache = AvailabilityCache(config)
+        self._chunk_samples = config.arg(CHUNKSAMPLES)
+        self._chunk_order = config.arg(CHUNKORDER).lower()
         self.name = name
         self._request_path = request_path
         self._availability_url = availability_url
         self._dataselect_url = dataselect_url
+        self._updated_after = updated_after  # only data updated after this epoch are checked (if not None)
+        # shared with other sources using the same services, if given (see DownloadManager)
+        self._endpoints = endpoints or Endpoints(self._log, dataselect_url, config.arg(DATASELECTWORKERS))
         self._completion_callback = completion_callback
+        self._journal = ChunkJournal(config, name)
+        self._resume = config.arg(RESUME)
+        self._bulk_diff = config.arg(BULKDIFF)
+        self._verify_full_every = config.arg(VERIFYFULLEVERY)
+        # latencies are kept across retrievals
+        self._hedging = Hedging(config.arg(DOWNLOADHEDGE)) if config.arg(DOWNLOADHEDGE) else None
         self.n_retries = 0
         self._retrieval = None
+        self._full_check = True  # must the next new retrieval check the whole request? (see _new_retrieval)
         self.start_epoch = time()
         self.errors = ErrorStatistics()
         self._expect_empty = False
         self.consistent = UNCERTAIN
+        self._timespans_sql = None  # (columns, table) for reading the index, once per retrieval
         # load first retrieval immediately so we don't print messages in the middle of list-retrieve
-        self._new_retrieval(fetch)
+        if not (fetch and self._resume and self._resume_retrieval()):
+            self._new_retrieval(fetch)
         self.initial_progress = self._retrieval.progress
 
     def __str__(self):
@@ -352,6 +1165,12 @@ class Source(SqliteSupport):
         """
         return self._retrieval.has_chunks()
 
+    def plan_ahead(self):
+        """
+        Compare more availability with the index, if still planning (returns whether anything was done).
+        """
+        return self._retrieval.plan_ahead()
+
     @property
     def worker_count(self):
         """
@@ -361,9 +1180,25 @@ class Source(SqliteSupport):
 
     def new_worker(self, workers, config_path, rover_cmd):
         """
-        Launch a new worker (called by manager main loop).
+        Launch a new worker (called by manager main loop), returning the estimated samples requested.
         """
-        self._retrieval.new_worker(workers, config_path, rover_cmd)
+        return self._retrieval.new_worker(workers, config_path, rover_cmd)
+
+    def hedge(self, workers, config_path, rover_cmd):
+        """
+        Start a second copy of a slow download, if possible, returning whether one was started.
+        """
+        if self.max_workers and self.worker_count >= self.max_workers:
+            return False
+        return self._retrieval.hedge(workers, config_path, rover_cmd)
+
+    def can_use_worker(self):
+        """
+        Does the source have data to download, and is it below any limit on workers
+        (including the limit for each dataselect service)?
+        """
+        return (not self.max_workers or self.worker_count < self.max_workers) and \
+            self._endpoints.has_space() and self.has_chunks()
 
     @property
     def _name(self):
@@ -427,9 +1262,9 @@ class Source(SqliteSupport):
             # if we can retry, then do so
             if retry_possible:
                 self._log.default(('Retrieval attempt %d of %d completed with %d errors. '+
-                                    'We will retry to check that all data were retrieved') %
+                                    'We will retry the failed downloads') %
                                     (self.n_retries, self.download_retries, self._retrieval.errors.errors))
-                self._new_retrieval(True)
+                self._retry_failures()
                 return False
             # otherwise, we can't retry so we're done, but failed.
             else:
@@ -573,46 +1408,261 @@ class Source(SqliteSupport):
 
     def _new_retrieval(self, fetch):
         # fetch indicates we're not simply querying and so should check for no data and prime days
+        # a retrieval that follows one without errors is verifying that, and may check only what was touched
+        # (this must be read before the journal is cleared below)
+        self._note_errors()
+        touched = self._touched() if fetch and not self._full_check else None
+        if fetch and touched is None:
+            self._full_check = False
         self.n_retries += 1
+        self._timespans_sql = None
         if fetch:
             self._log.default('Trying new %sretrieval attempt %d of %d.' %
                               (self._name, self.n_retries, self.download_retries))
-        self._retrieval = Retrieval(self._log, self._name, self._temp_dir, self._delete_files,
-                                    self._dataselect_url, self._force_failures)
-        request = self._build_request(self._request_path)
-        response = self._get_availability(request, self._availability_url)
+            self._journal.start_plan(self._request_hash(), self.n_retries)
+        self._retrieval = self._empty_retrieval()
+        if touched is None:
+            request = self._build_request(self._request_path)
+        elif touched:
+            self._log.default('Checking availability only for the %d N_S_L_C downloaded in the previous attempt' %
+                              len(touched))
+            request = self._build_touched_request(touched)
+        else:
+            self._log.default('Nothing was downloaded in the previous attempt, so there is nothing to check')
+            return
+        self._start_planning(fetch, request)
+        if fetch and not self._retrieval.has_chunks():
+            self._log.default('%sRetrieval attempt %d of %d is complete.' %
+                              (self._name, self.n_retries, self.download_retries))
+
+    def _start_planning(self, fetch, request, planned_sncl=None):
+        # request availability and start the (lazy) comparison with the index.  if planned_sncl
+        # is given then SNCLs up to and including that were planned earlier (see _resume_retrieval)
+        responses = self._get_availability(request, self._availability_url)
+        availability = None
         try:
-            # compare database and availability to construct list of missing data
-            # we could make this lazy, but then we lose progression statistics.  so
-            # just try to be as meagre with memory use as possible.
-            for remote in self._parse_availability(response):
+            if responses:  # empty when no data returned
+                # the responses, merged in order (usually each is already sorted, so is read directly)
+                availability = SortedFile(self._log, responses, self._temp_dir, self._sort_in_python)
+            n_stations, seconds, networks = self._count_availability(availability)
+        except:
+            self._delete_request(request, responses, availability)
+            raise
+        # the comparison with the index is made as chunks are needed (or while waiting for
+        # downloads), so downloads start immediately, even for large requests
+        self._retrieval.plan(self._plan(fetch, request, responses, availability, networks, planned_sncl),
+                             n_stations, seconds)
+        if not fetch:
+            self._retrieval.finish_planning()
+
+    def _plan(self, fetch, request, responses, availability, networks, planned_sncl=None):
+        # compare database and availability to construct list of missing data.  progress is
+        # saved (with the last SNCL compared) regularly, so that an interrupted plan can be resumed
+        planned, compared = [], 0
+        skip = tuple(planned_sncl.split('_')) if planned_sncl else None
+        index = MergedIndex(self._config, *networks) if self._bulk_diff and networks else None
+        try:
+            for remote in self._parse_availability(availability):
+                if skip and tuple(remote.sncl.split('_')) <= skip:
+                    # already in the plan (availability is sorted, as for MergedIndex)
+                    yield remote, None
+                    continue
                 self._log.debug('Available data: %s' % remote)
-                local = self._scan_index(remote.sncl)
+                local = index.coverage(remote.sncl) if index else None
+                if local is None:
+                    local = self._scan_index(remote.sncl)
                 self._log.debug('Local data: %s' % local)
                 required = remote.subtract(local)
-                self._retrieval.add_coverage(required)
+                compared += 1
+                if fetch:
+                    if required:
+                        planned.append(required)
+                    if len(planned) == PLAN_AHEAD or not compared % PLAN_AHEAD:
+                        self._journal.extend_plan(planned, remote.sncl)
+                        planned = []
+                yield remote, required
+            if fetch:
+                self._journal.extend_plan(planned)
+                self._journal.complete_plan()
         finally:
-            if self._delete_files:
-                safe_unlink(request)
+            if index:
+                index.close()
+            self._delete_request(request, responses, availability)
+
+    def _note_errors(self):
+        # any error (in planning or downloads) means data may have been missed, so the next new
+        # retrieval checks the whole request, even when a retry of the failed downloads (which
+        # has no errors of its own) comes first
+        if self._retrieval and self._retrieval.errors.errors:
+            self._full_check = True
+
+    def _touched(self):
+        # None if the full request should be checked (see verify-full-every), otherwise
+        # coverages for the data touched in the previous attempt
+        count = self._journal.count_verification()
+        if self._verify_full_every and not count % self._verify_full_every:
+            return None
+        touched = []
+        for sncl, timespans in sorted(self._journal.touched().items()):
+            coverage = self._coverage_class(self._log, self._timespan_tol, self._timespan_inc, sncl)
+            for start, end in sorted(timespans):
+                coverage.add_epochs(start, end)
+            touched.append(coverage)
+        return touched
+
+    def _build_touched_request(self, touched):
+        tmp = unique_path(self._temp_dir, TMPREQUEST, self._request_path)
+        self._log.debug('Writing request for touched data to %s' % tmp)
+        with open(tmp, 'w') as output:
+            print('merge=samplerate,quality', file=output)
+            for coverage in touched:
+                for start, end in coverage.timespans:
+                    print('%s %s %s' % (Chunks.format_sncl(coverage.sncl), format_epoch(start), format_epoch(end)),
+                          file=output)
+        return tmp
+
+    def _delete_request(self, request, responses, availability=None):
+        if availability:
+            availability.close()
+        if self._delete_files:
+            safe_unlink(request)
+            for response in responses:
                 safe_unlink(response)
-        if fetch and not self._retrieval.has_chunks():
-            self._log.default('%sRetrieval attempt %d of %d is complete.' %
-                              (self._name, self.n_retries, self.download_retries))
+
+    def _request_hash(self):
+        # a stable digest (the same in every process), so a plan can be resumed by a later run
+        with open(self._request_path, 'r') as input:
+            request = '%s %s %s' % (self._availability_url, self._dataselect_url, input.read())
+        if self._updated_after is not None:
+            request += ' updatedafter=%s' % self._updated_after
+        return sha1(request.encode('utf-8')).hexdigest()
+
+    def _resume_retrieval(self):
+        # continue from the saved plan, less the chunks that completed.  the index is checked
+        # again for data in chunks that were interrupted (or failed), since they may have been
+        # partially ingested.
+        plan = self._journal.load_plan(self._request_hash())
+        if plan is None:
+            self._log.default('No interrupted %sretrieval to resume' % self._name)
+            return False
+        self.n_retries, coverages, planned_sncl = plan
+        self._full_check = True  # we don't know whether the interrupted attempt had errors
+        done, uncertain = self._journal.outcomes()
+        self._log.default('Resuming %sretrieval attempt %d of %d.' % (self._name, self.n_retries, self.download_retries))
+        self._timespans_sql = None
+        self._retrieval = self._empty_retrieval()
+        for coverage in coverages:
+            if coverage.sncl in done:
+                completed = self._coverage_class(self._log, self._timespan_tol, self._timespan_inc, coverage.sncl)
+                completed.add_samplerate(coverage.estimated_samplerate())
+                for start, end in sorted(done[coverage.sncl]):
+                    completed.add_epochs(start, end)
+                coverage = coverage.subtract(completed)
+            if coverage.sncl in uncertain:
+                coverage = coverage.subtract(self._scan_index(coverage.sncl))
+            self._retrieval.add_coverage(coverage)
+        # the remaining coverages become the plan
+        self._journal.save_plan(self._request_hash(), self.n_retries, self._retrieval.get_coverages(), planned_sncl)
+        if planned_sncl is not None:
+            # planning was interrupted, so continue with the SNCLs that were not compared
+            self._log.default('Continuing the interrupted plan%s' %
+                              (' after %s' % planned_sncl if planned_sncl else ''))
+            self._start_planning(True, self._build_request(self._request_path), planned_sncl)
+        return True
+
+    def discard_plan(self):
+        """
+        Discard the saved plan (called when complete).
+        """
+        self._journal.discard_plan()
+
+    def _empty_retrieval(self):
+        return Retrieval(self._log, self._name, self._temp_dir, self._delete_files,
+                         self._dataselect_url, self._force_failures, self._chunk_samples,
+                         self._chunk_order, self._journal, self._record_metrics if self._metrics else None,
+                         self._hedging, self._endpoints)
+
+    def _record_metrics(self, description, dispatch_epoch, return_code, feedback, url):
+        self._metrics.record(self.name, url, description, dispatch_epoch, return_code, feedback)
+
+    def _retry_failures(self):
+        # re-download only the chunks that failed (from the journal), without checking availability
+        # again.  the full comparison with availability is still made when verifying at the end.
+        self._note_errors()
+        failures = self._journal.failures()
+        if not failures:
+            self._new_retrieval(True)
+            return
+        self.n_retries += 1
+        self._log.default('Trying new %sretrieval attempt %d of %d (%d failed downloads).' %
+                          (self._name, self.n_retries, self.download_retries, len(failures)))
+        self._retrieval = self._empty_retrieval()
+        for description, data in failures:
+            self._retrieval.add_failure(description, data)
 
     def _build_request(self, path):
         tmp = unique_path(self._temp_dir, TMPREQUEST, path)
         self._log.debug('Prepending options to %s via %s' % (path, tmp))
         with open(tmp, 'w') as output:
             print('merge=samplerate,quality', file=output)
+            if self._updated_after is not None:
+                print('updatedafter=%s' % format_epoch(self._updated_after), file=output)
             with open(path, 'r') as inpath:
                 for line in inpath:
                     print(line, file=output, end='')
         return tmp
 
     def _get_availability(self, request, availability_url):
-        self._log.info('Checking availability service')
+        # large requests are split into shards that are queried in parallel.  returns the
+        # responses (there is no response for a query that returned no data)
+        shards = self._shard_request(request)
+        if len(shards) == 1:
+            self._log.info('Checking availability service')
+            response = self._query_availability(request, availability_url)
+            self._availability_cache.log_stats()
+            return [response] if response else []
+        self._log.info('Checking availability service (%d queries, %d at a time)' %
+                       (len(shards), self._availability_workers))
+        queue, results = Queue(), Queue()
+        for shard in shards:
+            queue.put(shard)
+        threads = [Thread(target=self._query_shards, args=(queue, results, availability_url))
+                   for _ in range(min(self._availability_workers, len(shards)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        responses, error = [], None
+        while not results.empty():
+            response, e = results.get()
+            if response:
+                responses.append(response)
+            error = error or e
+        if error:
+            self._delete_request(None, responses)
+            raise error
+        self._availability_cache.log_stats()
+        return responses
+
+    def _query_shards(self, queue, results, availability_url):
+        while True:
+            try:
+                shard = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results.put((self._query_availability(shard, availability_url), None))
+            except Exception as e:
+                results.put((None, e))
+            finally:
+                if self._delete_files:
+                    safe_unlink(shard)
+
+    def _query_availability(self, request, availability_url):
         response = unique_path(self._temp_dir, TMPRESPONSE, request)
-        response, check_status = post_to_file(availability_url, request, response, self._http_timeout, self._http_retries, self._log)
+        response, check_status = self._availability_cache.fetch(availability_url, request, response,
+                                                                self._http_timeout, self._http_retries)
         try:
             check_status()
             return response
@@ -620,6 +1670,29 @@ class Source(SqliteSupport):
             diagnose_error(self._log, str(e), request, response)
             raise
 
+    def _shard_request(self, request):
+        # split the request into shards (each with the options) of at most availability-shard lines,
+        # grouped by network, with any wide time ranges for wildcard networks or stations in separate
+        # windows.  the availability of a channel across windows is joined when the responses are merged.
+        options, lines = [], []
+        with open(request, 'r') as input:
+            for line in input:
+                line = line.strip()
+                if '=' in line:
+                    options.append(line)
+                elif line:
+                    lines.append(line)
+        shards = shard_lines(lines, self._availability_shard) if self._availability_shard else []
+        if len(shards) < 2:
+            return [request]
+        paths = []
+        for i, shard in enumerate(shards):
+            paths.append(unique_path(self._temp_dir, TMPREQUEST, '%s %d' % (request, i)))
+            with open(paths[-1], 'w') as output:
+                for line in options + shard:
+                    print(line, file=output)
+        return paths
+
     def _parse_line(self, line):
         try:
             n, s, l, c, b, e = ('' if token == '--' else token for token in line.split())
@@ -627,44 +1700,67 @@ class Source(SqliteSupport):
         except:
             raise Exception('Could not parse "%s" in the response from the availability service' % line)
 
-    def _parse_availability(self, response):
+    def _count_availability(self, lines):
+        # a quick pass through the (sorted) response to estimate totals for progress (and find
+        # the range of networks, for bulk-diff)
+        n_stations, seconds, prev_net_sta, networks = 0, 0, None, None
+        if lines is not None:
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    sncl, b, e = self._parse_line(line)
+                    net_sta = sncl.split('_')[0:2]
+                    if net_sta != prev_net_sta:
+                        n_stations += 1
+                        prev_net_sta = net_sta
+                    seconds += e - b
+                    network = net_sta[0]
+                    networks = (min(networks[0], network), max(networks[1], network)) if networks \
+                        else (network, network)
+        return n_stations, seconds, networks
+
+    def _parse_availability(self, lines):
+        # lines (a SortedFile) must be sorted
         try:
-            if response is not None:  # None when no data returned
-                sort_file_inplace(self._log, response, self._temp_dir, self._sort_in_python)
-                with open(response, 'r') as input:
-                    availability = None
-                    for line in input:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            sncl, b, e = self._parse_line(line)
-                            if availability and not availability.sncl == sncl:
-                                yield availability
-                                availability = None
-                            if not availability:
-                                availability = Coverage(self._log, self._timespan_tol, self._timespan_inc, sncl)
-                            availability.add_epochs(b, e)
-                    if availability:
-                        yield availability
+            if lines is not None:  # None when no data returned
+                availability = None
+                for line in lines:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        sncl, b, e = self._parse_line(line)
+                        if availability and not availability.sncl == sncl:
+                            yield availability
+                            availability = None
+                        if not availability:
+                            availability = self._coverage_class(self._log, self._timespan_tol, self._timespan_inc, sncl)
+                        availability.add_epochs(b, e)
+                if availability:
+                    yield availability
         except Exception as e:
             diagnose_error(self._log, 'Problems parsing the availability service response.',
-                           self._request_path, response)
+                           self._request_path, lines.paths[0])
             raise
 
     def _scan_index(self, sncl):
-        availability = SingleSNCLBuilder(self._log, self._timespan_tol, self._timespan_inc, sncl)
+        availability = SingleSNCLBuilder(self._log, self._timespan_tol, self._timespan_inc, sncl,
+                                         coverage_class=self._coverage_class)
 
         def callback(row):
-            availability.add_timespans(row[0], row[1])
+            availability.add_timespans(row[0], row[2], packed=row[1])
 
         try:
-            # coalesce below replaces [...] with <...> based on start/endtime if timespans is missing
+            # the timespans are read as text or, if available, packed (see rover.packed)
+            # the text is coalesced to <...> based on start/endtime if timespans is missing
             # this is handled by rover.coverage.BaseBuilder
             # see issue 47
             # note we separate times with space as time contains colons
-            self.foreachrow('''SELECT coalesce(timespans, '<' || starttime || ' ' || endtime || '>'), samplerate
-                                    FROM tsindex
-                                    WHERE network=? AND station=? AND location=? AND channel=?
-                                    ORDER BY starttime, endtime''',
+            if self._timespans_sql is None:
+                self._timespans_sql = select_timespans(self)
+            columns, table = self._timespans_sql
+            self.foreachrow('''SELECT %s, t.samplerate
+                                    FROM %s
+                                    WHERE t.network=? AND t.station=? AND t.location=? AND t.channel=?
+                                    ORDER BY t.starttime, t.endtime''' % (columns, table),
                             sncl.split('_'),
                             callback, quiet=True)
         except OperationalError:
@@ -672,14 +1768,65 @@ class Source(SqliteSupport):
         return availability.coverage()
 
 
+class FairShare:
+    """
+    Choose the source for the next download using deficit round-robin.
+
+    Each time a source's turn comes round it is credited with QUANTUM (times its weight)
+    estimated samples.  A source with credit can start a download, which is then charged
+    (after the event, since only then is the size known) with the estimated samples requested.
+    So, over time, each source gets a share of the downloaded data in proportion to its weight,
+    whatever the size of its chunks.
+
+    Only sources that can use a worker are considered (those with data, below any limit).
+    Credit is not saved by other sources, so when a source completes (or reaches its limit)
+    its share moves immediately to the rest.  But debt is kept (until the source is removed),
+    so a source that is briefly unable to use a worker (at its limit, or between chunks)
+    still repays the cost of a large download.
+    """
+
+    def __init__(self, quantum=QUANTUM):
+        self._quantum = quantum
+        self._deficits = {}  # map from source name to credit (estimated samples)
+        self._index = 0
+
+    def select(self, sources):
+        """
+        The next source (from a consistently ordered list of candidates), or None.
+        """
+        candidates = [source for source in sources if source.can_use_worker()]
+        names = set(source.name for source in sources)
+        candidate_names = set(source.name for source in candidates)
+        for name in list(self._deficits.keys()):
+            if name not in names:
+                del self._deficits[name]
+            elif name not in candidate_names:
+                self._deficits[name] = min(0, self._deficits[name])
+        if not candidates:
+            return None
+        while True:
+            source = candidates[self._index % len(candidates)]
+            deficit = self._deficits.get(source.name, 0)
+            if deficit > 0:
+                return source
+            self._deficits[source.name] = deficit + self._quantum * source.weight
+            self._index += 1
+
+    def charge(self, source, samples):
+        """
+        Charge the source for a download.
+        """
+        self._deficits[source.name] = self._deficits.get(source.name, 0) - samples
+
+
 class DownloadManager(SqliteSupport):
     """
     An interface to downloader instances that restricts downloads to a fixed number of workers,
     each downloading data that is for a maximum duration of a day.
 
-    It supports multiple *sources* and will try to divide load fairly between sources.  A
-    source is typically a source / subscription, so we spread downloads across multiple
-    servers when possible.
+    It supports multiple *sources* and will try to divide load fairly between sources (see
+    FairShare; sources can be weighted and limited).  A source is typically a source /
+    subscription, so we spread downloads across multiple servers when possible.
 
     The config_file is overwritten (in temp_dir) because only a singleton (for either
     standalone or daemon) should ever exist.  Because of this, and the daemon exiting via
@@ -694,10 +1841,15 @@ class DownloadManager(SqliteSupport):
         self._log = config.log
         self._config = config
         self._sources = {}  # map of source names to sources
-        self._index = 0  # used to round-robin sources
-        self._workers = Workers(config, config.arg(DOWNLOADWORKERS))
+        self._endpoints = {}  # map of dataselect URLs to endpoints (shared by sources)
+        self._fair_share = FairShare()
         self._n_downloads = 0
-        self._create_stats_table()
+        self._metrics = Metrics()
+        self._metrics_path = metrics_path(config)
+        self._metrics_epoch = 0
+        self._stats_path = stats_path(config)
+        self._stats_epoch = 0
+        self._stats = None  # the last stats published
         if config_file:
             # these aren't used to list subscriptions (when config_file is None)
             self._rover_cmd = check_cmd(config, ROVERCMD, 'rover')
@@ -705,9 +1857,32 @@ class DownloadManager(SqliteSupport):
             log_unique = config.arg(LOGUNIQUE) or not config.arg(DEV)
             log_verbosity = config.arg(LOGVERBOSITY) if config.arg(DEV) else min(config.arg(LOGVERBOSITY), 3)
             self._config_path = write_config(config, config_file, log_unique=log_unique, log_verbosity=log_verbosity)
+            self._update_stats(force=True)  # discard any from an earlier process
             self._start_web()
         else:
-            self._config_path = None
+            self._rover_cmd, self._config_path = None, None
+        self._workers = self._new_workers(config)
+        self._max_workers = config.arg(DOWNLOADWORKERS)
+        if config.arg(DOWNLOADADAPTIVE):
+            AdaptiveLimit(self._log, self._workers, config.arg(DOWNLOADWORKERSMIN), self._max_workers)
+
+    def _new_workers(self, config):
+        engine = config.arg(DOWNLOADENGINE).lower()
+        if engine == THREAD:
+            # each thread has its own downloader (and so database connection) which is
+            # re-used for every chunk, avoiding a new rover process per download
+            return ThreadWorkers(config, config.arg(DOWNLOADWORKERS), Downloader)
+        elif engine == POOL:
+            # a fixed set of 'rover worker' processes that each run many downloads
+            if windows():
+                command = 'pythonw -m rover -f %s %s' % (self._config_path, WORKER)
+            else:
+                command = '%s -f %s %s' % (self._rover_cmd, self._config_path, WORKER)
+            return PoolWorkers(config, config.arg(DOWNLOADWORKERS), command)
+        elif engine == SUBPROCESS:
+            return Workers(config, config.arg(DOWNLOADWORKERS))
+        else:
+            raise Exception('Unknown download engine "%s" (%s)' % (engine, mm(DOWNLOADENGINE)))
 
     # source management
 
@@ -722,12 +1897,23 @@ class DownloadManager(SqliteSupport):
             raise Exception('Unexpected source: %s' % name)
         return self._sources[name]
 
-    def add(self, name, request_path, fetch, availability_url, dataselect_url, completion_callback):
+    def add(self, name, request_path, fetch, availability_url, dataselect_url, completion_callback,
+            weight=1, max_workers=0, updated_after=None):
         # fetch is necessary here because source wants to prime days for retrieval
         if name in self._sources and self._sources[name].worker_count:
             raise Exception('Cannot overwrite active source %s' % self._sources[name])
         self._sources[name] = Source(self._config, name, fetch, request_path, availability_url, dataselect_url,
-                                     completion_callback)
+                                     completion_callback, metrics=self._metrics, weight=weight,
+                                     max_workers=max_workers, updated_after=updated_after,
+                                     endpoints=self._shared_endpoints(dataselect_url))
+
+    def _shared_endpoints(self, dataselect_url):
+        # sources that use the same dataselect services share the limit on downloads,
+        # the measured latency and the record of services that are down
+        key = tuple(split_urls(dataselect_url))
+        if key not in self._endpoints:
+            self._endpoints[key] = Endpoints(self._log, dataselect_url, self._config.arg(DATASELECTWORKERS))
+        return self._endpoints[key]
 
     # display expected downloads
 
@@ -767,22 +1953,6 @@ class DownloadManager(SqliteSupport):
 
     # downloading data and processing in the pipeline
 
-    def _has_data(self):
-        for source in self._sources.values():
-            if source.has_chunks():
-                return True
-        return False
-
-    def _next_source(self, sources):
-        self._index = (self._index + 1) % len(sources)
-        return sources[self._index]
-
-    def _has_least_workers(self, c):
-        for source in self._sources.values():
-            if source.worker_count < c.worker_count:
-                return False
-        return True
-
     def _clean_sources(self, quiet=True):
         names = list(self._sources.keys())
         for name in names:
@@ -795,6 +1965,7 @@ class DownloadManager(SqliteSupport):
                     raise
             if complete:
                 self._log.debug('Source %s complete' % self._source(name))
+                self._source(name).discard_plan()
                 del self._sources[name]
 
     def is_idle(self):
@@ -803,7 +1974,7 @@ class DownloadManager(SqliteSupport):
         """
         self._clean_sources()
         if not self._sources:
-            self._update_stats()  # wipe
+            self._update_stats(force=True)  # wipe
             return True
         else:
             return False
@@ -822,9 +1993,9 @@ class DownloadManager(SqliteSupport):
         A single iteration of the manager's main loop.  Can be inter-mixed with add().
         """
         # the logic here is a little opaque because we need to mix layers of abstraction to
-        # get the fine control we want for load balancing - we want to give jobs to whichever
-        # source has least threads running so that the total number of workers (and so total
-        # download bandwidth) is evenly spread across all servers.
+        # get the fine control we want for load balancing - we want to give jobs to sources in
+        # proportion to their weight (see FairShare) so that the total download bandwidth is
+        # spread fairly across all servers.
         # a consequence of that is that there's no "step()" for lower levels.  this is also
         # partly because all the work is done in a separate worker process.  instead, most of
         # the lower level logic is done in clean_sources() which checks and updates the sources
@@ -838,23 +2009,24 @@ class DownloadManager(SqliteSupport):
         self._clean_sources(quiet=quiet)
         # with that done, update the stats for teh web display
         self._update_stats()
+        self._publish_metrics()
         # before trying to find a suitable candidates for more work...
-        while self._workers.has_space() and self._has_data():
+        while self._workers.has_space():
             # the order of sources is sorted here so that we round-robin consistently
-            # (starting where we left off last time with self._index)
             sources = list(map(lambda name: self._source(name), sorted(self._sources.keys())))
-            while True:
-                # consider sources in turn
-                source = self._next_source(sources)
-                # are they deserving of an extra worker?
-                if self._has_least_workers(source):
-                    break
-            # todo - why is this check needed?  shouldn't this always succeed?
-            if source.has_chunks():
-                source.new_worker(self._workers, self._config_path, self._rover_cmd)
-                self._n_downloads += 1
+            source = self._fair_share.select(sources)
+            if not source:
+                self._workers.no_work()
+                break
+            self._fair_share.charge(source, source.new_worker(self._workers, self._config_path, self._rover_cmd))
+            self._n_downloads += 1
             # todo - does this do anything useful without a workers.check()?
             self._clean_sources(quiet=quiet)
+        # any workers still free (nothing left to start) can repeat slow downloads (if hedging)
+        for name in sorted(self._sources.keys()):
+            while self._workers.has_space() and \
+                    self._source(name).hedge(self._workers, self._config_path, self._rover_cmd):
+                pass
 
     def download(self):
         """
@@ -866,40 +2038,71 @@ class DownloadManager(SqliteSupport):
         try:
             while self._sources and not source.is_complete():
                 self.step(quiet=False)
-                sleep(0.1)
+                self.wait()
         finally:
             # not needed in normal use, as no workers when no sources, but useful on error
             self._workers.wait_for_all()
+            self._update_stats(force=True)
+            self._publish_metrics(force=True)
+        idle = self._workers.mean_idle_time()
+        if idle is not None:
+            self._log.info('Download slots were idle for %.1fms (average) between downloads' % (1000 * idle))
+        if self._metrics.total.chunks:
+            self._log.info('Download metrics written to %s' % self._metrics_path)
 
         return self._n_downloads
 
+    def wait(self, timeout=1):
+        """
+        Block until a download completes (so step() can start another), or the
+        timeout expires.  Returns immediately if no downloads are running.
+
+        If a source is still planning, that is continued instead (and we return
+        without blocking).
+        """
+        for source in self._sources.values():
+            if source.plan_ahead():
+                self._workers.check()
+                return
+        self._workers.wait(timeout=timeout)
+
     # stats for web display
 
-    def _create_stats_table(self):
-        self.execute('''CREATE TABLE IF NOT EXISTS rover_download_stats (
-                          submission text not null,
-                          initial_stations int not null,
-                          remaining_stations int not null,
-                          initial_time float not null,
-                          remaining_time float not null,
-                          n_retries int not null,
-                          download_retries int not null
-                        )''')
+    def _update_stats(self, force=False):
+        # progress is held in memory and published to a file (not the database, which would
+        # compete with the workers), only when it has changed, and at most every STATS_PERIOD
+        if not self._config_path or not (force or time() - self._stats_epoch > STATS_PERIOD):
+            return
+        stats = {}
+        for source in self._sources.values():
+            progress = source.stats()
+            stats[str(source.name)] = {
+                'initial_stations': progress.stations[1],
+                'remaining_stations': progress.stations[1] - progress.stations[0],
+                'initial_time': progress.seconds[1],
+                'remaining_time': max(0, int(progress.seconds[1] - progress.seconds[0])),
+                'n_retries': source.n_retries,
+                'download_retries': source.download_retries,
+                'concurrency': self._workers.limit,
+                'max_concurrency': self._max_workers,
+                'mean_idle_time': self._workers.mean_idle_time()}
+        self._stats_epoch = time()
+        if stats != self._stats:
+            try:
+                write_json(self._stats_path, stats)
+                self._stats = stats
+            except Exception as e:
+                self._log.warn('Could not write progress to %s: %s' % (self._stats_path, e))
 
-    def _update_stats(self):
-        with self._db:  # single transaction
-            self._db.cursor().execute('BEGIN')
-            self._db.execute('DELETE FROM rover_download_stats', tuple())
-            for source in self._sources.values():
-                progress = source.stats()
-                self._db.execute('''INSERT INTO rover_download_stats
-                                    (submission, initial_stations, remaining_stations, initial_time, remaining_time,
-                                     n_retries, download_retries)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                                 (source.name,
-                                  progress.stations[1], progress.stations[1] - progress.stations[0],
-                                  progress.seconds[1], max(0, int(progress.seconds[1] - progress.seconds[0])),
-                                  source.n_retries, source.download_retries))
+    def _publish_metrics(self, force=False):
+        # written to a file (rather than the database) to avoid contention with the workers
+        if self._metrics.total.chunks and (force or time() - self._metrics_epoch > METRICS_PERIOD):
+            self._metrics.record_idle(self._workers.idle_time, self._workers.idle_count)
+            try:
+                self._metrics.dump(self._metrics_path)
+            except Exception as e:
+                self._log.warn('Could not write metrics to %s: %s' % (self._metrics_path, e))
+            self._metrics_epoch = time()
 
     def _start_web(self):
         if windows():
@@ -0,0 +1,183 @@
+
+from bisect import bisect_left
+from collections import deque
+from time import time
+
+from .utils import write_json
+
+"""
+Throughput and latency metrics for downloads - per source, per endpoint and in total.
+
+These are collected by the download manager and published (periodically) as JSON so
+that `rover web` (and other tools) can display them.
+"""
+
+
+# the phases timed for each chunk (queue is the time between dispatch and the download starting)
+QUEUE, DOWNLOAD, INGEST, INDEX = 'queue', 'download', 'ingest', 'index'
+PHASES = (QUEUE, DOWNLOAD, INGEST, INDEX)
+
+# upper bounds (seconds) of the latency histogram buckets (there is a further, unbounded, bucket)
+LATENCY_BOUNDS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300)
+
+# rates are measured over this many seconds
+RATE_WINDOW = 60
+
+# the number of individual chunks included in the published metrics
+N_RECENT = 100
+
+
+class Histogram:
+    """
+    Counts of values in fixed buckets (so percentiles are approximate - the
+    upper bound of the bucket is returned).
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self._bounds, value)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.n:
+            return None
+        target, count = percent * self.n / 100.0, 0
+        for i, n in enumerate(self.counts):
+            count += n
+            if count >= target:
+                return self._bounds[i] if i < len(self._bounds) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.n,
+                'mean': self.total / self.n if self.n else None,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': list(zip(list(self._bounds) + [None], self.counts))}
+
+
+class RollingRate:
+    """
+    The rate (per second) of some quantity over the last RATE_WINDOW seconds.
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self._window = window
+        self._values = deque()  # (epoch, value)
+        self._start = None  # the first value (so early rates are not diluted by the full window)
+
+    def add(self, value, epoch=None):
+        epoch = time() if epoch is None else epoch
+        if self._start is None:
+            self._start = epoch
+        self._values.append((epoch, value))
+
+    def rate(self, epoch=None):
+        if self._start is None:
+            return 0
+        epoch = time() if epoch is None else epoch
+        while self._values and self._values[0][0] < epoch - self._window:
+            self._values.popleft()
+        period = max(0.001, min(self._window, epoch - self._start))
+        return sum(value for (_, value) in self._values) / period
+
+
+class MetricGroup:
+    """
+    Metrics for a group of chunks (a source, an endpoint, or all).
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latencies = dict((phase, Histogram()) for phase in PHASES)
+        self._byte_rate = RollingRate()
+        self._chunk_rate = RollingRate()
+
+    def record(self, returncode, byte_count, timings, epoch):
+        self.chunks += 1
+        if returncode:
+            self.errors += 1
+        self.bytes += byte_count
+        self._byte_rate.add(byte_count, epoch)
+        self._chunk_rate.add(1, epoch)
+        for phase in PHASES:
+            if phase in timings:
+                self.latencies[phase].add(timings[phase])
+
+    def as_dict(self, epoch=None):
+        return {'chunks': self.chunks,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'bytes_per_second': self._byte_rate.rate(epoch),
+                'chunks_per_second': self._chunk_rate.rate(epoch),
+                'latency': dict((phase, self.latencies[phase].as_dict()) for phase in PHASES)}
+
+
+class Metrics:
+    """
+    All metrics for the download manager.
+    """
+
+    def __init__(self):
+        self.total = MetricGroup()
+        self.sources = {}
+        self.endpoints = {}
+        self._recent = deque(maxlen=N_RECENT)
+        self._start = time()
+        self.idle_time = 0  # total seconds download slots were idle between downloads
+        self.idle_count = 0  # number of measurements in idle_time
+
+    def record(self, source, endpoint, description, dispatch_epoch, returncode, feedback):
+        """
+        Record the result of a chunk, given the feedback from the download (if any).
+        """
+        feedback = feedback or {}
+        epoch = time()
+        timings = dict(feedback.get('timings') or {})
+        if 'start_epoch' in feedback:
+            timings[QUEUE] = max(0, feedback['start_epoch'] - dispatch_epoch)
+        byte_count = feedback.get('download_byte_count', 0)
+        for group in (self.total,
+                      self.sources.setdefault(source, MetricGroup()),
+                      self.endpoints.setdefault(endpoint, MetricGroup())):
+            group.record(returncode, byte_count, timings, epoch)
+        self._recent.append({'source': source, 'endpoint': endpoint, 'chunk': description,
+                             'epoch': epoch, 'returncode': returncode, 'bytes': byte_count,
+                             'http_status': feedback.get('http_status'), 'sections': feedback.get('sections'),
+                             'files': len(feedback.get('files') or []), 'timings': timings})
+
+    def record_idle(self, idle_time, idle_count):
+        """
+        Record the (total) time download slots have been idle between downloads (see BaseWorkers).
+        """
+        self.idle_time, self.idle_count = idle_time, idle_count
+
+    def as_dict(self):
+        epoch = time()
+        return {'epoch': epoch,
+                'elapsed': epoch - self._start,
+                'total': self.total.as_dict(epoch),
+                'sources': dict((name, group.as_dict(epoch)) for (name, group) in self.sources.items()),
+                'endpoints': dict((url, group.as_dict(epoch)) for (url, group) in self.endpoints.items()),
+                'idle': {'seconds': self.idle_time,
+                         'count': self.idle_count,
+                         'mean': self.idle_time / self.idle_count if self.idle_count else None},
+                'recent': list(self._recent)}
+
+    def dump(self, path):
+        """
+        Write the metrics, as JSON, to the given path (replacing any existing file).
+        """
+        write_json(path, self.as_dict())
@@ -0,0 +1,83 @@
+
+from sqlite3 import Binary
+from struct import pack, unpack_from
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Timespans from the index stored as packed binary (little-endian float64 start, end
+pairs) in a table alongside tsindex, so that scans avoid parsing the timespans text.
+
+Rows are added after indexing (see Indexer).  Triggers delete the packed timespans
+for any tsindex row that is changed or deleted (eg by mseedindex, when a file is
+re-indexed), so a packed row is never out of date (missing rows are parsed as
+before).
+"""
+
+
+PACKED_TABLE = 'rover_packed_timespans'
+PACKED_TRIGGERS = ('rover_packed_timespans_delete', 'rover_packed_timespans_update')
+
+
+def pack_timespans(timespans):
+    """
+    Pack (start, end) pairs as bytes.
+    """
+    values = [epoch for timespan in timespans for epoch in timespan]
+    return Binary(pack('<%dd' % len(values), *values))
+
+
+def unpack_timespans(packed):
+    """
+    The (start, end) pairs packed in the bytes (read directly, via numpy, if available).
+    """
+    if np is not None:
+        values = np.frombuffer(packed, dtype='<f8')
+        return zip(values[0::2].tolist(), values[1::2].tolist())
+    values = unpack_from('<%dd' % (len(packed) // 8), packed)
+    return zip(values[0::2], values[1::2])
+
+
+def has_packed_timespans(db):
+    """
+    Are packed timespans available (and maintained by the triggers)?
+    """
+    return db.fetchsingle('''SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?)''',
+                          PACKED_TRIGGERS) == len(PACKED_TRIGGERS)
+
+
+def create_packed_table(db):
+    """
+    Create the table and triggers (tsindex must exist).
+    """
+    maintained = has_packed_timespans(db)
+    db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                     id integer primary key,
+                     packed blob not null
+                  )''' % PACKED_TABLE)
+    if not maintained:
+        # any existing rows may be out of date
+        db.execute('DELETE FROM %s' % PACKED_TABLE)
+        for (trigger, event) in zip(PACKED_TRIGGERS, ('DELETE', 'UPDATE')):
+            db.execute('''CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON tsindex
+                            BEGIN DELETE FROM %s WHERE id = old.rowid; END''' % (trigger, event, PACKED_TABLE))
+
+
+def select_timespans(db):
+    """
+    SQL for the timespans (text, and packed if available) from tsindex (aliased as t):
+    returns (columns, table) for use in 'SELECT ... columns FROM table'.
+
+    The text is NULL when packed timespans are available.
+    """
+    # coalesce replaces [...] with <...> based on start/endtime if timespans is missing
+    # (see coverage.BaseBuilder)
+    text = "coalesce(t.timespans, '<' || t.starttime || ' ' || t.endtime || '>')"
+    if has_packed_timespans(db):
+        return ('CASE WHEN p.packed IS NULL THEN %s END, p.packed' % text,
+                'tsindex t LEFT JOIN %s p ON p.id = t.rowid' % PACKED_TABLE)
+    else:
+        return '%s, NULL' % text, 'tsindex t'
@@ -4,7 +4,7 @@ from functools import reduce
 from re import sub, compile
 
 from .args import mm, FORCEREQUEST
-from .utils import parse_epoch
+from .utils import parse_epochs
 
 """
 Comparison of requests to check for overlap.
@@ -69,8 +69,8 @@ def overlapping_pair(pair1, pair2):
     # if they're both lower bounds, they must overlap
     if len(pair1) == 1 and len(pair2) == 1:
         return True
-    pair1 = list(map(parse_epoch, pair1))
-    pair2 = list(map(parse_epoch, pair2))
+    pair1 = parse_epochs(pair1)
+    pair2 = parse_epochs(pair2)
     # dates1 is a range
     if len(pair1) == 2:
         # dates2 is a lower bound?
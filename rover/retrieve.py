@@ -45,6 +45,18 @@ availability of remote data can be configured by the availability-url option,
 and URL controlling data downloads is configured by the dataselect-url
 option.
 
+The dataselect-url option can list several equivalent services (eg mirrors,
+or a local caching proxy), separated by commas.  Downloads are then spread
+across the services, favouring the fastest, with at most dataselect-workers
+running at each.  A service that fails repeatedly is avoided until it passes
+a health check, and downloads that failed there are retried elsewhere.
+
+Availability responses are cached in the temp-dir.  A cached response is
+used for availability-cache-ttl seconds and is then revalidated with the
+service (which returns only a short reply if nothing has changed, when it
+supports conditional requests).  The cache is limited to
+availability-cache-size MB.
+
 Use ROVER's list-index function to determine data available on a remote server
 which is not in the local repository.
 
@@ -52,7 +64,12 @@ which is not in the local repository.
 
 @temp-dir
 @availability-url
+@availability-shard
+@availability-workers
+@availability-cache-ttl
+@availability-cache-size
 @dataselect-url
+@dataselect-workers
 @timespan-tol
 @pre-index
 @ingest
@@ -62,6 +79,16 @@ which is not in the local repository.
 @mseedindex-cmd
 @data-dir
 @download-workers
+@download-adaptive
+@download-workers-min
+@download-engine
+@download-hedge
+@chunk-samples
+@chunk-order
+@resume
+@bulk-diff
+@coverage-engine
+@verify-full-every
 @download-retries
 @http-timeout
 @http-retries
@@ -98,6 +125,11 @@ data missing from ROVER's local repository.
 processes a command line request to download, ingest, and index
 data missing from ROVER's local repository.
 
+    rover retrieve IU_ANMO_00_BH1 2017-01-01 2017-01-04 --resume
+
+continues the same request after an interruption, without checking
+availability again.
+
 """
 
     def __init__(self, config):
@@ -5,7 +5,7 @@ from sqlite3 import OperationalError
 from .request import RequestComparison
 from .manager import DownloadManager
 from .args import SUBSCRIBE, LIST_SUBSCRIBE, UNSUBSCRIBE, SUBSCRIPTIONSDIR, AVAILABILITYURL, DATASELECTURL, DEV, \
-    FORCEREQUEST, mm, TRIGGER, VERBOSITY, NO, DELETEFILES, TEMPDIR
+    FORCEREQUEST, mm, TRIGGER, VERBOSITY, NO, DELETEFILES, TEMPDIR, SUBSCRIPTIONWEIGHT, SUBSCRIPTIONWORKERS
 from .sqlite import SqliteSupport, NoResult
 from .utils import unique_path, build_file, format_day_epoch, safe_unlink, format_time_epoch, log_file_contents, \
     fix_file_inplace
@@ -22,6 +22,31 @@ The 'rover list-subscriptions' command - display information about subscriptions
 SUBSCRIBEFILE = 'rover_subscribe'
 
 
+def create_subscriptions_table(db):
+    """
+    Create the subscriptions table (and add columns missing from earlier versions).
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS rover_subscriptions (
+                     id integer primary key autoincrement,
+                     file text unique,
+                     availability_url text not null,
+                     dataselect_url text not null,
+                     creation_epoch int default (cast(strftime('%s', 'now') as int)),
+                     last_check_epoch int default NULL,
+                     last_error_count int default 0,
+                     consistent int default 0,
+                     weight int default 1,
+                     max_workers int default 0,
+                     last_success_epoch int default NULL,
+                     last_full_epoch int default NULL
+    )''')
+    columns = [row[1] for row in db.fetchall('PRAGMA table_info(rover_subscriptions)')]
+    for column, default in (('weight', '1'), ('max_workers', '0'),
+                            ('last_success_epoch', 'NULL'), ('last_full_epoch', 'NULL')):
+        if column not in columns:
+            db.execute('ALTER TABLE rover_subscriptions ADD COLUMN %s int default %s' % (column, default))
+
+
 class Subscriber(SqliteSupport):
     """
 ### Subscribe
@@ -43,13 +68,16 @@ repository.
 @availability-url
 @dataselect-url
 @force-request
+@subscription-weight
+@subscription-workers
 @verbosity
 @log-dir
 @log-verbosity
 @temp-dir
 
 Most of the download process is controlled by the options provided when starting the service (see
-`rover start`).
+`rover start`).  The weight and worker limit are stored with the subscription and control how
+downloads are shared when several subscriptions are active.
 
 ##### Examples
 
@@ -63,6 +91,11 @@ NSLCs / timespans in the given file.
 will instruct the daemon to regularly download, ingest and index and data for IU.ANMO.00.BH1 between the given
 dates that are missing from the repository.
 
+    rover subscribe N_S_L_C.txt --subscription-weight 3 --subscription-workers 2
+
+will give the subscription three times the share of downloads of other subscriptions, but never more than
+two at once.
+
     """
 
     def __init__(self, config):
@@ -72,19 +105,9 @@ dates that are missing from the repository.
         self._availability_url = config.arg(AVAILABILITYURL)
         self._dataselect_url = config.arg(DATASELECTURL)
         self._temp_dir = config.dir(TEMPDIR)
-        self._create_table()
-
-    def _create_table(self):
-        self.execute('''CREATE TABLE IF NOT EXISTS rover_subscriptions (
-                           id integer primary key autoincrement,
-                           file text unique,
-                           availability_url text not null,
-                           dataselect_url text not null,
-                           creation_epoch int default (cast(strftime('%s', 'now') as int)),
-                           last_check_epoch int default NULL,
-                           last_error_count int default 0,
-                           consistent int default 0
-        )''')
+        self._weight = config.arg(SUBSCRIPTIONWEIGHT)
+        self._max_workers = config.arg(SUBSCRIPTIONWORKERS)
+        create_subscriptions_table(self)
 
     def _check_all_for_overlap(self, path1):
         rows = self.fetchall('''SELECT file FROM rover_subscriptions''')
@@ -117,8 +140,9 @@ dates that are missing from the repository.
             self._log.warn('Not checking for overlaps (%s) - may result in duplicate data in the repository' % (mm(FORCEREQUEST)))
         else:
             self._check_all_for_overlap(path)
-        self.execute('''INSERT INTO rover_subscriptions (file, availability_url, dataselect_url) VALUES (?, ?, ?)''',
-                     (path, self._availability_url, self._dataselect_url))
+        self.execute('''INSERT INTO rover_subscriptions (file, availability_url, dataselect_url, weight, max_workers)
+                          VALUES (?, ?, ?, ?, ?)''',
+                     (path, self._availability_url, self._dataselect_url, self._weight, self._max_workers))
         self._log.default('Subscribed')
 
 
@@ -210,13 +234,14 @@ will show what data would be downloaded by the daemon if the subscription were p
         count = [0]
 
         def callback(row):
-            id, file, availability_url, dataselect_url, creation_epoch, last_check_epoch = row
+            id, file, availability_url, dataselect_url, creation_epoch, last_check_epoch, weight, max_workers = row
             date = format_day_epoch(creation_epoch)
             try:
                 check = format_time_epoch(last_check_epoch)
             except TypeError:
                 check = 'never'
-            print('  %d created %s  checked %s' % (id, date, check))
+            print('  %d created %s  checked %s  weight %d%s' %
+                  (id, date, check, weight, '  max %d downloads' % max_workers if max_workers else ''))
             print('    %s' % file)
             print('    %s' % availability_url)
             print('    %s' % dataselect_url)
@@ -225,7 +250,8 @@ will show what data would be downloaded by the daemon if the subscription were p
 
         try:
 
-            self.foreachrow('''SELECT id, file, availability_url, dataselect_url, creation_epoch, last_check_epoch
+            self.foreachrow('''SELECT id, file, availability_url, dataselect_url, creation_epoch, last_check_epoch,
+                                      weight, max_workers
                                  FROM rover_subscriptions ORDER BY creation_epoch
                             ''', tuple(), callback, quiet=True)
         except OperationalError:
@@ -3,11 +3,17 @@ import datetime
 import time
 import re
 import codecs
+import json
+import errno
 
 from binascii import hexlify
 from hashlib import sha1
-from os import makedirs, stat, getpid, listdir, unlink, kill, name, rename, rmdir, strerror
-from os.path import dirname, exists, isdir, expanduser, abspath, join, realpath, getmtime
+from heapq import merge
+from itertools import islice
+from os import makedirs, stat, getpid, listdir, unlink, kill, name, rename, rmdir, strerror, environ, \
+    open as os_open, close, O_CREAT, O_EXCL, O_WRONLY
+from os.path import dirname, exists, isdir, expanduser, abspath, join, realpath, getmtime, getsize
+from shlex import split
 from shutil import move, copyfile
 from subprocess import Popen, check_output, STDOUT
 from sys import version_info
@@ -54,6 +60,43 @@ def safe_unlink(path):
             pass  # file still in use on windows
 
 
+def create_exclusive(path):
+    """
+    Atomically create an empty file, returning False if it already exists.
+    """
+    try:
+        close(os_open(path, O_CREAT | O_EXCL | O_WRONLY))
+        return True
+    except OSError as e:   # py2.7 no FileExistsError
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+
+
+def write_json(path, data):
+    """
+    Write data, as JSON, replacing any existing file (readers never see a partial file,
+    except on Windows, where the existing file must be deleted first).
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as output:
+        json.dump(data, output, indent=1, sort_keys=True)
+    if windows():
+        safe_unlink(path)
+    rename(tmp, path)
+
+
+def read_json(path):
+    """
+    Read data written by write_json (returns None if not available).
+    """
+    try:
+        with open(path, 'r') as input:
+            return json.load(input)
+    except (IOError, OSError, ValueError):
+        return None
+
+
 def check_cmd(config, param, name):
     """
     Check the command exists and, if not, inform the user.
@@ -96,23 +139,39 @@ def canonify_dir_and_make(path):
     return path
 
 
-def run(cmd, log, uncouple=False):
+def run(cmd, log, uncouple=False, env=None):
     """
     We can't use subprocess.run() because it doesn't exist for 2.7.
+
+    A list is run directly, without a shell.
     """
+    shell = not isinstance(cmd, list)
     log.debug('Running "%s"' % cmd)
     if uncouple:
         if version_info[0] >= 3:
-            Popen(cmd, shell=True, close_fds=True, start_new_session=True)
+            Popen(cmd, shell=shell, close_fds=True, start_new_session=True, env=env)
         else:
-            Popen(cmd, shell=True, close_fds=True)
+            Popen(cmd, shell=shell, close_fds=True, env=env)
     else:
-        process = Popen(cmd, shell=True)
+        process = Popen(cmd, shell=shell, env=env)
         process.wait()
         if process.returncode:
             raise Exception('Command "%s" failed' % cmd)
 
 
+def mseedindex_command(cmd, leap_file, *args):
+    """
+    Returns (command, env) to run mseedindex with the given leap second file.
+
+    Except on Windows, the command is a list and the leap second file is passed
+    in the environment, so no shell is started (which adds latency to each call).
+    """
+    if windows():
+        return 'set LIBMSEED_LEAPSECOND_FILE=%s && %s %s' % (leap_file, cmd, ' '.join(args)), None
+    else:
+        return split(cmd) + list(args), dict(environ, LIBMSEED_LEAPSECOND_FILE=leap_file)
+
+
 def check_leap(enabled, expire, file, url, timeout, retries, log):
     """
     Download a file if none exists or it is more than 3 months old.
@@ -207,7 +266,7 @@ def unique_path(dir, filename, salt):
     name = uniqueish(filename, salt)
     return unique_filename(join(dir, name))
 
-def _stream_output(request, down, unique=True):
+def stream_output(request, down, unique=True):
     # special case empty return.  this avoids handling empty files elsewhere
     # which isn't a 'serious' problem, but causes ugly logging
     if request.status_code == 204:
@@ -224,10 +283,10 @@ def _stream_output(request, down, unique=True):
         return down, request.raise_for_status
 
 
-def _session(retries):
+def http_session(retries):
     """
     Ugliness required by requests lib to set max retries.
-    (We don't really care about efficiency to the point where we need to re-use the session)
+    (Long-lived downloaders re-use the session so that connections are kept alive)
     """
     # https://stackoverflow.com/questions/21371809/cleanly-setting-max-retries-on-python-requests-get-or-post-method
     session = Session()
@@ -245,7 +304,7 @@ def _session(retries):
     return session
 
 
-def get_to_file(url, down, timeout, retries, log, unique=True):
+def get_to_file(url, down, timeout, retries, log, unique=True, session=None):
     """
     Execute an HTTP GET request, with output to a file.
 
@@ -256,11 +315,13 @@ def get_to_file(url, down, timeout, retries, log, unique=True):
     and the error exception.
     """
     log.info('Downloading %s from %s' % (down, url))
-    request = _session(retries).get(url, stream=True, timeout=timeout)
-    return _stream_output(request, down, unique=unique)
+    if not session:
+        session = http_session(retries)
+    request = session.get(url, stream=True, timeout=timeout)
+    return stream_output(request, down, unique=unique)
 
 
-def post_to_file(url, up, down, timeout, retries, log, unique=True):
+def post_to_file(url, up, down, timeout, retries, log, unique=True, session=None):
     """
     Execute an HTTP POST request, with output to a file.
 
@@ -273,8 +334,10 @@ def post_to_file(url, up, down, timeout, retries, log, unique=True):
     up = canonify(up)
     log.info('Downloading %s from %s with %s' % (down, url, up))
     with open(up, 'rb') as input:
-        request = _session(retries).post(url, stream=True, data=input, timeout=timeout)
-    return _stream_output(request, down, unique=unique)
+        if not session:
+            session = http_session(retries)
+        request = session.post(url, stream=True, data=input, timeout=timeout)
+    return stream_output(request, down, unique=unique)
 
 
 def clean_old_files(dir, age_secs, match, log):
@@ -402,12 +465,67 @@ def format_time_epoch_local(epoch):
     return datetime.datetime.strftime(dt, '%Y-%m-%dT%H:%M:%S')
 
 
+# days since the epoch, for dates seen recently (most timestamps share a few dates)
+_EPOCH_DAYS = {}
+_MAX_EPOCH_DAYS = 10000
+
+
+def _epoch_days(date):
+    days = _EPOCH_DAYS.get(date)
+    if days is None:
+        if not (date[4] == '-' and date[7] == '-' and date[:4].isdigit() and date[5:7].isdigit() and
+                date[8:10].isdigit()):
+            raise ValueError(date)
+        days = datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10])).toordinal() - EPOCH.toordinal()
+        if len(_EPOCH_DAYS) >= _MAX_EPOCH_DAYS:
+            _EPOCH_DAYS.clear()
+        _EPOCH_DAYS[date] = days
+    return days
+
+
 def parse_epoch(date):
     """
     Parse a date in the standard formats
     """
     if date.endswith('Z'):
         date = date[:-1]
+    # the fixed-width formats used by web services (and ROVER) are parsed directly,
+    # with the same result as the general case below
+    try:
+        n = len(date)
+        if n == 10 or (n in (16, 19) or 21 <= n <= 26) and date[10] == 'T':
+            seconds, micros = 86400 * _epoch_days(date[:10]), 0
+            if n > 10:
+                if date[13] != ':' or not (date[11:13].isdigit() and date[14:16].isdigit()):
+                    raise ValueError(date)
+                hours, minutes = int(date[11:13]), int(date[14:16])
+                if hours > 23 or minutes > 59:
+                    raise ValueError(date)
+                seconds += 3600 * hours + 60 * minutes
+            if n > 16:
+                if date[16] != ':' or not date[17:19].isdigit() or int(date[17:19]) > 59:
+                    raise ValueError(date)
+                seconds += int(date[17:19])
+            if n > 19:
+                if date[19] != '.' or not date[20:].isdigit():
+                    raise ValueError(date)
+                micros = int(date[20:].ljust(6, '0'))
+            # as timedelta.total_seconds()
+            return (seconds * 10**6 + micros) / 1e6
+    except ValueError:
+        pass
+    return _parse_epoch(date)
+
+
+def parse_epochs(dates):
+    """
+    Parse a sequence of dates (eg a column from a file), returning a list of epochs.
+    """
+    return list(map(parse_epoch, dates))
+
+
+def _parse_epoch(date):
+    # the general case - any of the standard formats, with fields of any width
     try:
         dt = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f')
     except ValueError:
@@ -472,36 +590,112 @@ def build_file(log, path, args):
         print(' '.join(parts), file=req)
 
 
-def sort_file_inplace(log, path, temp_dir, sort_in_python):
+# the number of lines sorted at once in python (larger files are sorted in runs that are merged)
+SORT_LINES = 1000000
+
+
+def _is_sorted(lines):
+    previous = None
+    for line in lines:
+        if previous is not None and line < previous:
+            return False
+        previous = line
+    return True
+
+
+class SortedFile:
     """
-    Sort file using UNIX command line utility.
+    The lines of one or more files, merged in (byte) order, read using bounded
+    memory.  The files themselves are not changed and iterating again repeats
+    the lines.
+
+    A file that is already sorted (typically the case for web service responses)
+    is read directly.  Otherwise it is sorted, using the OS sort command (unless
+    sort_in_python) or in python: blocks of lines are sorted in memory and saved
+    as runs (a block that is already sorted is instead read from the file), and
+    the runs are merged as the lines are read.
+
+    Lines are returned without line endings.  Call close() to delete the runs.
     """
-    done = False
-    try:
+
+    def __init__(self, log, paths, temp_dir, sort_in_python, max_lines=SORT_LINES):
+        self._log = log
+        self.paths = paths
+        self._temp_dir = temp_dir
+        self._max_lines = max_lines
+        self._segments = []  # (path, start, end) offsets of sorted lines within the files
+        self._runs = []  # temporary files of sorted lines
+        try:
+            for path in paths:
+                self._sort(path, sort_in_python)
+        except:
+            self.close()
+            raise
+
+    def _sort(self, path, sort_in_python):
+        with open(path, 'rb') as input:
+            if _is_sorted(line.rstrip(b'\r\n') for line in input):
+                self._log.debug('%s is already sorted' % path)
+                self._segments.append((path, 0, getsize(path)))
+                return
         if not sort_in_python:
-            _os_sort(log, path, temp_dir)
-            done = True
-    except Exception as e:
-        log.warn('OS sorting failed (%s) using python fallback' % e)
-    if not done:
-        _python_sort(log, path)
-
-
-def _python_sort(log, path):
-    log.debug('Sorting %s in memory' % path)
-    with open(path, 'r') as source:
-        lines = source.readlines()
-    with open(path, 'w') as dest:
-        for line in sorted(lines):
-            print(line.rstrip(), file=dest)
-
-
-def _os_sort(log, path, temp_dir):
-    sorted_path = unique_path(temp_dir, 'rover_sort', path)
-    log.debug('Sorting %s into %s' % (path, sorted_path))
-    run('sort %s > %s' % (path, sorted_path), log)
-    safe_unlink(path)
-    move(sorted_path, path)
+            try:
+                self._os_sort(path)
+                return
+            except Exception as e:
+                self._log.warn('OS sorting failed (%s) using python fallback' % e)
+        self._python_sort(path)
+
+    def _new_run(self, path):
+        run = unique_path(self._temp_dir, 'rover_sort', path)
+        self._runs.append(run)
+        return run
+
+    def _os_sort(self, path):
+        sorted_path = self._new_run(path)
+        self._log.debug('Sorting %s into %s' % (path, sorted_path))
+        # the C locale gives the same (byte) order as the database (see bulk-diff)
+        run('sort %s > %s' % (path, sorted_path), self._log, env=dict(environ, LC_ALL='C'))
+
+    def _python_sort(self, path):
+        self._log.debug('Sorting %s in runs of %d lines' % (path, self._max_lines))
+        start = 0
+        with open(path, 'rb') as input:
+            while True:
+                lines = list(islice(input, self._max_lines))
+                if not lines:
+                    break
+                end = start + sum(len(line) for line in lines)
+                lines = [line.rstrip(b'\r\n') for line in lines]
+                if _is_sorted(lines):
+                    self._segments.append((path, start, end))
+                else:
+                    lines.sort()
+                    with open(self._new_run(path), 'wb') as output:
+                        for line in lines:
+                            output.write(line + b'\n')
+                start = end
+
+    def _read(self, path, start=0, end=None):
+        with open(path, 'rb') as input:
+            input.seek(start)
+            for line in input:
+                if end is not None:
+                    if start >= end:
+                        return
+                    start += len(line)
+                yield line.rstrip(b'\r\n')
+
+    def __iter__(self):
+        sources = [self._read(path, start, end) for (path, start, end) in self._segments] + \
+                  [self._read(run) for run in self._runs]
+        for line in (sources[0] if len(sources) == 1 else merge(*sources)):
+            yield line.decode('utf-8')
+
+    def close(self):
+        for run in self._runs:
+            safe_unlink(run)
+        self._runs = []
 
 
 def process_exists(pid):
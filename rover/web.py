@@ -1,4 +1,5 @@
 
+import json
 import os
 from sqlite3 import OperationalError
 from threading import Thread
@@ -7,10 +8,12 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from .manager import INCONSISTENT, UNCERTAIN
 from .args import HTTPBINDADDRESS, HTTPPORT, RETRIEVE, DAEMON, WEB
+from .config import metrics_path, stats_path
 from .download import DEFAULT_NAME
+from .metrics import DOWNLOAD, QUEUE
 from .process import ProcessManager
-from .sqlite import SqliteSupport, NoResult
-from .utils import process_exists, format_time_epoch, format_time_epoch_local, safe_unlink
+from .sqlite import SqliteSupport
+from .utils import process_exists, format_time_epoch, format_time_epoch_local, safe_unlink, read_json
 
 """
 The 'rover web' command - run a web service that displays information on the download manager.
@@ -56,7 +59,11 @@ class RequestHandler(BaseHTTPRequestHandler):
         This method is called when the server receives a GET request.
 
         We detect what is running and generate the appropriate response.
+        The path /metrics returns the download metrics as JSON.
         """
+        if self.path.rstrip('/') == '/metrics':
+            self._do_metrics()
+            return
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
@@ -71,6 +78,17 @@ class RequestHandler(BaseHTTPRequestHandler):
             self._do_quiet()
         self._html_footer()
 
+    def _do_metrics(self):
+        metrics = read_json(self.server.metrics_path)
+        if metrics is None:
+            self.send_response(404)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self._write(json.dumps(metrics, indent=1, sort_keys=True))
+
     def _write(self, text):
         self.wfile.write(text.encode('ascii'))
 
@@ -126,24 +144,51 @@ Last active: %s (%s local)</pre></p>''' %
             pass
         if not count[0]:
             self._write('<p>No subscriptions</p>')
+        self._write_metrics()
         self._write_explanation()
 
     def _do_retrieve(self):
         self._write('<h2>Retrieval Progress</h2>')
         self._write_progress(DEFAULT_NAME, None, None, None)
+        self._write_metrics()
         self._write_explanation()
 
+    def _write_metrics(self):
+        metrics = read_json(self.server.metrics_path)
+        if not metrics:
+            return
+        self._write('<h2>Throughput</h2><p><pre>\n')
+        self._write('%-40s %8s %7s %10s %10s %10s %10s\n' %
+                    ('', 'chunks', 'errors', 'MB/s', 'p50 (s)', 'p90 (s)', 'queue (s)'))
+        rows = [('Total', metrics['total'])] + \
+               [('Source %s' % name, group) for (name, group) in sorted(metrics['sources'].items())] + \
+               [(url, group) for (url, group) in sorted(metrics['endpoints'].items())]
+        for label, group in rows:
+            download, queue = group['latency'][DOWNLOAD], group['latency'][QUEUE]
+            self._write('%-40s %8d %7d %10.3f %10s %10s %10s\n' %
+                        (label[:40], group['chunks'], group['errors'], group['bytes_per_second'] / 1e6,
+                         self._format_seconds(download['p50']), self._format_seconds(download['p90']),
+                         self._format_seconds(queue['mean'])))
+        self._write('</pre></p>')
+        self._write('<p>Full metrics (JSON): <a href="/metrics">/metrics</a></p>')
+
+    @staticmethod
+    def _format_seconds(seconds):
+        return '-' if seconds is None else '%.2f' % seconds
+
     def _write_progress(self, name, last_check_epoch, last_error_count, consistent):
-        try:
-            initial_stations, remaining_stations, initial_time, remaining_time, n_retries, download_retries = \
-                self.server.fetchone('''SELECT initial_stations, remaining_stations, initial_time, remaining_time,
-                                               n_retries, download_retries
-                                          FROM rover_download_stats WHERE submission = ?''', (name,))
-            self._write('<p>Progress for download attempt %d of %d:<pre>\n' % (n_retries, download_retries))
-            self._write_bar('stations', initial_stations, remaining_stations)
-            self._write_bar('timespan', initial_time, remaining_time)
+        stats = (read_json(self.server.stats_path) or {}).get(str(name))
+        if stats:
+            self._write('<p>Progress for download attempt %d of %d:<pre>\n' %
+                        (stats['n_retries'], stats['download_retries']))
+            self._write_bar('stations', stats['initial_stations'], stats['remaining_stations'])
+            self._write_bar('timespan', stats['initial_time'], stats['remaining_time'])
             self._write('</pre></p>')
-        except NoResult:
+            self._write('<p>Parallel downloads: %d (maximum %d)</p>' % (stats['concurrency'], stats['max_concurrency']))
+            if stats.get('mean_idle_time') is not None:
+                self._write('<p>Download slots idle between downloads: %.1fms (average)</p>' %
+                            (1000 * stats['mean_idle_time']))
+        else:
             if last_error_count:
                 self._write('<p>Inactive.  WARNING: Last download had errors, so data may be incomplete.</p>')
             elif last_check_epoch:
@@ -157,8 +202,6 @@ Last active: %s (%s local)</pre></p>''' %
                     self._write('<p>Inactive.  Latest download had no errors.</p>')
             else:
                 self._write('<p>Inactive.  Waiting for initial download.</p>')
-        except OperationalError:
-            self._write('<p>Error: no statistics in database.</p>')
 
     def _write_bar(self, label, initial, current):
         # there's some massaging of numbers here because the seconds might not match exactly
@@ -175,6 +218,9 @@ Last active: %s (%s local)</pre></p>''' %
 <li>Progress values are based on data still to be downloaded; they do not include data within the pipeline.</li>
 <li>The stations statistic is the number of distinct Net_Sta that will be requested.</li>
 <li>The timespan statistic is the total time (s) covered by the data in the downloads.</li>
+<li>Parallel downloads vary during retrieval when download-adaptive is set.</li>
+<li>Throughput is measured over the last minute; latencies (p50, p90) are for the download phase and are approximate;
+queue is the mean time between a download being scheduled and starting.</li>
 <li>Firefox will not open file:// URLs, but you can copy them to the address bar, where they will work.</li>
 </ul>
 ''')
@@ -192,6 +238,8 @@ class Server(HTTPServer, SqliteSupport):
         HTTPServer.__init__(self, address, handler)
         SqliteSupport.__init__(self, config)
         self.process_manager = ProcessManager(config)
+        self.metrics_path = metrics_path(config)
+        self.stats_path = stats_path(config)
 
 
 class ServerStarter:
@@ -209,6 +257,11 @@ manager. ROVER's default configuration starts `rover web` automatically.
 The flag`--no-web` prevents ROVER's web server from launching in accordance
 with `rover retrieve`.
 
+The page also shows download metrics (throughput and latency for each source
+and dataselect endpoint, and how long download slots stand idle between
+downloads).  The full metrics are available as JSON from the
+`/metrics` path, and are written to `rover_metrics.json` in the temp-dir.
+
 ##### Significant Options
 
 @web
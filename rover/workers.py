@@ -1,17 +1,204 @@
+import atexit
 import json
 import os
+import signal
 
-from subprocess import Popen
-from time import sleep
+from queue import Queue, Empty
+from subprocess import Popen, PIPE
+from threading import Thread
+from time import time
 
-from .args import TEMPDIR
-from .utils import uniqueish, unique_filename
+from .args import ERROR_CODE
+from .utils import windows
 
 """
-Support for running multiple sub-processes.
+Support for running multiple sub-processes (or, for downloads, in-process threads
+or a pool of long-lived worker processes).
 """
 
-class Workers:
+
+# values for the download-engine option
+SUBPROCESS, THREAD, POOL = 'subprocess', 'thread', 'pool'
+
+# processes started by popen() that have not yet been seen to exit
+_processes = set()
+
+
+def popen(command, **kwargs):
+    """
+    Start a process in its own process group (except on Windows), so that kill() stops
+    the command and anything it starts (with shell=True, the process is the shell).
+    """
+    if not windows():
+        kwargs['preexec_fn'] = os.setpgrp
+    process = Popen(command, **kwargs)
+    _processes.add(process)
+    return process
+
+
+def kill(process):
+    """
+    Kill a process started by popen() (and its process group), returning whether it was running.
+    """
+    _processes.discard(process)
+    try:
+        if windows():
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+        return True
+    except OSError:
+        return False  # already exited
+
+
+@atexit.register
+def _kill_all():
+    # processes in their own group do not see ctrl-C, so are killed explicitly on exit
+    for process in list(_processes):
+        kill(process)
+
+
+class BaseWorkers:
+    """
+    Common support for the classes below.  Completed jobs are reported (from
+    background threads) on a queue, so that the caller can block until a slot
+    is free, rather than polling.
+
+    Subclasses call _started() when a job starts, put a result on the queue
+    when a job ends, and implement _completed() to handle that result (which
+    happens in the caller's thread).  They may also implement _stop() to
+    cancel a running job.
+
+    We also track how long slots stand idle between one job finishing and the
+    next starting (a measure of how well the caller keeps the workers busy).
+    Only delays in starting work that is waiting are measured: the caller calls
+    no_work() when it has nothing to start, and slots removed by reducing the
+    limit are dropped.
+    """
+
+    def __init__(self, config, n_workers):
+        self._log = config.log
+        self._n_workers = n_workers
+        self._running = 0
+        self._results = Queue()
+        self._freed = []  # times at which slots became free
+        self.idle_time = 0  # total seconds slots were idle between jobs
+        self.idle_count = 0  # number of measurements in idle_time
+        self.monitor = None  # called with (returncode, feedback) for each completed job
+        self._cancelled = set()  # names of cancelled jobs (not passed to the monitor)
+
+    def _started(self):
+        if self._freed:
+            self.idle_time += time() - self._freed.pop(0)
+            self.idle_count += 1
+        self._running += 1
+
+    def _completed(self, result):
+        raise NotImplementedError()
+
+    def _complete(self, result):
+        self._running -= 1
+        self._freed.append(time())
+        self._completed(result)
+
+    def _wait_for_space(self):
+        self.check()
+        while not self.has_space():
+            self.wait()
+        self._log.debug('Space for new job (%d/%d)' % (self._running, self._n_workers))
+
+    def has_space(self):
+        return self._running < self._n_workers
+
+    def set_limit(self, n_workers):
+        """
+        Change the number of jobs that can run at once (running jobs are not affected).
+        """
+        self._n_workers = n_workers
+        # slots beyond the limit will not be re-used (drop the oldest)
+        excess = len(self._freed) - max(0, n_workers - self._running)
+        if excess > 0:
+            del self._freed[:excess]
+
+    def no_work(self):
+        """
+        Called when the caller has nothing to start, so free slots are waiting for work
+        (not for the caller) and are not counted as idle.
+        """
+        self._freed = []
+
+    @property
+    def limit(self):
+        return self._n_workers
+
+    def _default_callback(self, name, returncode, **kwargs):
+        if returncode:
+            raise Exception('"%s" returned %d' % (name, returncode))
+        else:
+            self._log.debug('"%s" succeeded' % (name,))
+
+    def _callback(self, name, returncode, callback, feedback):
+        self._log.debug('Calling callback %s (job %s)' % (callback, name))
+        if str(name) in self._cancelled:
+            self._cancelled.discard(str(name))
+        elif self.monitor:
+            self.monitor(returncode, feedback)
+        if feedback:
+            callback(name, returncode, feedback=feedback)
+        else:
+            callback(name, returncode)
+
+    def cancel(self, name):
+        """
+        Cancel the named job, if possible, returning whether it was stopped.  The
+        callback is still called when the job ends (perhaps with an error), but
+        the result is not monitored.
+        """
+        self._cancelled.add(name)
+        return self._stop(name)
+
+    def _stop(self, name):
+        return False
+
+    def check(self):
+        """
+        Handle any completed jobs (without blocking).
+        """
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except Empty:
+                return
+            self._complete(result)
+
+    def wait(self, timeout=None):
+        """
+        Block until a job completes (or the timeout, in seconds, expires) and then
+        handle all completed jobs.  Returns immediately if nothing is running.
+        """
+        if self._running:
+            try:
+                self._complete(self._results.get(timeout=timeout))
+            except Empty:
+                pass
+        self.check()
+
+    def wait_for_all(self):
+        """
+        Wait for all remaining jobs to finish.
+        """
+        while self._running:
+            self.wait()
+        self._log.debug('No jobs remain')
+
+    def mean_idle_time(self):
+        """
+        Average time (seconds) between a slot being freed and re-used (or None).
+        """
+        return self.idle_time / self.idle_count if self.idle_count else None
+
+
+class Workers(BaseWorkers):
     """
     A collection of processes that run asynchronously.  Note that the Python
     code here does NOT run asynchonously - it will block if there are no free
@@ -19,93 +206,299 @@ class Workers:
 
     The idea is that (for example) we run N mseedindex processes in the background
     so that we are not waiting on them to complete.
+
+    A thread per process waits for it to exit, so completion is signalled
+    immediately (and portably), without polling.  If feedback is requested,
+    the process's stdout (a single JSON dictionary) is read by the same thread
+    through a pipe.
+
+    Cancelling a job kills the process, including (for shell commands) the
+    command run by the shell.
     """
 
     def __init__(self, config, n_workers):
-        self._temp_dir = config.dir(TEMPDIR)
-        self._log = config.log
-        self._n_workers = n_workers
-        self._workers = []  # (command, popen, callback)
+        super().__init__(config, n_workers)
+        self._processes = {}  # command -> process
 
-    def execute(self, command, callback=None, feedback=None):
+    def execute(self, command, callback=None, feedback=None, env=None):
         """
-        Execute the command in a separate process.
+        Execute the command in a separate process.  A list is run directly,
+        without a shell.
         """
         self._wait_for_space()
 
         if not callback:
             callback = self._default_callback
 
-        if feedback:
-            name = uniqueish('rover_worker_feedback', command)
-            filename = unique_filename(os.path.join(self._temp_dir, name))
+        self._log.debug('Adding worker for "%s" (callback %s)' % (command, callback))
+        process = self._popen(command, feedback=feedback, env=env)
+        self._processes[str(command)] = process
+        self._started()
+        thread = Thread(target=self._wait_for_process, args=(command, process, callback, feedback))
+        thread.daemon = True
+        thread.start()
 
+    def _wait_for_process(self, command, process, callback, feedback):
+        output, _ = process.communicate()
+        self._results.put((command, process, callback, output if feedback else None))
+
+    def _completed(self, result):
+        command, process, callback, output = result
+        _processes.discard(process)
+        if self._processes.get(str(command)) is process:
+            del self._processes[str(command)]
+        process_feedback = {}
+        if output:
             try:
-                feedback = open (filename, 'w+')
+                process_feedback = json.loads(output)
             except Exception as ex:
-                raise Exception('Cannot open feedback file: %s' % ex)
+                self._log.error('Error processing feedback: %s, contents: %s' % (ex, output))
+        self._callback(command, process.returncode, callback, process_feedback)
 
-        self._log.debug('Adding worker for "%s" (callback %s)' % (command, callback))
-        self._workers.append((command, self._popen(command, feedback=feedback), callback, feedback))
+    def _stop(self, name):
+        process = self._processes.get(name)
+        return bool(process) and kill(process)
 
-    def _wait_for_space(self):
-        while True:
-            self.check()
-            if self.has_space():
-                self._log.debug('Space for new worker (%d/%d)' % (len(self._workers), self._n_workers))
-                return
-            sleep(0.1)
+    def _popen(self, command, feedback=None, env=None):
+        return popen(command, shell=not isinstance(command, list), stdout=PIPE if feedback else None, env=env,
+                     universal_newlines=True)
 
-    def has_space(self):
-        return len(self._workers) < self._n_workers
 
-    def _default_callback(self, cmd, returncode, **kwargs):
-        if returncode:
-            raise Exception('"%s" returned %d' % (cmd, returncode))
-        else:
-            self._log.debug('"%s" succeeded' % (cmd,))
+class ThreadWorkers(BaseWorkers):
+    """
+    A collection of long-lived threads that run jobs in-process.  This has the
+    same interface as Workers (execute / check / wait / has_space / wait_for_all)
+    so that the download manager can use either.
 
-    def check(self):
-        for idx, worker in enumerate(self._workers):
-            command, process, callback, feedback = worker
+    Each thread calls factory() once, with its own copy of the configuration
+    (so its own database connection), and then passes the result to every job
+    it runs.  This keeps expensive state (checked commands, leap seconds,
+    HTTP sessions) warm between jobs.
 
-            process.poll()
-            if process.returncode is not None:
+    A job is a callable that takes the per-thread context and returns a
+    (possibly empty) feedback dictionary.  Exceptions are logged and reported
+    to the callback as a non-zero return code.  Running jobs cannot be cancelled.
+    """
 
-                # Remove finished worker from list
-                del self._workers[idx]
+    def __init__(self, config, n_workers, factory):
+        super().__init__(config, n_workers)
+        self._config = config
+        self._factory = factory
+        self._jobs = Queue()
+        self._threads = []
 
-                self._log.debug('Calling callback %s (command %s)' % (callback, command))
+    def execute(self, job, callback=None, name=None):
+        """
+        Queue the job for the next free thread.
+        """
+        self._wait_for_space()
+        if not callback:
+            callback = self._default_callback
+        if not name:
+            name = str(job)
+        if len(self._threads) < self._n_workers:
+            self._start_thread()
+        self._log.debug('Adding job for "%s" (callback %s)' % (name, callback))
+        self._started()
+        self._jobs.put((name, job, callback))
 
-                process_feedback = {}
-                if feedback:
-                    try:
-                        feedback.seek(0, 0)
-                        feedback_data = feedback.read()
+    def _start_thread(self):
+        thread = Thread(target=self._run_thread)
+        thread.daemon = True   # don't block exit on ctrl-C
+        thread.start()
+        self._threads.append(thread)
 
-                        if len(feedback_data) > 0:
-                            process_feedback = json.loads(feedback_data)
-                    except Exception as ex:
-                        self._log.error('Error processing feedback file: %s, contents: %s' % (ex, feedback_data))
-                    finally:
-                        feedback.close()
-                        os.remove(feedback.name)
+    def _run_thread(self):
+        from .config import clone_config   # avoid import loop
+        context = None
+        while True:
+            name, job, callback = self._jobs.get()
+            try:
+                if context is None:
+                    context = self._factory(clone_config(self._config))
+                feedback = job(context)
+                self._results.put((name, 0, callback, feedback))
+            except Exception as e:
+                self._log.error('"%s" failed: %s' % (name, e))
+                self._results.put((name, ERROR_CODE, callback, getattr(e, 'feedback', None)))
 
-                if process_feedback:
-                    callback(command, process.returncode, feedback=process_feedback)
-                else:
-                    callback(command, process.returncode)
+    def _completed(self, result):
+        name, returncode, callback, feedback = result
+        self._callback(name, returncode, callback, feedback)
 
-    def wait_for_all(self):
+
+class PoolWorkers(BaseWorkers):
+    """
+    A pool of long-lived worker processes (see 'rover worker') that each run
+    many jobs.  This has the same interface as ThreadWorkers.
+
+    A job is a dictionary that is sent to a free worker as a single line of
+    JSON on stdin.  The worker replies with a single line of JSON on stdout,
+    containing the return code and feedback (which includes per-phase timings).
+    A reader thread per process queues replies, so check() never blocks.
+
+    Processes are started as needed (up to n_workers) using the given shell
+    command.  A process that exits unexpectedly fails its current job and is
+    replaced when next needed.  Processes exit when their stdin is closed
+    (including when this process exits).  Cancelling a job kills its process
+    (and the command run by the shell).
+    """
+
+    def __init__(self, config, n_workers, command):
+        super().__init__(config, n_workers)
+        self._command = command
+        self._idle = []  # processes waiting for a job
+        self._busy = {}  # process -> (name, callback)
+
+    def execute(self, job, callback=None, name=None):
         """
-        Wait for all remaining processes to finish.
+        Send the job to a free worker process.
         """
-        while True:
-            self.check()
-            if not self._workers:
-                self._log.debug('No workers remain')
-                return
-            sleep(0.1)
+        self._wait_for_space()
+        if not callback:
+            callback = self._default_callback
+        if not name:
+            name = str(job)
+        process = self._idle.pop() if self._idle else self._start_process()
+        self._log.debug('Sending job for "%s" to worker %d (callback %s)' % (name, process.pid, callback))
+        self._busy[process] = (name, callback)
+        self._started()
+        try:
+            process.stdin.write(json.dumps(job) + '\n')
+            process.stdin.flush()
+        except Exception as e:
+            self._log.error('Cannot send job to worker %d: %s' % (process.pid, e))
+            self._results.put((process, None))  # treat as exited
+
+    def _start_process(self):
+        self._log.debug('Starting worker process "%s"' % self._command)
+        process = popen(self._command, shell=True, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        thread = Thread(target=self._read_process, args=(process,))
+        thread.daemon = True
+        thread.start()
+        return process
+
+    def _stop(self, name):
+        for process, (busy_name, _) in self._busy.items():
+            if busy_name == name:
+                return kill(process)
+        return False
+
+    def _read_process(self, process):
+        for line in iter(process.stdout.readline, ''):
+            self._results.put((process, line))
+        self._results.put((process, None))  # eof
+
+    def _complete(self, result):
+        # only replies from busy processes complete a job
+        process, line = result
+        if process in self._busy:
+            super()._complete(result)
+        elif line is None:
+            self._exited(process)
+        else:
+            self._log.warn('Unexpected output from worker %d: %s' % (process.pid, line.strip()))
+
+    def _completed(self, result):
+        process, line = result
+        name, callback = self._busy.pop(process)
+        if line is None:
+            self._exited(process)
+            log = self._log.debug if name in self._cancelled else self._log.error
+            log('Worker %d exited (return code %d) while running "%s"' % (process.pid, process.returncode, name))
+            self._callback(name, process.returncode if process.returncode else ERROR_CODE, callback, None)
+        else:
+            self._idle.append(process)
+            try:
+                reply = json.loads(line)
+                returncode, feedback = reply['returncode'], reply.get('feedback')
+            except Exception as e:
+                self._log.error('Bad reply from worker %d (%s): %s' % (process.pid, e, line.strip()))
+                returncode, feedback = ERROR_CODE, None
+            self._callback(name, returncode, callback, feedback)
+
+    def _exited(self, process):
+        process.wait()
+        _processes.discard(process)
+        if process in self._idle:
+            self._idle.remove(process)
+
+
+# http responses that suggest the server is overloaded
+CONGESTION_STATUS = (429, 503, 504)
+# a round whose mean download time exceeds the lowest seen by this factor suggests queuing
+LATENCY_FACTOR = 2
+
+
+class AdaptiveLimit:
+    """
+    Adjust the number of jobs that workers run at once, between minimum and
+    maximum, using additive-increase / multiplicative-decrease (as TCP does).
+
+    The feedback from each download is monitored.  A failure with a status that
+    indicates congestion (429, 503, 504) or no status at all (eg a timeout)
+    halves the limit.  Otherwise, after each "round" (as many completed jobs as
+    the limit), the total download rate is compared with the previous round, and
+    the mean download time (from the feedback timings) with the lowest mean seen
+    for any round: if the rate has fallen (by more than 10%) the limit is reduced
+    by one; if the time has risen (by more than LATENCY_FACTOR) and the rate has
+    not improved, the limit is also reduced by one; otherwise it is increased by
+    one.  So the limit falls when the service starts queuing requests, but not
+    when longer downloads are simply sharing a link that still delivers more.
+    """
+
+    def __init__(self, log, workers, minimum, maximum):
+        self._log = log
+        self._workers = workers
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._workers.set_limit(self._minimum)
+        self._workers.monitor = self.observe
+        self._previous_rate = None
+        self._min_latency = None  # lowest mean download time for a round
+        self._reduced = False
+        self._start_round()
+
+    def _start_round(self):
+        self._round_start = time()
+        self._round_count = 0
+        self._round_bytes = 0
+        self._round_seconds = []  # download times
+
+    def _set_limit(self, limit, reason):
+        limit = max(self._minimum, min(self._maximum, limit))
+        if limit != self._workers.limit:
+            self._log.info('Changing number of downloads from %d to %d (%s)' % (self._workers.limit, limit, reason))
+            self._workers.set_limit(limit)
 
-    def _popen(self, command, feedback=None):
-        return Popen(command, shell=True, stdout=feedback)
+    def observe(self, returncode, feedback):
+        feedback = feedback or {}
+        status = feedback.get('http_status')
+        if returncode and (status is None or status in CONGESTION_STATUS):
+            # only react once to a burst of errors (from downloads started before we reduced)
+            if not self._reduced:
+                self._set_limit(self._workers.limit // 2, 'HTTP status %s' % status if status else 'no response')
+                self._reduced = True
+                self._previous_rate = None
+                self._start_round()
+            return
+        self._reduced = False
+        self._round_count += 1
+        self._round_bytes += feedback.get('download_byte_count', 0)
+        seconds = (feedback.get('timings') or {}).get('download')
+        if seconds is not None:
+            self._round_seconds.append(seconds)
+        if self._round_count >= self._workers.limit:
+            rate = self._round_bytes / max(0.001, time() - self._round_start)
+            latency = sum(self._round_seconds) / len(self._round_seconds) if self._round_seconds else None
+            if latency is not None and (self._min_latency is None or latency < self._min_latency):
+                self._min_latency = latency
+            if self._previous_rate is not None and rate < 0.9 * self._previous_rate:
+                self._set_limit(self._workers.limit - 1, 'rate fell to %.0f bytes/s' % rate)
+            elif latency is not None and latency > LATENCY_FACTOR * self._min_latency and \
+                    (self._previous_rate is None or rate <= self._previous_rate):
+                self._set_limit(self._workers.limit - 1, 'download time rose to %.1fs' % latency)
+            else:
+                self._set_limit(self._workers.limit + 1, '%.0f bytes/s' % rate)
+            self._previous_rate = rate
+            self._start_round()
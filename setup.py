@@ -41,6 +41,7 @@ setup(
     extras_require={
         'dev': ["nose", "robotframework"],
         'mseedindex': ["mseedindex"],
+        'numpy': ["numpy"],
     },
     entry_points={
         'console_scripts': [
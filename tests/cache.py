@@ -0,0 +1,156 @@
+
+from os import listdir, remove
+from os.path import join, exists
+from sys import version_info
+from threading import Thread
+
+if version_info[0] >= 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from tempfile import TemporaryDirectory
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from backports.tempfile import TemporaryDirectory
+
+from rover.args import AVAILABILITYCACHETTL, AVAILABILITYCACHESIZE
+from rover.cache import AvailabilityCache, cache_key
+from rover.config import availability_cache_dir
+from rover.utils import read_json
+from .test_utils import TestConfig, WindowsTemp, _
+
+
+class AvailabilityHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        if self.server.etag and self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            if self.server.etag:
+                self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    # a local stand-in for an availability service that supports conditional requests
+    server = HTTPServer(('127.0.0.1', 0), AvailabilityHandler)
+    server.requests, server.etag, server.body = 0, '"1"', b'IU ANMO 00 BHZ M 40.0 2018-01-01T00:00:00 2018-01-02T00:00:00\n'
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/fdsnws/availability/1/query' % server.server_port
+
+
+def write(path, text):
+    with open(path, 'w') as output:
+        output.write(text)
+    return path
+
+
+def read(path):
+    with open(path, 'r') as input:
+        return input.read()
+
+
+def cached(config):
+    dir = availability_cache_dir(config)
+    return listdir(dir) if exists(dir) else []
+
+
+def test_key():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        a = write(join(dir, 'a'), 'IU ANMO * *\nII KAPI * *\n')
+        b = write(join(dir, 'b'), '\n  II KAPI * *\nIU ANMO * *  \n')
+        assert cache_key('http://x', a) == cache_key('http://x', b)
+        assert cache_key('http://x', a) != cache_key('http://y', a)
+
+
+def test_cache():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        try:
+            config = TestConfig(dir, **{_(AVAILABILITYCACHETTL): 60})
+            cache = AvailabilityCache(config)
+            request = write(join(dir, 'request'), 'IU ANMO * *\n')
+            response = join(dir, 'response')
+            # the first query is a miss, the second a hit (within the ttl)
+            for _n in range(2):
+                path, check_status = cache.fetch(url, request, response, 10, 0)
+                check_status()
+                assert read(path) == server.body.decode('ascii')
+            assert server.requests == 1 and (cache.hits, cache.revalidated, cache.misses) == (1, 0, 1)
+            # after the ttl the response is revalidated (and unchanged)
+            cache._ttl = 0
+            path, check_status = cache.fetch(url, request, response, 10, 0)
+            assert read(path) == server.body.decode('ascii')
+            assert server.requests == 2 and cache.revalidated == 1
+            # or replaced, if it has changed
+            server.etag, server.body = '"2"', b''
+            path, check_status = cache.fetch(url, request, response, 10, 0)
+            assert read(path) == '' and cache.misses == 2
+        finally:
+            server.shutdown()
+
+
+def test_evict():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        try:
+            config = TestConfig(dir, **{_(AVAILABILITYCACHESIZE): 0})
+            cache = AvailabilityCache(config)
+            cache._max_bytes = 100
+            for i in range(3):
+                request = write(join(dir, 'request%d' % i), 'IU STA%d * *\n' % i)
+                cache.fetch(url, request, join(dir, 'response'), 10, 0)
+            # each response is 63 bytes, so only the latest is kept
+            assert sorted(listdir(availability_cache_dir(config))) == \
+                sorted(cache_key(url, request) + suffix for suffix in ('.json', '.txt'))
+        finally:
+            server.shutdown()
+
+
+def test_not_stored():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        try:
+            config = TestConfig(dir)
+            cache = AvailabilityCache(config)
+            request = write(join(dir, 'request'), 'IU ANMO * *\n')
+            # with no ttl and no validator the response could never be used again
+            server.etag = None
+            path, check_status = cache.fetch(url, request, join(dir, 'response'), 10, 0)
+            assert read(path) == server.body.decode('ascii')
+            assert not cached(config)
+            # and a response larger than the cache is not stored
+            server.etag = '"1"'
+            cache._max_bytes = 10
+            cache.fetch(url, request, join(dir, 'response'), 10, 0)
+            assert not cached(config)
+        finally:
+            server.shutdown()
+
+
+def test_evicted():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        try:
+            config = TestConfig(dir, **{_(AVAILABILITYCACHETTL): 60})
+            cache = AvailabilityCache(config)
+            request = write(join(dir, 'request'), 'IU ANMO * *\n')
+            cache.fetch(url, request, join(dir, 'response'), 10, 0)
+            # the response is deleted (eg by another process) after the metadata is read
+            remove(join(availability_cache_dir(config), cache_key(url, request) + '.txt'))
+            meta = read_json(join(availability_cache_dir(config), cache_key(url, request) + '.json'))
+            assert cache._copy(cache_key(url, request), meta, join(availability_cache_dir(config), 'missing'),
+                               join(dir, 'response')) is None
+            # so it is requested again
+            path, check_status = cache.fetch(url, request, join(dir, 'response'), 10, 0)
+            assert read(path) == server.body.decode('ascii') and server.requests == 2
+        finally:
+            server.shutdown()
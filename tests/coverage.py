@@ -7,7 +7,7 @@ else:
     from backports.tempfile import TemporaryDirectory
 
 from rover.logs import init_log
-from rover.coverage import Coverage
+from rover.coverage import Coverage, ArrayCoverage, np
 from rover.utils import format_epoch, parse_epoch
 
 from .test_utils import WindowsTemp
@@ -47,8 +47,8 @@ def coverage_to_str(coverage):
     return '(' + ','.join(map(lambda be: '(%g,%g)' % be, coverage.timespans)) + ')'
 
 
-def indices_to_coverage(log, tolerance, increment, indices):
-    coverage = Coverage(log, tolerance, increment, 'N.S.L.C')
+def indices_to_coverage(log, tolerance, increment, indices, cls=Coverage):
+    coverage = cls(log, tolerance, increment, 'N.S.L.C')
     for (begin, end) in indices:
         if begin != end:
             coverage.add_epochs(begin, end, 1)
@@ -84,7 +84,7 @@ def print_coverage(title, coverage):
     print()
 
 
-def run_explicit(log, tolerance, increment, index, avail, expected):
+def run_explicit(log, tolerance, increment, index, avail, expected, cls=Coverage):
     """
     A bad test looks like:
 
@@ -95,10 +95,10 @@ def run_explicit(log, tolerance, increment, index, avail, expected):
 
     where, for example, avail has data at 3 but it's not in missing
     """
-    index = indices_to_coverage(log, tolerance, increment, index)
-    avail = indices_to_coverage(log, tolerance, increment, avail)
+    index = indices_to_coverage(log, tolerance, increment, index, cls)
+    avail = indices_to_coverage(log, tolerance, increment, avail, cls)
     missing = avail.subtract(index)
-    expected = indices_to_coverage(log, tolerance, increment, expected)
+    expected = indices_to_coverage(log, tolerance, increment, expected, cls)
     if True or expected != missing:
         print()
         print_labels()
@@ -111,32 +111,41 @@ def run_explicit(log, tolerance, increment, index, avail, expected):
 def run(log, tolerance, increment,
         width_index, gap_index, offset_index,
         width_avail, gap_avail, offset_avail,
-        expected):
+        expected, cls=Coverage):
     run_explicit(log, tolerance, increment,
                  build_coverage(log, width_index, gap_index, offset_index),
                  build_coverage(log, width_avail, gap_avail, offset_avail),
-                 expected)
+                 expected, cls)
 
 
 def test_coverage():
+    check_coverage(Coverage)
+
+
+def test_array_coverage():
+    if np is not None:
+        check_coverage(ArrayCoverage)
+
+
+def check_coverage(cls):
     with WindowsTemp(TemporaryDirectory) as dir:
         log = init_log(dir, '10M', 1, 5, 4, 'coverage', False, 1)[0]
-        run(log, 0.5, 0.5, 0, 10, 0, 3, 2, 0, ((2,5),(7,10)))
-        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 0, ())
-        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 1, ())
-        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 2, ())
-        run(log, 0.5, 0.5, 2, 1, -1, 1, 1, 0, ())
-        run(log, 0.5, 0.5, 2, 1, 0, 1, 1, 0, ((9.5,10),))
-        run(log, 0.5, 0.5, 2, 1, 1, 1, 1, 0, ())
-        run(log, 0.5, 0.5, 1, 2, 0, 1, 2, 0, ())
-        run(log, 0.5, 0.5, 1, 2, 1, 1, 2, 0, ((2,2.5),(5,5.5),(8,8.5)))
-        run(log, 0.5, 0.5, 1, 2, 2, 1, 2, 0, ((2.5,3),(5.5,6),(8.5,9)))
-        run(log, 0.5, 0.5, 1, 2, 3, 1, 2, 0, ())
-        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 0, ())
-        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 1, ((0,1),(4.5,5),(8.5,9)))
-        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 2, ((0,1.5),(4.5,5.5),(8.5,10)))
-        run(log, 0.5, 0.5, 1, 1, 0, 3, 2, 0, ())
-        run(log, 0.5, 0.5, 1, 1, 0, 3, 2, 1, ((0,0.5),))
+        run(log, 0.5, 0.5, 0, 10, 0, 3, 2, 0, ((2,5),(7,10)), cls)
+        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 0, (), cls)
+        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 1, (), cls)
+        run(log, 0.5, 0.5, 2, 1, -1, 3, 2, 2, (), cls)
+        run(log, 0.5, 0.5, 2, 1, -1, 1, 1, 0, (), cls)
+        run(log, 0.5, 0.5, 2, 1, 0, 1, 1, 0, ((9.5,10),), cls)
+        run(log, 0.5, 0.5, 2, 1, 1, 1, 1, 0, (), cls)
+        run(log, 0.5, 0.5, 1, 2, 0, 1, 2, 0, (), cls)
+        run(log, 0.5, 0.5, 1, 2, 1, 1, 2, 0, ((2,2.5),(5,5.5),(8,8.5)), cls)
+        run(log, 0.5, 0.5, 1, 2, 2, 1, 2, 0, ((2.5,3),(5.5,6),(8.5,9)), cls)
+        run(log, 0.5, 0.5, 1, 2, 3, 1, 2, 0, (), cls)
+        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 0, (), cls)
+        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 1, ((0,1),(4.5,5),(8.5,9)), cls)
+        run(log, 0.5, 0.5, 2, 2, 0, 2, 2, 2, ((0,1.5),(4.5,5.5),(8.5,10)), cls)
+        run(log, 0.5, 0.5, 1, 1, 0, 3, 2, 0, (), cls)
+        run(log, 0.5, 0.5, 1, 1, 0, 3, 2, 1, ((0,0.5),), cls)
 
 # with tolerance 1.5 these overlap
 # (this was a bug with rover retrieve IU_ANMO_3?_* 2016-01-01T20:00:00 2016-01-02T04:00:00)
@@ -144,7 +153,7 @@ def test_coverage():
 #   index |    |====|====|====|    |    |
 #   avail |    |    |    |====|====|    |
 # missing |    |    |    |    |    |    |
-        run_explicit(log, 1.5, 0.5, [(1,4)], [(3,5)], [])
+        run_explicit(log, 1.5, 0.5, [(1,4)], [(3,5)], [], cls)
 # more of same (in retrospect these seem weird - we shouldn't be using a tolerance of 1.5!)
         seed(42)
         for i in range(100):
@@ -155,4 +164,32 @@ def test_coverage():
             index_start = randint(0, min(4, avail_start+1))
             # and must end with a width of at least 2, and at least one before end (so after, within tolerance)
             index_end = randint(max(avail_end-1, index_start+2), 6)
-            run_explicit(log, 1.5, 0.5, [(index_start, index_end)], [(avail_start, avail_end)], [])
+            run_explicit(log, 1.5, 0.5, [(index_start, index_end)], [(avail_start, avail_end)], [], cls)
+
+
+def random_coverage(log, cls, tolerance, increment, samplerate, n):
+    coverage, start = cls(log, tolerance, increment, 'N.S.L.C'), 0
+    for _ in range(n):
+        # a mix of gaps, small gaps, overlaps and contained timespans
+        start += randint(0, 10) * 0.25
+        coverage.add_epochs(start, start + randint(0, 20) * 0.25, samplerate)
+    return coverage
+
+
+def test_array_coverage_random():
+    if np is None:
+        return
+    with WindowsTemp(TemporaryDirectory) as dir:
+        log = init_log(dir, '10M', 1, 5, 4, 'coverage', False, 1)[0]
+        seed(42)
+        for i in range(500):
+            tolerance, increment, samplerate = randint(0, 3) * 0.5, randint(0, 3) * 0.5, (0.5, 1, 4)[i % 3]
+            avail, index = randint(0, 30), randint(0, 30)
+            seed(i)
+            expected = random_coverage(log, Coverage, tolerance, increment, samplerate, avail).subtract(
+                random_coverage(log, Coverage, tolerance, increment, samplerate, index))
+            seed(i)
+            array = random_coverage(log, ArrayCoverage, tolerance, increment, samplerate, avail)
+            result = array.subtract(random_coverage(log, ArrayCoverage, tolerance, increment, samplerate, index))
+            assert result.timespans == expected.timespans, (i, result.timespans, expected.timespans)
+            assert abs(result.duration() - expected.duration()) < 1e-6
@@ -0,0 +1,114 @@
+
+from sys import version_info
+
+if version_info[0] >= 3:
+    from tempfile import TemporaryDirectory
+else:
+    from backports.tempfile import TemporaryDirectory
+
+from rover.args import FULLRECHECKPERIOD
+from rover.daemon import Daemon
+from rover.manager import ErrorStatistics, CONFIRMED, INCONSISTENT
+from rover.sqlite import SqliteSupport
+from rover.subscribe import create_subscriptions_table
+from .test_utils import TestConfig, WindowsTemp, _
+
+
+class StubDownloadManager:
+
+    def __init__(self):
+        self.added = {}  # id -> updated_after
+
+    def add(self, id, path, fetch, availability_url, dataselect_url, callback, weight=1, max_workers=0,
+            updated_after=None):
+        self.added[id] = updated_after
+
+
+class StubReporter:
+
+    def describe_daemon(self, source):
+        return 'subject', 'message'
+
+    def send_email(self, subject, msg):
+        pass
+
+
+class StubSource:
+
+    def __init__(self, name, errors=0, consistent=CONFIRMED):
+        self.name = name
+        self.errors = ErrorStatistics()
+        self.errors.final_errors = errors
+        self.consistent = consistent
+
+
+def daemon(config):
+    # the real constructor needs the rover command (for downloads), so only what the checks use is created
+    daemon = Daemon.__new__(Daemon)
+    SqliteSupport.__init__(daemon, config)
+    create_subscriptions_table(daemon)
+    daemon._log = config.log
+    daemon._config = config
+    daemon._post_summary = False
+    daemon._reporter = StubReporter()
+    daemon._download_manager = StubDownloadManager()
+    daemon._full_recheck_period = config.arg(FULLRECHECKPERIOD) * 60 * 60
+    daemon._checks = {}
+    daemon.execute('''INSERT INTO rover_subscriptions (file, availability_url, dataselect_url)
+                        VALUES ('request', 'http://example.com/availability', 'http://example.com/dataselect')''')
+    return daemon
+
+
+def epochs(daemon):
+    return daemon.fetchone('SELECT last_success_epoch, last_full_epoch FROM rover_subscriptions WHERE id = 1')
+
+
+def check(daemon, **kargs):
+    # returns updated_after (None for a full check)
+    daemon._add_subscription(1)
+    daemon._source_callback(StubSource(1, **kargs))
+    return daemon._download_manager.added[1]
+
+
+def test_is_full_check():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir, **{_(FULLRECHECKPERIOD): 24})
+        d = daemon(config)
+        assert d._is_full_check(1000, None, None)
+        assert d._is_full_check(1000, 900, None)
+        assert not d._is_full_check(1000, 900, 800)
+        assert d._is_full_check(800 + 24 * 60 * 60, 900, 800)
+        d._full_recheck_period = 0
+        assert d._is_full_check(1000, 900, 800)
+
+
+def test_checks():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir, **{_(FULLRECHECKPERIOD): 24})
+        d = daemon(config)
+        # the first check is full, and sets both epochs
+        assert check(d) is None
+        success, full = epochs(d)
+        assert success is not None and full == success
+        # the next is incremental, from the start of the last success
+        assert check(d) == success
+        assert epochs(d)[0] >= success and epochs(d)[1] == full
+        # failed or inconsistent checks do not move the epochs
+        before = epochs(d)
+        assert check(d, errors=1) == before[0]
+        assert check(d, consistent=INCONSISTENT) == before[0]
+        assert epochs(d) == before
+        # once the period has expired, the check is full again
+        d.execute('UPDATE rover_subscriptions SET last_full_epoch = ? WHERE id = 1', (full - 24 * 60 * 60,))
+        assert check(d) is None
+        assert epochs(d)[1] >= full
+
+
+def test_no_full_recheck_period():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir, **{_(FULLRECHECKPERIOD): 0})
+        d = daemon(config)
+        # every check is full
+        assert check(d) is None
+        assert check(d) is None
+        assert epochs(d)[0] == epochs(d)[1]
@@ -0,0 +1,110 @@
+
+from sys import version_info
+from threading import Thread, Event
+from time import time
+
+if version_info[0] >= 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from tempfile import TemporaryDirectory
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from backports.tempfile import TemporaryDirectory
+
+from rover.endpoints import Endpoints, split_urls, version_url, is_endpoint_failure
+from .test_utils import TestConfig, WindowsTemp
+
+
+class VersionHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(self.server.status if self.path.endswith('/version') else 404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(status):
+    # a local stand-in for a dataselect service (only the version method)
+    server = HTTPServer(('127.0.0.1', 0), VersionHandler)
+    server.status = status
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/fdsnws/dataselect/1/query' % server.server_port
+
+
+def test_urls():
+    assert split_urls('http://a/query, http://b/query,') == ['http://a/query', 'http://b/query']
+    assert version_url('http://a/fdsnws/dataselect/1/query') == 'http://a/fdsnws/dataselect/1/version'
+    assert is_endpoint_failure(1, None)
+    assert is_endpoint_failure(1, {'http_status': 503})
+    assert not is_endpoint_failure(1, {'http_status': 400})
+    assert not is_endpoint_failure(0, {'http_status': 200})
+
+
+def test_balance():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        endpoints = Endpoints(config.log, 'http://a/query,http://b/query', max_workers=2)
+        a, b = list(endpoints)
+        # with no latencies, downloads are spread evenly (up to the limit)
+        assert [endpoints.select().url for _ in range(4)] == ['http://a/query', 'http://b/query'] * 2
+        assert endpoints.select() is None and not endpoints.has_space()
+        endpoints.finished(a, 0, {'timings': {'download': 1}}, 2)
+        endpoints.finished(a, 0, {'timings': {'download': 1}}, 2)
+        endpoints.finished(b, 0, {'timings': {'download': 10}}, 11)
+        assert a.latency == 1 and b.latency == 10
+        # the faster service is preferred, while it has space
+        assert [endpoints.select() for _ in range(3)] == [a, a, b]
+        # but a failed download is retried elsewhere, if possible
+        endpoints.release(a)
+        assert endpoints.select(avoid=('http://a/query',)) is a
+
+
+def test_health():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        good, good_url = start_server(200)
+        bad, bad_url = start_server(500)
+        try:
+            endpoints = Endpoints(config.log, ','.join([good_url, bad_url]))
+            first, second = list(endpoints)
+            # repeated server errors mark the service down
+            for _ in range(3):
+                assert endpoints.select(avoid=(good_url,)) is second
+                endpoints.finished(second, 1, {'http_status': 503}, 1)
+            assert second.down_until is not None
+            assert not endpoints.has_alternative((good_url,))
+            assert endpoints.select(avoid=(good_url,)) is first
+            # once the backoff expires a health check is made (in the background)
+            backoff, second.down_until = second.backoff, 0
+            assert endpoints.select(avoid=(good_url,)) is first
+            second.checking.join()
+            assert endpoints.select(avoid=(good_url,)) is first
+            assert second.down_until and second.backoff == 2 * backoff
+            # and when that succeeds the service is used again
+            bad.status, second.down_until = 200, 0
+            assert endpoints.select(avoid=(good_url,)) is first
+            second.checking.join()
+            assert endpoints.select(avoid=(good_url,)) is second
+            assert second.down_until is None and second.failures == 0
+        finally:
+            good.shutdown()
+            bad.shutdown()
+
+
+def test_background_check():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        release = Event()
+        endpoints = Endpoints(config.log, 'http://a/query,http://b/query', check=lambda endpoint: release.wait(10))
+        a, b = list(endpoints)
+        b.down_until = 0
+        # a slow health check does not delay the choice of endpoint
+        start = time()
+        assert endpoints.select() is a
+        assert endpoints.select() is a and time() - start < 5
+        release.set()
+        b.checking.join()
+        assert endpoints.select(avoid=('http://a/query',)) is b
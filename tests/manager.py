@@ -0,0 +1,475 @@
+
+from sys import version_info
+
+if version_info[0] >= 3:
+    from tempfile import TemporaryDirectory
+else:
+    from backports.tempfile import TemporaryDirectory
+
+from os.path import join
+
+from rover.args import COVERAGEENGINE, RESUME, AVAILABILITYCACHESIZE
+from rover.coverage import Coverage, ArrayCoverage, NUMPY, np
+from rover.manager import Chunks, ChunkJournal, ProgressStatistics, Retrieval, MergedIndex, FairShare, Hedging, \
+    Source, shard_lines, \
+    OLDEST, NEWEST, LARGEST, SMALLEST, DONE, FAILED, RETRIED
+from rover.endpoints import Endpoints
+from rover.workers import ThreadWorkers
+from rover.utils import parse_epoch
+
+from .cache import start_server
+from .test_utils import TestConfig, WindowsTemp, _
+
+
+def coverage(config, sncl, start, end, samplerate=None):
+    coverage = Coverage(config.log, 0.5, 1.5, sncl)
+    coverage.add_epochs(parse_epoch(start), parse_epoch(end), samplerate)
+    return coverage
+
+
+def build_chunks(config, max_samples, coverages):
+    chunks = Chunks(config.log, max_samples)
+    remaining = list(coverages)
+    while remaining and chunks.accepts(remaining[0]):
+        chunks.add_coverage(remaining.pop(0))
+    return chunks, remaining
+
+
+def test_one_station():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        coverages = [coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-02T23:59:59'),
+                     coverage(config, 'IU_ANMO_00_LHN', '2018-01-01', '2018-01-02T23:59:59'),
+                     coverage(config, 'IU_COLA_00_LHZ', '2018-01-01', '2018-01-02T23:59:59')]
+        chunks, remaining = build_chunks(config, 0, coverages)
+        assert len(chunks) == 2, len(chunks)
+        assert chunks.n_stations == 1
+        assert len(remaining) == 1
+
+
+def test_packed_stations():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        # LH is nominally 1Hz, so 86400 samples per channel per day
+        coverages = [coverage(config, 'IU_%s_00_LHZ' % sta, '2018-01-01', '2018-01-01T23:59:59')
+                     for sta in ('ANMO', 'COLA', 'KONO', 'MAJO')]
+        chunks, remaining = build_chunks(config, 3 * 86400, coverages)
+        assert len(chunks) == 1, len(chunks)
+        assert chunks.n_stations == 3
+        assert len(remaining) == 1
+        progress = ProgressStatistics()
+        description, data = chunks.pop(progress)
+        assert description == 'IU_ANMO (+2 stations) 2018-001', description
+        assert len(data) == 3, data
+        # a known samplerate (from the index) is used in preference to the band code
+        remaining.append(coverage(config, 'IU_XXXX_00_LHZ', '2018-01-01', '2018-01-02', samplerate=40))
+        chunks, remaining = build_chunks(config, 3 * 86400, remaining)
+        assert chunks.n_stations == 1
+        assert len(remaining) == 1
+
+
+def test_split_day():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        # HH is nominally 100Hz, so 8640000 samples per channel per day
+        coverages = [coverage(config, 'IU_ANMO_00_HH%s' % cha, '2018-01-01', '2018-01-01T23:59:59')
+                     for cha in 'ZNE']
+        chunks, remaining = build_chunks(config, 10000000, coverages)
+        assert len(chunks) == 1
+        progress = ProgressStatistics()
+        progress.add_chunks(len(chunks), chunks.n_stations)
+        windows = []
+        while chunks:
+            windows.append(chunks.pop(progress))
+        assert len(windows) == 3, windows
+        assert windows[0][0] == 'IU_ANMO 2018-001 (1/3)', windows[0][0]
+        assert progress.chunks == [3, 3], progress.chunks
+        for description, data in windows:
+            assert len(data) == 3
+        assert windows[0][1][0][1] == parse_epoch('2018-01-01')
+        assert windows[1][1][0][1] == parse_epoch('2018-01-01T08:00:00')
+        assert windows[2][1][0][2] == parse_epoch('2018-01-01T23:59:59')
+
+
+def test_halve():
+    data = [('IU_ANMO_00_HHZ', 0, 1000), ('IU_ANMO_00_HHN', 0, 1000), ('IU_ANMO_00_HHE', 0, 1000)]
+    first, second = Chunks.halve(data)
+    assert first == data[:1] and second == data[1:]
+    first, second = Chunks.halve(first)
+    assert first == [('IU_ANMO_00_HHZ', 0, 500 - 0.000001)], first
+    assert second == [('IU_ANMO_00_HHZ', 500, 1000)], second
+    assert Chunks.halve([('IU_ANMO_00_HHZ', 0, 100)]) is None
+
+
+def test_order():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+
+        def days(order):
+            chunks = Chunks(config.log, 0, order)
+            chunks.add_coverage(coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-03T23:59:59'))
+            chunks.add_coverage(coverage(config, 'IU_ANMO_00_LHN', '2018-01-02', '2018-01-02T23:59:59'))
+            progress = ProgressStatistics()
+            return [chunks.pop(progress)[0].split()[-1] for _ in range(len(chunks))]
+
+        assert days(OLDEST) == ['2018-001', '2018-002', '2018-003'], days(OLDEST)
+        assert days(NEWEST) == ['2018-003', '2018-002', '2018-001'], days(NEWEST)
+        assert days(LARGEST)[0] == '2018-002', days(LARGEST)
+        assert days(SMALLEST)[-1] == '2018-002', days(SMALLEST)
+
+
+def test_window_order():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        required = [coverage(config, 'IU_%s_00_LHZ' % sta, day, day + 'T23:59:59')
+                    for (sta, day) in (('ANMO', '2018-01-01'), ('COLA', '2018-01-03'), ('KONO', '2018-01-02'))]
+
+        def stations(order):
+            retrieval = Retrieval(config.log, '', dir, True, 'http://example.com', False, 0, order,
+                                  ChunkJournal(config, 'test'))
+            retrieval.plan(iter([(coverage, coverage) for coverage in required]), 3, 0)
+            while retrieval.plan_ahead():
+                pass
+            stations = []
+            while retrieval.has_chunks():
+                stations.append(retrieval._chunks.pop(retrieval.progress)[0].split()[0])
+            return stations
+
+        # stations planned ahead are ordered in the same way as days
+        assert stations(OLDEST) == ['IU_ANMO', 'IU_KONO', 'IU_COLA'], stations(OLDEST)
+        assert stations(NEWEST) == ['IU_COLA', 'IU_KONO', 'IU_ANMO'], stations(NEWEST)
+
+
+def test_journal():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        journal = ChunkJournal(config, 'test')
+        data = [('IU_ANMO_00_LHZ', 0.0, 100.0)]
+        journal.finish(journal.start('ok', data), DONE)
+        journal.finish(journal.start('bad', data), FAILED)
+        assert journal.failures() == [('bad', data)]
+        # failures are only returned once
+        assert journal.failures() == []
+        journal.clear()
+        assert config.db.execute('SELECT count(*) FROM rover_chunks').fetchone()[0] == 0
+
+
+def test_plan():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        journal = ChunkJournal(config, 'test')
+        planned = coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-02T23:59:59', samplerate=1)
+        journal.save_plan('abc', 2, [planned])
+        assert journal.load_plan('xyz') is None
+        n_retries, coverages, planned_sncl = journal.load_plan('abc')
+        assert n_retries == 2 and planned_sncl is None
+        assert coverages == [planned], coverages
+        done = ('IU_ANMO_00_LHZ', parse_epoch('2018-01-01'), parse_epoch('2018-01-01T23:59:59'))
+        journal.finish(journal.start('done', [done]), DONE)
+        journal.start('interrupted', [('IU_ANMO_00_LHN', 0, 100)])
+        completed, uncertain = journal.outcomes()
+        assert completed == {'IU_ANMO_00_LHZ': [done[1:]]}, completed
+        assert uncertain == set(['IU_ANMO_00_LHN']), uncertain
+        journal.discard_plan()
+        assert journal.load_plan('abc') is None
+
+
+def test_partial_plan():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        journal = ChunkJournal(config, 'test')
+        planned = coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-02T23:59:59', samplerate=1)
+        # an interrupted plan can be resumed after the last SNCL compared
+        journal.start_plan('abc', 1)
+        assert journal.load_plan('abc') == (1, [], '')
+        journal.extend_plan([planned], 'IU_COLA_00_LHZ')
+        assert journal.load_plan('abc') == (1, [planned], 'IU_COLA_00_LHZ')
+        journal.save_plan('abc', 1, [planned], 'IU_KONO_00_LHZ')
+        assert journal.load_plan('abc') == (1, [planned], 'IU_KONO_00_LHZ')
+        journal.complete_plan()
+        assert journal.load_plan('abc') == (1, [planned], None)
+
+
+def test_resume_source():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        server.body = b'IU ANMO 00 BHZ 2018-01-01T00:00:00.000000Z 2018-01-02T00:00:00.000000Z\n'
+        try:
+            request = join(dir, 'request')
+            with open(request, 'w') as output:
+                output.write('IU ANMO 00 BHZ 2018-01-01T00:00:00 2018-01-02T00:00:00\n')
+            config = TestConfig(dir, **{_(AVAILABILITYCACHESIZE): 0})
+            source = Source(config, 'test', False, request, url, 'http://example.com/query', None)
+            request_hash = source._request_hash()
+            assert len(request_hash) == 40, request_hash  # a digest, the same in every process
+            source._updated_after = parse_epoch('2018-01-01')
+            assert source._request_hash() != request_hash
+            planned = coverage(config, 'IU_ANMO_00_BHZ', '2018-01-01', '2018-01-01T23:59:59', samplerate=40)
+            ChunkJournal(config, 'test').save_plan(request_hash, 2, [planned])
+            # a fresh source (as in a later run) resumes the saved plan, without requesting availability
+            requests = server.requests
+            config = TestConfig(dir, **{_(AVAILABILITYCACHESIZE): 0, _(RESUME): True})
+            source = Source(config, 'test', True, request, url, 'http://example.com/query', None)
+            assert server.requests == requests
+            assert source.n_retries == 2
+            assert [coverage.timespans for coverage in source.get_coverages()] == [planned.timespans]
+        finally:
+            server.shutdown()
+
+
+def test_full_check_after_errors():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        server, url = start_server()
+        server.body = b'IU ANMO 00 BHZ 2018-01-01T00:00:00.000000Z 2018-01-02T00:00:00.000000Z\n'
+        try:
+            request = join(dir, 'request')
+            with open(request, 'w') as output:
+                output.write('IU ANMO 00 BHZ 2018-01-01T00:00:00 2018-01-02T00:00:00\n')
+            config = TestConfig(dir, **{_(AVAILABILITYCACHESIZE): 0})
+            source = Source(config, 'test', True, request, url, 'http://example.com/query', None)
+            checked = []
+            source._touched = lambda: checked.append(True) or [coverage(config, 'IU_ANMO_00_BHZ', '2018-01-01',
+                                                                         '2018-01-01T23:59:59')]
+
+            def failing():
+                raise Exception('index unavailable')
+                yield
+
+            # planning fails (and a download fails too, so only that is retried next)
+            source._retrieval.plan(failing(), 1, 0)
+            source._retrieval.finish_planning()
+            assert source._retrieval.errors.errors == 1
+            journal = source._journal
+            journal.finish(journal.start('bad', [('IU_ANMO_00_BHZ', 0.0, 100.0)]), FAILED)
+            source._retry_failures()
+            assert source._retrieval.has_chunks() and not source._retrieval.errors.errors
+            # the retry had no errors, but the plan before it was incomplete, so everything is checked
+            source._new_retrieval(True)
+            assert not checked
+            # after a full check without errors, only the data touched are checked
+            source._new_retrieval(True)
+            assert checked == [True]
+        finally:
+            server.shutdown()
+
+
+def test_plan_engine():
+    if np is None:
+        return
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir, **{_(COVERAGEENGINE): NUMPY})
+        journal = ChunkJournal(config, 'test')
+        planned = coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-02T23:59:59', samplerate=1)
+        journal.save_plan('abc', 1, [planned])
+        # a resumed plan uses the configured coverage engine
+        n_retries, coverages, planned_sncl = journal.load_plan('abc')
+        assert isinstance(coverages[0], ArrayCoverage)
+        assert coverages[0].timespans == planned.timespans
+
+
+def test_lazy_plan():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        available = [coverage(config, 'IU_%s_00_LHZ' % sta, '2018-01-01', '2018-01-02T23:59:59')
+                     for sta in ('ANMO', 'COLA', 'KONO')]
+        required = [coverage(config, 'IU_%s_00_LHZ' % sta, '2018-01-01', '2018-01-01T23:59:59')
+                    for sta in ('ANMO', 'COLA', 'KONO')]
+        planned = []
+
+        def planner():
+            for pair in zip(available, required):
+                planned.append(pair[0].sncl)
+                yield pair
+
+        retrieval = Retrieval(config.log, '', dir, True, 'http://example.com', False, 0, OLDEST,
+                              ChunkJournal(config, 'test'))
+        seconds = sum(end - start for coverage in available for (start, end) in coverage.timespans)
+        retrieval.plan(planner(), 3, seconds)
+        assert retrieval.progress.stations[1] == 3
+        assert retrieval.progress.seconds[1] == seconds
+        # only one coverage is compared beyond what is needed for the first chunks
+        assert retrieval.has_chunks()
+        assert planned == ['IU_ANMO_00_LHZ', 'IU_COLA_00_LHZ'], planned
+        while retrieval.plan_ahead():
+            pass
+        assert len(planned) == 3
+        # once planning is complete the totals are exact
+        assert retrieval.progress.stations[1] == 3
+        assert abs(retrieval.progress.seconds[1] - 3 * 86399) < 1, retrieval.progress.seconds
+
+
+def test_merged_index():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        config.db.execute('''CREATE TABLE tsindex (network text, station text, location text, channel text,
+                                                   timespans text, starttime text, endtime text, samplerate float)''')
+        for (n, s, l, c, start, end) in (('IU', 'ANMO', '00', 'LHZ', '2018-01-01T00:00:00', '2018-01-01T12:00:00'),
+                                         ('IU', 'ANMO', '00', 'LHZ', '2018-01-02T00:00:00', '2018-01-02T12:00:00'),
+                                         ('IU', 'ANMO', '', 'LHZ', '2018-01-01T00:00:00', '2018-01-01T12:00:00'),
+                                         ('IU', 'COLA', '00', 'LHZ', '2018-01-01T00:00:00', '2018-01-01T12:00:00')):
+            config.db.execute('INSERT INTO tsindex VALUES (?, ?, ?, ?, NULL, ?, ?, 1)', (n, s, l, c, start, end))
+        config.db.commit()
+        index = MergedIndex(config, 'IU', 'IU')
+        try:
+            assert index.coverage('IU_ANMO__LHZ').timespans == \
+                [(parse_epoch('2018-01-01'), parse_epoch('2018-01-01T12:00:00'))]
+            assert len(index.coverage('IU_ANMO_00_LHZ').timespans) == 2
+            assert not index.coverage('IU_ANMO_00_LHZZ')
+            # out of order, so the index must be queried directly
+            assert index.coverage('IU_ANMO_00_LHZ') is None
+            assert len(index.coverage('IU_COLA_00_LHZ').timespans) == 1
+        finally:
+            index.close()
+
+
+def test_touched():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        journal = ChunkJournal(config, 'test')
+        journal.finish(journal.start('ok', [('IU_ANMO_00_LHZ', 0.0, 100.0)]), DONE)
+        journal.finish(journal.start('bad', [('IU_ANMO_00_LHZ', 200.0, 300.0), ('IU_COLA_00_LHZ', 0.0, 100.0)]),
+                       FAILED)
+        assert journal.touched() == {'IU_ANMO_00_LHZ': [(0.0, 100.0), (200.0, 300.0)],
+                                     'IU_COLA_00_LHZ': [(0.0, 100.0)]}, journal.touched()
+        assert journal.count_verification() == 1
+        assert journal.count_verification() == 2
+        assert ChunkJournal(config, 'other').count_verification() == 1
+
+
+class StubSource:
+
+    def __init__(self, name, weight=1, max_workers=0, chunks=100):
+        self.name = name
+        self.weight = weight
+        self.max_workers = max_workers
+        self.worker_count = 0
+        self.chunks = chunks
+
+    def can_use_worker(self):
+        return (not self.max_workers or self.worker_count < self.max_workers) and self.chunks > 0
+
+
+def test_fair_share():
+    fair_share = FairShare(quantum=10)
+    a, b, c = StubSource('a', weight=3), StubSource('b'), StubSource('c', max_workers=2)
+    counts = {'a': 0, 'b': 0, 'c': 0}
+    for _ in range(50):
+        source = fair_share.select([a, b, c])
+        source.worker_count += 1
+        source.chunks -= 1
+        counts[source.name] += 1
+        fair_share.charge(source, 10)
+    # c is limited, and the remainder is shared 3:1
+    assert counts['c'] == 2, counts
+    assert counts['a'] == 36 and counts['b'] == 12, counts
+    # when a source has no more data its share moves to the others
+    a.chunks = 0
+    assert all(fair_share.select([a, b, c]) is b for _ in range(5))
+    assert fair_share.select([StubSource('d', chunks=0)]) is None
+
+
+def test_fair_share_debt():
+    fair_share = FairShare(quantum=10)
+    a, b = StubSource('a', max_workers=1), StubSource('b')
+    source = fair_share.select([a, b])
+    assert source is a
+    a.worker_count += 1
+    fair_share.charge(a, 100)
+    # while a is at its limit b has every download
+    for _ in range(5):
+        assert fair_share.select([a, b]) is b
+        fair_share.charge(b, 10)
+    # and once a is free again it still repays the large download
+    a.worker_count = 0
+    selected = []
+    for _ in range(10):
+        source = fair_share.select([a, b])
+        fair_share.charge(source, 10)
+        selected.append(source.name)
+    assert selected.count('a') <= 2, selected
+
+
+class StubWorkers(ThreadWorkers):
+
+    def __init__(self, config):
+        super().__init__(config, 2, None)
+        self.jobs = []
+        self.cancelled = []
+
+    def execute(self, job, callback=None, name=None):
+        self.jobs.append((name, callback))
+
+    def cancel(self, name):
+        self.cancelled.append(name)
+        return False
+
+
+def test_hedging():
+    hedging = Hedging(50, n_samples=4, min_samples=3)
+    hedging.add(1)
+    hedging.add(5)
+    assert hedging.threshold() is None
+    for seconds in (3, 4, 2):
+        hedging.add(seconds)
+    # the first sample was discarded
+    assert hedging.threshold() == 4, hedging.threshold()
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        hedging = Hedging(50, min_samples=1)
+        hedging.add(-1)  # so any running download is slow
+        journal = ChunkJournal(config, 'test')
+        retrieval = Retrieval(config.log, '', dir, True, 'http://example.com', False, 0, OLDEST, journal,
+                              hedging=hedging)
+        retrieval.add_coverage(coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-01T23:59:59'))
+        workers = StubWorkers(config)
+        assert retrieval.has_chunks()
+        retrieval.new_worker(workers, None, None)
+        assert retrieval.hedge(workers, None, None)
+        # only one extra copy
+        assert not retrieval.hedge(workers, None, None)
+        assert len(workers.jobs) == 2 and retrieval.worker_count == 2
+        (first, first_callback), (second, second_callback) = workers.jobs
+        # the copy finishes first, so the original is cancelled
+        second_callback(second, 0, feedback={})
+        assert workers.cancelled == [first], workers.cancelled
+        assert retrieval.is_complete()
+        first_callback(first, 1)
+        assert retrieval.errors.errors == 0 and retrieval.errors.downloads == 1
+        assert config.db.execute('SELECT state FROM rover_chunks').fetchall() == [(DONE,)]
+
+
+def test_fail_over():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        endpoints = Endpoints(config.log, 'http://a/query,http://b/query')
+        a, b = list(endpoints)
+        retrieval = Retrieval(config.log, '', dir, True, 'http://a/query', False, 0, OLDEST,
+                              ChunkJournal(config, 'test'), endpoints=endpoints)
+        retrieval.add_coverage(coverage(config, 'IU_ANMO_00_LHZ', '2018-01-01', '2018-01-01T23:59:59'))
+        workers = StubWorkers(config)
+        assert retrieval.has_chunks()
+        retrieval.new_worker(workers, None, None)
+        assert a.running == 1
+        name, callback = workers.jobs[-1]
+        callback(name, 1, feedback={'http_status': 503})
+        # the whole chunk is retried at the other service
+        assert retrieval.has_chunks() and retrieval.errors.errors == 0
+        retrieval.new_worker(workers, None, None)
+        assert a.running == 0 and b.running == 1
+        name, callback = workers.jobs[-1]
+        callback(name, 0, feedback={})
+        assert retrieval.is_complete()
+        states = [row[0] for row in config.db.execute('SELECT state FROM rover_chunks ORDER BY id').fetchall()]
+        assert states == [RETRIED, DONE], states
+
+
+def test_shard_lines():
+    lines = ['US * * * 2018-01-01T00:00:00 2018-01-03T00:00:00', 'IU COLA 00 LHZ', 'IU ANMO 00 LHZ',
+             'II KAPI 00 LHZ 2018-01-01T00:00:00 2018-01-10T00:00:00']
+    shards = shard_lines(lines, 2, days=1)
+    # sorted by network, with the wildcard split into daily windows
+    assert shards == [['II KAPI 00 LHZ 2018-01-01T00:00:00 2018-01-10T00:00:00', 'IU ANMO 00 LHZ'],
+                      ['US * * * 2018-01-01T00:00:00.000000 2018-01-02T00:00:00.000000'],
+                      ['US * * * 2018-01-02T00:00:00.000000 2018-01-03T00:00:00.000000'],
+                      ['IU COLA 00 LHZ']], shards
+    assert shard_lines(lines, 10) == [sorted(lines)]
@@ -0,0 +1,53 @@
+
+from sys import version_info
+
+if version_info[0] >= 3:
+    from tempfile import TemporaryDirectory
+else:
+    from backports.tempfile import TemporaryDirectory
+
+from os.path import join
+
+from rover.metrics import Histogram, Metrics, RollingRate, DOWNLOAD, QUEUE
+from rover.utils import read_json
+
+from .test_utils import WindowsTemp
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for value in (0.005, 0.2, 0.2, 2, 500):
+        histogram.add(value)
+    assert histogram.percentile(50) == 0.3, histogram.percentile(50)
+    assert histogram.percentile(100) == 500
+    assert histogram.as_dict()['count'] == 5
+
+
+def test_rate():
+    rate = RollingRate(window=10)
+    rate.add(100, epoch=0)
+    rate.add(100, epoch=15)
+    # the first value has expired
+    assert rate.rate(epoch=20) == 10
+
+
+def test_record():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        metrics = Metrics()
+        metrics.record('a', 'http://example.com', 'IU_ANMO 2018-001', 10.0, 0,
+                       {'start_epoch': 10.5, 'download_byte_count': 1000, 'timings': {DOWNLOAD: 2.0}})
+        metrics.record('b', 'http://example.com', 'IU_COLA 2018-001', 10.0, 1, None)
+        assert metrics.total.chunks == 2
+        assert metrics.total.errors == 1
+        assert metrics.sources['a'].bytes == 1000
+        assert metrics.endpoints['http://example.com'].chunks == 2
+        assert metrics.sources['a'].latencies[QUEUE].total == 0.5
+        metrics.record_idle(0.5, 2)
+        path = join(dir, 'metrics.json')
+        metrics.dump(path)
+        dumped = read_json(path)
+        assert dumped['sources']['a']['latency'][DOWNLOAD]['count'] == 1
+        assert dumped['idle'] == {'seconds': 0.5, 'count': 2, 'mean': 0.25}, dumped['idle']
+        assert len(dumped['recent']) == 2
+        assert read_json(join(dir, 'missing.json')) is None
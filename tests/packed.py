@@ -0,0 +1,83 @@
+
+from sys import version_info
+
+if version_info[0] >= 3:
+    from tempfile import TemporaryDirectory
+else:
+    from backports.tempfile import TemporaryDirectory
+
+from rover.index import Indexer
+from rover.manager import MergedIndex
+from rover.packed import PACKED_TABLE, pack_timespans, unpack_timespans, has_packed_timespans, \
+    create_packed_table
+from rover.sqlite import SqliteSupport
+from rover.utils import parse_epoch
+from .test_utils import TestConfig, WindowsTemp
+
+
+def create_index(config):
+    config.db.execute('''CREATE TABLE tsindex (network text, station text, location text, channel text,
+                                               timespans text, starttime text, endtime text, samplerate float,
+                                               filename text)''')
+    for (n, s, l, c, timespans, start, end, filename) in (
+            ('IU', 'ANMO', '00', 'LHZ', '[0.0:10.0],[20.0:30.0]', '1970-01-01T00:00:00', '1970-01-01T00:00:30', 'a'),
+            ('IU', 'ANMO', '00', 'LHZ', None, '2018-01-01T00:00:00', '2018-01-01T12:00:00', 'b'),
+            ('IU', 'COLA', '00', 'LHZ', '[0.0:10.0]', '1970-01-01T00:00:00', '1970-01-01T00:00:10', 'c')):
+        config.db.execute('INSERT INTO tsindex VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)',
+                          (n, s, l, c, timespans, start, end, filename))
+    config.db.commit()
+
+
+def test_round_trip():
+    timespans = [(0.0, 10.5), (parse_epoch('2018-01-01'), parse_epoch('2018-01-02'))]
+    assert list(unpack_timespans(pack_timespans(timespans))) == timespans
+    assert len(pack_timespans(timespans)) == 32
+    assert list(unpack_timespans(pack_timespans([]))) == []
+
+
+def test_pack():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        create_index(config)
+        db = SqliteSupport(config)
+        assert not has_packed_timespans(db)
+        # packing is done after indexing, for the files indexed (mseedindex is not needed here)
+        Indexer._pack_timespans(db, ['a', 'b'])
+        assert has_packed_timespans(db)
+        assert db.fetchsingle('SELECT count(*) FROM %s' % PACKED_TABLE) == 2
+        # packing again (eg by a concurrent process) is harmless
+        Indexer._pack_timespans(db, ['a', 'b', 'c'])
+        assert db.fetchsingle('SELECT count(*) FROM %s' % PACKED_TABLE) == 3
+        assert list(unpack_timespans(db.fetchsingle('SELECT packed FROM %s WHERE id = 1' % PACKED_TABLE))) == \
+            [(0.0, 10.0), (20.0, 30.0)]
+        index = MergedIndex(config, 'IU', 'IU')
+        try:
+            assert index.coverage('IU_ANMO_00_LHZ').timespans == \
+                [(0.0, 10.0), (20.0, 30.0), (parse_epoch('2018-01-01'), parse_epoch('2018-01-01T12:00:00'))]
+        finally:
+            index.close()
+
+
+def test_triggers():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        create_index(config)
+        db = SqliteSupport(config)
+        Indexer._pack_timespans(db, ['a', 'b', 'c'])
+        # changed or deleted entries lose their packed timespans
+        db.execute('''UPDATE tsindex SET timespans = '[0.0:5.0]' WHERE rowid = 1''')
+        db.execute('''DELETE FROM tsindex WHERE rowid = 3''')
+        assert [row[0] for row in db.fetchall('SELECT id FROM %s ORDER BY id' % PACKED_TABLE)] == [2]
+        # and the text is used instead
+        index = MergedIndex(config, 'IU', 'IU')
+        try:
+            assert index.coverage('IU_ANMO_00_LHZ').timespans[0] == (0.0, 5.0)
+            assert not index.coverage('IU_COLA_00_LHZ')
+        finally:
+            index.close()
+        # until they are packed again
+        Indexer._pack_timespans(db, ['a'])
+        assert db.fetchsingle('SELECT count(*) FROM %s' % PACKED_TABLE) == 2
+        # creating the table again changes nothing
+        create_packed_table(db)
+        assert db.fetchsingle('SELECT count(*) FROM %s' % PACKED_TABLE) == 2
@@ -1,4 +1,5 @@
 
+from os import listdir, mkdir
 from os.path import join, exists
 from sys import version_info
 
@@ -9,7 +10,7 @@ else:
 
 from rover.args import DEFAULT_LEAPURL, DEFAULT_LEAPEXPIRE, DEFAULT_HTTPTIMEOUT, DEFAULT_HTTPRETRIES
 from rover.logs import init_log
-from rover.utils import check_leap, tidy_timestamp
+from rover.utils import check_leap, tidy_timestamp, SortedFile, parse_epoch, parse_epochs, _parse_epoch
 
 from .test_utils import WindowsTemp
 
@@ -33,3 +34,43 @@ def test_tidy_timestamp():
         assert_timestamp(log, '2018-7-4', '2018-07-04T00:00:00.000000')
         assert_timestamp(log, '2018-7-4T1:2:3.456', '2018-07-04T01:02:03.456000')
         assert_timestamp(log, '2018-7-4T1:3', '2018-07-04T01:03:00.000000')
+
+
+def test_sorted_file():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        log = init_log(dir, '7M', 1, 5, 0, 'test', False, 0)[0]
+        path, temp_dir = join(dir, 'response.txt'), join(dir, 'tmp')
+        mkdir(temp_dir)
+        lines = ['IU ANMO 00 LHZ 1', 'IU ANMO 10 LHZ 2', 'IU COLA 00 LHZ 3', 'IU KONO 00 LHZ 4', 'US AAM 00 LHZ 5']
+        with open(path, 'w') as output:
+            output.write('\n'.join(lines))
+        # already sorted, so read directly
+        sorted_file = SortedFile(log, [path], temp_dir, True, max_lines=2)
+        assert list(sorted_file) == lines
+        assert listdir(temp_dir) == []
+        # otherwise sorted in runs (the first is already sorted and read from the file) and merged
+        with open(path, 'w') as output:
+            output.write('\n'.join(lines[:2] + lines[:1:-1]) + '\n')
+        for sort_in_python in (True, False):
+            sorted_file = SortedFile(log, [path], temp_dir, sort_in_python, max_lines=2)
+            assert len(listdir(temp_dir)) == 1
+            assert list(sorted_file) == lines
+            assert list(sorted_file) == lines  # and repeated
+            sorted_file.close()
+            assert listdir(temp_dir) == []
+
+
+def test_parse_epoch():
+    # the fixed-width formats are parsed directly, but the results must match the general case
+    for date in ('2018-07-04', '2018-07-04T01:03', '2018-07-04T01:02:03', '2018-07-04T01:02:03.4',
+                 '2018-07-04T01:02:03.456789', '1969-12-31T23:59:59.999', '2018-7-4T1:2:3.456'):
+        assert parse_epoch(date) == _parse_epoch(date), date
+        assert parse_epoch(date + 'Z') == _parse_epoch(date), date
+    for date in ('2018-13-01', '2018-02-30', '2018-07-04T24:00', '2018-07-04T01:02:60', '2018-07-04T01:02:03.',
+                 '2018-07-04T01:02:03.1234567', '2018-07-04 01:02:03'):
+        try:
+            parse_epoch(date)
+            assert False, date
+        except ValueError:
+            pass
+    assert parse_epochs(['1970-01-01T00:00:01', '1970-01-02']) == [1.0, 86400.0]
@@ -0,0 +1,229 @@
+
+from os.path import join
+from sys import version_info, executable
+from time import time, sleep
+
+if version_info[0] >= 3:
+    from tempfile import TemporaryDirectory
+else:
+    from backports.tempfile import TemporaryDirectory
+
+from rover.utils import windows
+from rover.workers import Workers, ThreadWorkers, PoolWorkers, AdaptiveLimit
+from .test_utils import TestConfig, WindowsTemp
+
+
+class Context:
+
+    def __init__(self, config):
+        self.db = config.db
+        self.count = 0
+
+    def job(self, value):
+        self.count += 1
+        if value < 0:
+            raise Exception('negative')
+        return {'value': value, 'count': self.count}
+
+
+def test_thread_workers():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 2, Context)
+        results = []
+
+        def callback(name, returncode, feedback=None):
+            results.append((name, returncode, feedback))
+
+        for value in (1, 2, -1, 3):
+            workers.execute(lambda context, value=value: context.job(value), callback=callback, name=str(value))
+        workers.wait_for_all()
+        assert len(results) == 4, results
+        failed = [name for (name, returncode, feedback) in results if returncode]
+        assert failed == ['-1'], failed
+        values = sorted(feedback['value'] for (name, returncode, feedback) in results if feedback)
+        assert values == [1, 2, 3], values
+        # contexts are re-used within threads, so at most two were created
+        assert sum(feedback['count'] == 1 for (name, returncode, feedback) in results if feedback) <= 2
+
+
+# a minimal worker: echoes the job back as feedback, exits on request
+ECHO = '''
+import json, sys
+for line in iter(sys.stdin.readline, ''):
+    job = json.loads(line)
+    if job.get('exit'):
+        sys.exit(3)
+    sys.stdout.write(json.dumps({'returncode': 0, 'feedback': job}) + '\\n')
+    sys.stdout.flush()
+'''
+
+
+def test_pool_workers():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        script = join(dir, 'echo.py')
+        with open(script, 'w') as output:
+            output.write(ECHO)
+        workers = PoolWorkers(config, 2, '"%s" "%s"' % (executable, script))
+        results = []
+
+        def callback(name, returncode, feedback=None):
+            results.append((name, returncode, feedback))
+
+        for value in range(5):
+            workers.execute({'value': value}, callback=callback, name=str(value))
+        workers.execute({'exit': True}, callback=callback, name='exit')
+        workers.execute({'value': 5}, callback=callback, name='5')
+        workers.wait_for_all()
+        assert len(results) == 7, results
+        failed = [(name, returncode) for (name, returncode, feedback) in results if returncode]
+        assert failed == [('exit', 3)], failed
+        values = sorted(feedback['value'] for (name, returncode, feedback) in results if feedback)
+        assert values == list(range(6)), values
+
+
+def test_subprocess_workers():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        workers = Workers(config, 2)
+        results = []
+
+        def callback(name, returncode, **kwargs):
+            results.append((name, returncode))
+
+        for command in ('exit 0', 'exit 2', 'exit 0'):
+            workers.execute(command, callback=callback)
+        # the third job re-used a freed slot, so the idle time was measured
+        assert workers.mean_idle_time() is not None
+        workers.wait(timeout=10)
+        workers.wait_for_all()
+        assert sorted(results) == [('exit 0', 0), ('exit 0', 0), ('exit 2', 2)], results
+        # feedback (json on stdout) is read through a pipe
+        workers.execute([executable, '-c', 'print(\'{"value": 1}\')'],
+                        callback=lambda name, returncode, **kwargs: results.append(kwargs), feedback=True)
+        workers.wait_for_all()
+        assert results[-1] == {'feedback': {'value': 1}}, results
+        # a cancelled job is killed, but still reported
+        command = [executable, '-c', 'import time; time.sleep(60)']
+        workers.execute(command, callback=callback)
+        assert workers.cancel(str(command))
+        workers.wait_for_all()
+        assert results[-1][1] != 0, results
+        # including the command run by a shell (which holds the pipe open until it exits)
+        if not windows():
+            command = '"%s" -c "import time; time.sleep(60)"; true' % executable
+            workers.execute(command, callback=callback, feedback=True)
+            start = time()
+            assert workers.cancel(command)
+            workers.wait(timeout=10)
+            assert results[-1][0] == command and time() - start < 5, results
+
+
+# a worker that never replies
+SLOW = '''
+import sys, time
+sys.stdin.readline()
+time.sleep(60)
+'''
+
+
+def test_pool_cancel():
+    if windows():
+        return
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        script = join(dir, 'slow.py')
+        with open(script, 'w') as output:
+            output.write(SLOW)
+        # '; true' so that the shell waits for python, rather than running it directly
+        workers = PoolWorkers(config, 1, '"%s" "%s"; true' % (executable, script))
+        results = []
+
+        def callback(name, returncode, feedback=None):
+            results.append((name, returncode))
+
+        workers.execute({}, callback=callback, name='slow')
+        start = time()
+        assert workers.cancel('slow')
+        workers.wait(timeout=10)
+        assert len(results) == 1 and results[0][1] != 0 and time() - start < 5, results
+
+
+def test_adaptive_limit():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 10, Context)
+        adaptive = AdaptiveLimit(config.log, workers, 2, 5)
+        assert workers.limit == 2
+        # a full first round of successes increases the limit by one
+        for _ in range(2):
+            adaptive.observe(0, {'download_byte_count': 1000})
+        assert workers.limit == 3
+        # congestion halves (but only once for a burst of errors)
+        adaptive.observe(1, {'http_status': 503})
+        adaptive.observe(1, {'http_status': 429})
+        assert workers.limit == 2, workers.limit
+        # other errors are ignored
+        adaptive.observe(0, {'download_byte_count': 1000})
+        adaptive.observe(1, {'http_status': 404})
+        adaptive.observe(0, {'download_byte_count': 1000})
+        assert workers.limit == 3, workers.limit
+        # and the limits are respected (later rounds depend on timing)
+        for _ in range(20):
+            adaptive.observe(0, {'download_byte_count': 1000})
+        assert 2 <= workers.limit <= 5, workers.limit
+
+
+def test_adaptive_latency():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 10, Context)
+        adaptive = AdaptiveLimit(config.log, workers, 2, 5)
+
+        def run_round(n_bytes, seconds):
+            # each round takes (just over) one second, so the rate is (about) the total bytes
+            adaptive._round_start = time() - 1
+            for _ in range(workers.limit):
+                adaptive.observe(0, {'download_byte_count': n_bytes, 'timings': {'download': seconds}})
+
+        run_round(1000, 1.0)
+        assert workers.limit == 3
+        # downloads that take longer, but deliver more in total, are sharing a link that is not saturated
+        run_round(1000, 5.0)
+        assert workers.limit == 4, workers.limit
+        # downloads that take much longer than before, without any gain, suggest queuing at the service
+        run_round(700, 5.0)
+        assert workers.limit == 3, workers.limit
+
+
+def test_idle_time():
+    with WindowsTemp(TemporaryDirectory) as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 2, Context)
+
+        def run_one(delay=0):
+            workers.execute(lambda context: context.job(1), name='job')
+            workers.wait_for_all()
+            sleep(delay)
+
+        # a slot that is freed and then re-used (after a delay) was idle for that delay
+        run_one(0.2)
+        run_one()
+        assert workers.idle_count == 1 and 0.2 <= workers.idle_time < 1, (workers.idle_count, workers.idle_time)
+        # but not while there was nothing to start
+        sleep(0.2)
+        workers.no_work()
+        run_one()
+        assert workers.idle_count == 1, workers.idle_count
+        # and slots removed by reducing the limit are dropped
+        for _ in range(2):
+            workers.execute(lambda context: context.job(1), name='job')
+        workers.wait_for_all()
+        workers.set_limit(1)
+        workers.idle_time, workers.idle_count = 0, 0
+        run_one(0.2)
+        run_one()
+        run_one()
+        # (otherwise the extra slot would be re-used in turn, adding a second delay)
+        assert workers.idle_count == 3 and 0.2 <= workers.idle_time < 0.35, (workers.idle_count, workers.idle_time)